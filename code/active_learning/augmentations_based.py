@@ -1,7 +1,6 @@
-from utils import AverageMeter
+from utils import AverageMeter, RankingStability, get_device
 import time
 import torch
-import numpy as np
 
 """
 Mode based uncertainty sampling classification
@@ -17,7 +16,41 @@ class UncertaintySamplingAugmentationBased:
         self.verbose = verbose
 
     @staticmethod
-    def get_samples(epoch, args, model, _, unlabeled_loader, number):
+    def predict_classes(epoch, args, model, unlabeled_loader, batch_time, end):
+        max_classes = None
+
+        for i, (data_x, data_y) in enumerate(unlabeled_loader):
+            data_x = data_x.to(get_device(), non_blocking=True)
+
+            with torch.no_grad():
+                if args.weak_supervision_strategy == 'semi_supervised_active_learning':
+                    output = model.forward_encoder_classifier(data_x)
+                else:
+                    output = model(data_x)
+
+            output = torch.argmax(output, dim=1)
+
+            max_classes = output if max_classes is None else torch.cat([max_classes, output])
+
+            batch_time.update(time.time() - end)
+            end = time.time()
+
+            if i % args.print_freq == 0:
+                print('{0}\t'
+                      'Epoch: [{1}][{2}/{3}]\t'
+                      'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
+                      .format(args.uncertainty_sampling_method, epoch, i, len(unlabeled_loader),
+                              batch_time=batch_time))
+
+        return max_classes, end
+
+    @staticmethod
+    def mode_scores(all_max_classes):
+        all_modes = torch.mode(all_max_classes, dim=1).values
+
+        return torch.sum(all_max_classes == all_modes.unsqueeze(dim=1), dim=1).float().cpu()
+
+    def get_samples(self, epoch, args, model, _, unlabeled_loader, number):
         batch_time = AverageMeter()
         end = time.time()
         model.eval()
@@ -25,55 +58,46 @@ class UncertaintySamplingAugmentationBased:
         all_max_classes = None
 
         for j in range(args.augmentations_based_iterations):
+            max_classes, end = self.predict_classes(epoch, args, model, unlabeled_loader, batch_time, end)
+            print('\n Augmentations based sample: ', j+1)
 
-            max_classes = None
-            targets = None
+            all_max_classes = torch.unsqueeze(max_classes, dim=1) if all_max_classes is None else \
+                torch.cat([all_max_classes, torch.unsqueeze(max_classes, dim=1)], dim=1)
 
-            for i, (data_x, data_y) in enumerate(unlabeled_loader):
-                data_x = data_x.cuda(non_blocking=True)
-                data_y = data_y.cuda(non_blocking=True)
+        scores = self.mode_scores(all_max_classes)
 
-                with torch.no_grad():
-                    if args.weak_supervision_strategy == 'semi_supervised_active_learning':
-                        output = model.forward_encoder_classifier(data_x)
-                    else:
-                        output = model(data_x)
+        return scores.argsort()[:number]
 
-                output = torch.argmax(output, dim=1)
 
-                max_classes = output if max_classes is None else torch.cat([max_classes, output])
-                targets = data_y.cpu().numpy() if targets is None \
-                    else np.concatenate([targets, data_y.cpu().numpy().tolist()])
+class AdaptiveUncertaintySamplingAugmentationBased(UncertaintySamplingAugmentationBased):
+    """
+    Mode based sampling with a variable number of augmentation passes: after every pass the mode agreement of the
+    passes so far is ranked and sampling stops once the selection is stable (see RankingStability), at the latest after
+    --augmentations_based_iterations passes. The passes used in every cycle are kept in self.log.
+    """
 
-                batch_time.update(time.time() - end)
-                end = time.time()
+    def __init__(self, verbose=True):
+        super(AdaptiveUncertaintySamplingAugmentationBased, self).__init__(verbose=verbose)
+        self.log = []
 
-                if i % args.print_freq == 0:
-                    print('{0}\t'
-                          'Epoch: [{1}][{2}/{3}]\t'
-                          'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
-                          .format(args.uncertainty_sampling_method, epoch, i, len(unlabeled_loader),
-                                  batch_time=batch_time))
-            print('\n Augmentations based sample: ', j+1)
+    def get_samples(self, epoch, args, model, _, unlabeled_loader, number):
+        batch_time = AverageMeter()
+        end = time.time()
+        model.eval()
 
-            all_max_classes = torch.unsqueeze(max_classes, dim=1) if all_max_classes is None else \
-                torch.cat([all_max_classes, torch.unsqueeze(max_classes, dim=1)], dim=1)
+        all_max_classes = None
+        stability = RankingStability(args, number, descending=False)
 
-        all_modes = torch.mode(all_max_classes, dim=1).values
-        scores = torch.zeros(all_max_classes.size(0))
+        for j in range(args.augmentations_based_iterations):
+            max_classes, end = self.predict_classes(epoch, args, model, unlabeled_loader, batch_time, end)
 
-        for j in range(all_max_classes.size(0)):
-            scores[j] = torch.sum(all_max_classes[j] == all_modes[j])
+            all_max_classes = torch.unsqueeze(max_classes, dim=1) if all_max_classes is None else \
+                torch.cat([all_max_classes, torch.unsqueeze(max_classes, dim=1)], dim=1)
 
-        '''
-        original_stdout = sys.stdout
+            if stability.update(self.mode_scores(all_max_classes) / (j + 1)):
+                break
 
-        with open(f'output_{args.semi_supervised_method}.txt', 'w') as f:
-            sys.stdout = f
-            print(targets.tolist())
-            print(scores[scores.argsort()[:number]].cpu().numpy().tolist())
-            print(np.array(targets)[scores.argsort()[:number].cpu().numpy()].tolist())
-            sys.stdout = original_stdout
-        '''
+        print('\n Augmentations based samples: ', stability.iterations)
+        self.log.append(dict(stability.get_log(epoch, args.augmentations_based_iterations), cycle=len(self.log)))
 
-        return scores.argsort()[:number]
+        return stability.rank(self.mode_scores(all_max_classes))[:number]
@@ -1,4 +1,4 @@
-from utils import AverageMeter
+from utils import AverageMeter, predict_member_probabilities, get_device
 import time
 import torch
 import numpy as np
@@ -342,13 +342,19 @@ class UncertaintySamplingBatchBald:
 
         end = time.time()
 
+        if hasattr(model, 'forward_members'):
+            all_scores = predict_member_probabilities(model, unlabeled_loader).to(get_device(), non_blocking=True)
+            scores, indices = self.get_batchbald_batch(all_scores, batch_size=number, num_samples=all_scores.size(1))
+
+            return indices
+
         model.train()
 
         for j in range(args.mc_dropout_iterations):
             scores = None
             for i, (data_x, data_y) in enumerate(unlabeled_loader):
-                data_x = data_x.cuda(non_blocking=True)
-                data_y = data_y.cuda(non_blocking=True)
+                data_x = data_x.to(get_device(), non_blocking=True)
+                data_y = data_y.to(get_device(), non_blocking=True)
 
                 with torch.no_grad():
                     if args.weak_supervision_strategy == 'semi_supervised_active_learning':
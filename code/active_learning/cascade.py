@@ -0,0 +1,69 @@
+import time
+import numpy as np
+import torch
+import torch.nn.functional as F
+from active_learning.others import UncertaintySamplingOthers
+from utils import create_subset_loader, get_inference_cache
+
+"""
+Cascaded acquisition: a single-pass criterion ranks the whole unlabeled subset and the expensive sampler
+(mc_dropout, augmentations_based or batch_bald) only scores the shortlisted candidates.
+"""
+
+
+class UncertaintySamplingCascade:
+    """
+    Ranks the unlabeled subset with the --cascade-criterion of UncertaintySamplingOthers on test-time inputs, keeps the
+    top --cascade-shortlist * add_labeled candidates and runs the wrapped sampler on a loader over the shortlist only.
+    The shortlist size, the stage timings and how the final selection ranks in the single-pass ranking are logged per
+    cycle.
+    """
+
+    def __init__(self, sampler, dataset_class, criterion='entropy_based', verbose=True):
+        self.sampler = sampler
+        self.dataset_class = dataset_class
+        self.criterion = UncertaintySamplingOthers(criterion)
+        self.verbose = verbose
+        self.log = []
+
+    def rank(self, args, model, unlabeled_loader):
+        loader = create_subset_loader(unlabeled_loader, np.arange(len(unlabeled_loader.dataset)),
+                                      transform=self.dataset_class.transform_test)
+        model.eval()
+        logits, _ = get_inference_cache(args).predict(model, loader)
+
+        return self.criterion.rank(self.criterion.method(F.softmax(logits, dim=1)))
+
+    def get_samples(self, epoch, args, model, train_loader, unlabeled_loader, number):
+        start = time.time()
+        ranking = self.rank(args, model, unlabeled_loader)
+        cheap_time = time.time() - start
+
+        shortlist = ranking[:max(number, args.cascade_shortlist * number)]
+
+        start = time.time()
+        shortlist_indices = self.sampler.get_samples(epoch, args, model, train_loader,
+                                                     create_subset_loader(unlabeled_loader, shortlist.numpy()),
+                                                     number)
+        expensive_time = time.time() - start
+        samples_indices = shortlist[torch.as_tensor(shortlist_indices).cpu()]
+
+        cheap_ranks = torch.empty_like(ranking)
+        cheap_ranks[ranking] = torch.arange(ranking.size(0))
+        selected_ranks = cheap_ranks[samples_indices].float()
+
+        overlap = len(set(samples_indices.tolist()) & set(ranking[:number].tolist())) / max(1, len(samples_indices))
+
+        self.log.append({'cycle': len(self.log), 'epoch': epoch,
+                         'criterion': self.criterion.uncertainty_sampling_method,
+                         'pool_size': len(unlabeled_loader.dataset), 'shortlist_size': len(shortlist),
+                         'cheap_time': cheap_time, 'expensive_time': expensive_time, 'overlap': overlap,
+                         'mean_cheap_rank': selected_ranks.mean().item(),
+                         'max_cheap_rank': selected_ranks.max().item()})
+
+        if self.verbose:
+            print('Cascade Sampling\t'
+                  'Shortlist: [{0}/{1}]\t'
+                  'Overlap {2:.3f}'.format(len(shortlist), len(unlabeled_loader.dataset), overlap))
+
+        return samples_indices
@@ -0,0 +1,51 @@
+import time
+import torch
+from utils import predict_member_probabilities
+
+"""
+Deep ensemble uncertainty sampling
+
+Scores the unlabeled subset with the members of a StackedEnsemble (--ensemble-size > 1), following:
+Simple and Scalable Predictive Uncertainty Estimation using Deep Ensembles:
+https://arxiv.org/abs/1612.01474
+"""
+
+
+class UncertaintySamplingDeepEnsemble:
+    """
+    Collects the N x M x C member probabilities of the stacked ensemble in one forward per batch and ranks the
+    samples by BALD (mutual information between prediction and member) or by the entropy of the mean prediction.
+    """
+
+    def __init__(self, criterion='bald', verbose=True):
+        self.criterion = criterion
+        self.verbose = verbose
+        self.log = []
+
+    @staticmethod
+    def entropy(probs):
+        return torch.sum(-probs * torch.log(probs.clamp(min=1e-12)), dim=-1)
+
+    def get_samples(self, epoch, args, model, _, unlabeled_loader, number):
+        if not hasattr(model, 'forward_members'):
+            raise ValueError('deep_ensemble sampling needs --ensemble-size > 1')
+
+        start = time.time()
+        probs = predict_member_probabilities(model, unlabeled_loader)
+
+        scores = self.entropy(probs.mean(dim=1))
+        if self.criterion == 'bald':
+            scores = scores - self.entropy(probs).mean(dim=1)
+
+        samples_indices = scores.argsort(descending=True)[:number]
+
+        self.log.append({'cycle': len(self.log), 'epoch': epoch, 'criterion': self.criterion,
+                         'members': probs.size(1), 'pool_size': probs.size(0), 'score_time': time.time() - start,
+                         'selected_score': scores[samples_indices].mean().item()})
+
+        if self.verbose:
+            print('Deep Ensemble Sampling\t'
+                  'Members: [{0}]\t'
+                  'Time {1:.3f}'.format(probs.size(1), self.log[-1]['score_time']))
+
+        return samples_indices
@@ -0,0 +1,138 @@
+import math
+import time
+import torch
+from utils import get_inference_cache, forward_embeddings, get_device
+
+"""
+Last-layer Laplace approximation
+
+Gaussian posterior over the final linear layer of the classifier head from the generalized Gauss-Newton (GGN) of the
+labeled set, following:
+Laplace Redux - Effortless Bayesian Deep Learning:
+https://arxiv.org/abs/2106.14806
+"""
+
+
+class UncertaintySamplingLaplace:
+    """
+    Fits a diagonal or Kronecker-factored (KFAC) GGN posterior over the weights and bias of the last nn.Linear of the
+    classifier head (ResNet.linear, SimCLRArch.classifier, ...) on the labeled set at every selection. The unlabeled
+    subset is scored from one deterministic pass of the backbone (through the inference cache) and the Gaussian logit
+    distribution of the head: BALD from --laplace-samples logit samples, or the entropy of the probit approximated
+    predictive distribution without sampling.
+    """
+
+    def __init__(self, structure='kron', prior_precision=1.0, samples=100, criterion='bald', chunk_size=1024,
+                 verbose=True):
+        self.structure = structure
+        self.prior_precision = prior_precision
+        self.samples = samples
+        self.criterion = criterion
+        self.chunk_size = chunk_size
+        self.verbose = verbose
+        self.weight, self.variance, self.eigen_features, self.eigen_classes, self.scales = None, None, None, None, None
+        self.log = []
+
+    @staticmethod
+    def head(model):
+        sequential = model.classifier if hasattr(model, 'classifier') else model.linear
+        return sequential[:-1], sequential[-1]
+
+    @staticmethod
+    def augment(features):
+        return torch.cat([features, torch.ones_like(features[:, :1])], dim=1)
+
+    def features(self, model, embeddings):
+        body, _ = self.head(model)
+        return self.augment(body(embeddings))
+
+    @staticmethod
+    def entropy(probs):
+        return torch.sum(-probs * torch.log(probs.clamp(min=1e-12)), dim=-1)
+
+    def fit(self, model, train_loader):
+        _, linear = self.head(model)
+        self.weight = torch.cat([linear.weight, linear.bias[:, None]], dim=1).detach()
+        classes, dimension = self.weight.shape
+        device = self.weight.device
+
+        features_outer = torch.zeros(dimension, dimension, device=device)
+        classes_outer = torch.zeros(classes, classes, device=device)
+        diagonal = torch.zeros(classes, dimension, device=device)
+        count = 0
+
+        model.eval()
+        with torch.no_grad():
+            for data_x, _ in train_loader:
+                phi = self.features(model, model.forward_encoder(data_x.to(get_device(), non_blocking=True)))
+                probs = torch.softmax(phi @ self.weight.t(), dim=1)
+
+                if self.structure == 'kron':
+                    features_outer += phi.t() @ phi
+                    classes_outer += torch.diag(probs.sum(dim=0)) - probs.t() @ probs
+                else:
+                    diagonal += (probs - probs ** 2).t() @ phi ** 2
+                count += phi.size(0)
+
+        if self.structure == 'kron':
+            # GGN ~ (sum_n Lambda_n) x (sum_n phi_n phi_n^T / N), both factors are diagonalized once so the posterior
+            # covariance of the logits only needs the eigenvalue products g_i * a_j + prior precision
+            features_eigenvalues, self.eigen_features = torch.linalg.eigh(features_outer / max(1, count))
+            classes_eigenvalues, self.eigen_classes = torch.linalg.eigh(classes_outer)
+            self.scales = 1 / (torch.outer(classes_eigenvalues.clamp(min=0), features_eigenvalues.clamp(min=0)) +
+                               self.prior_precision)
+        else:
+            self.variance = 1 / (diagonal + self.prior_precision)
+
+        return count
+
+    def logit_distribution(self, phi):
+        """
+        Mean and covariance square root of the logits, the covariance of a sample being
+        basis @ diag(scale ** 2) @ basis^T (diagonal when basis is None)
+        """
+        mean = phi @ self.weight.t()
+        if self.structure == 'kron':
+            scale = ((phi @ self.eigen_features) ** 2 @ self.scales.t()).sqrt()
+            return mean, scale, self.eigen_classes
+        return mean, (phi ** 2 @ self.variance.t()).sqrt(), None
+
+    def score(self, mean, scale, basis):
+        if self.criterion == 'entropy':
+            variance = scale ** 2 if basis is None else scale ** 2 @ (basis ** 2).t()
+            probs = torch.softmax(mean / torch.sqrt(1 + math.pi / 8 * variance), dim=1)
+            return self.entropy(probs)
+
+        noise = torch.randn(mean.size(0), self.samples, mean.size(1), device=mean.device) * scale[:, None]
+        logits = mean[:, None] + (noise if basis is None else noise @ basis.t())
+        probs = torch.softmax(logits, dim=-1)
+        return self.entropy(probs.mean(dim=1)) - self.entropy(probs).mean(dim=1)
+
+    def get_samples(self, epoch, args, model, train_loader, unlabeled_loader, number):
+        start = time.time()
+        labeled = self.fit(model, train_loader)
+        fit_time = time.time() - start
+
+        start = time.time()
+        _, embeddings = get_inference_cache(args).predict(model, unlabeled_loader, forward=forward_embeddings)
+        scores = []
+
+        with torch.no_grad():
+            for chunk in torch.split(embeddings, self.chunk_size):
+                phi = self.features(model, chunk.to(self.weight.device, non_blocking=True))
+                scores.append(self.score(*self.logit_distribution(phi)).cpu())
+
+        scores = torch.cat(scores)
+        samples_indices = scores.argsort(descending=True)[:number]
+
+        self.log.append({'cycle': len(self.log), 'epoch': epoch, 'structure': self.structure,
+                         'criterion': self.criterion, 'labeled': labeled, 'pool_size': len(scores),
+                         'fit_time': fit_time, 'score_time': time.time() - start,
+                         'selected_score': scores[samples_indices].mean().item()})
+
+        if self.verbose:
+            print('Laplace Sampling\t'
+                  'Fit Time {0:.3f}\t'
+                  'Score Time {1:.3f}'.format(fit_time, self.log[-1]['score_time']))
+
+        return samples_indices
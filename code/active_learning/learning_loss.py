@@ -1,6 +1,6 @@
+import os
 import time
 import torch
-from torch.utils.data import DataLoader
 
 from active_learning.others import UncertaintySamplingOthers
 from data.isic_dataset import ISICDataset
@@ -14,12 +14,13 @@ from model.loss_net import LossNet
 from utils import create_loaders, create_model_optimizer_scheduler, create_model_optimizer_loss_net, get_loss, \
     print_args, loss_module_objective_func, AverageMeter, accuracy, Metrics, store_logs, save_checkpoint, \
     perform_sampling, LossPerClassMeter, create_model_optimizer_autoencoder, load_pretrained, \
-    create_model_optimizer_simclr, postprocess_indices
+    create_model_optimizer_simclr, postprocess_indices, save_run_state, load_run_state, set_rng_state, \
+    ModelSnapshot, ValidationScheduler, create_stopping_policy, forward_no_grad, backward_chunks, \
+    ActivationCache, apply_freeze_schedule, get_inference_cache, get_device, synchronize_gradients, \
+    train_loss_columns, create_train_loader
 
 import pandas as pd
-from copy import deepcopy
 import numpy as np
-import torch.nn.functional as F
 
 
 '''
@@ -37,7 +38,11 @@ class LearningLoss:
         self.model = None
         self.kwargs = {'num_workers': 16, 'pin_memory': False, 'drop_last': True}
         self.init = self.args.semi_supervised_init
+        self.activation_cache = ActivationCache(os.path.join(self.args.checkpoint_path,
+                                                             f'{self.args.name}_{self.args.seed}', 'activations.npy'),
+                                                self.kwargs)
         self.semi_supervised = self.args.semi_supervised_method
+        self.inference_cache = get_inference_cache(self.args)
 
     def main(self):
         dataset_cl = self.datasets[self.args.dataset](root=self.args.root,
@@ -59,13 +64,13 @@ class LearningLoss:
         model_backbone, optimizer_backbone, _ = create_model_optimizer_scheduler(self.args, dataset_cl)
 
         if self.init == 'pretrained':
-            model_backbone = load_pretrained(model_backbone)
+            model_backbone = load_pretrained(model_backbone, cache_path=self.args.pretrained_cache_path)
         elif self.init == 'autoencoder':
             model_backbone, optimizer_backbone, _ = create_model_optimizer_autoencoder(self.args, dataset_cl)
         elif self.init == 'simclr':
             model_backbone, optimizer_backbone, _, _ = create_model_optimizer_simclr(self.args, dataset_cl)
 
-        model_module = LossNet().cuda()
+        model_module = LossNet().to(get_device())
         optimizer_module = torch.optim.Adam(model_module.parameters())
 
         models = {'backbone': model_backbone, 'module': model_module}
@@ -86,10 +91,10 @@ class LearningLoss:
             labeled_dataset_fix, unlabeled_dataset_fix = dataset_cl.get_datasets_fixmatch(base_dataset,
                                                                                           labeled_indices,
                                                                                           unlabeled_indices)
-            train_loader_fix = DataLoader(dataset=labeled_dataset_fix, batch_size=self.args.batch_size,
-                                          shuffle=True, **self.kwargs)
-            unlabeled_loader_fix = DataLoader(dataset=unlabeled_dataset_fix, batch_size=self.args.batch_size,
-                                              shuffle=True, **self.kwargs)
+            train_loader_fix = create_train_loader(labeled_dataset_fix, self.args.batch_size, self.kwargs,
+                                                   seed=self.args.seed)
+            unlabeled_loader_fix = create_train_loader(unlabeled_dataset_fix, self.args.batch_size, self.kwargs,
+                                                       seed=self.args.seed)
 
         current_labeled = dataset_cl.start_labeled
         metrics_per_cycle = pd.DataFrame([])
@@ -100,7 +105,48 @@ class LearningLoss:
 
         self.args.start_epoch, current_pseudo_labeled = 0, 0
         best_recall, best_report, last_best_epochs = 0, None, 0
-        best_model = deepcopy(models['backbone'])
+        best_model = ModelSnapshot(models['backbone'])
+        self.inference_cache.track(best_model)
+        current_cycle = 0
+
+        run_state = load_run_state(self.args)
+        if run_state is not None:
+            labeled_indices, unlabeled_indices = run_state['labeled_indices'], run_state['unlabeled_indices']
+            train_loader, unlabeled_loader, val_loader = create_loaders(self.args, labeled_dataset, unlabeled_dataset,
+                                                                        test_dataset, labeled_indices,
+                                                                        unlabeled_indices, self.kwargs,
+                                                                        dataset_cl.unlabeled_subset_num,
+                                                                        shuffle_unlabeled=False)
+            if 'fixmatch_with_al' == self.semi_supervised:
+                labeled_dataset_fix, unlabeled_dataset_fix = dataset_cl.get_datasets_fixmatch(base_dataset,
+                                                                                              labeled_indices,
+                                                                                              unlabeled_indices)
+                labeled_dataset_fix.indices = run_state['labeled_fix_indices']
+                unlabeled_dataset_fix.indices = run_state['unlabeled_fix_indices']
+                train_loader_fix = create_train_loader(labeled_dataset_fix, self.args.batch_size, self.kwargs,
+                                                       seed=self.args.seed)
+                unlabeled_loader_fix = create_train_loader(unlabeled_dataset_fix, self.args.batch_size, self.kwargs,
+                                                           seed=self.args.seed)
+            models['backbone'].load_state_dict(run_state['state_dict'])
+            models['module'].load_state_dict(run_state['module_state_dict'])
+            optimizers['backbone'].load_state_dict(run_state['optimizer'])
+            optimizers['module'].load_state_dict(run_state['module_optimizer'])
+            best_model.load_state_dict(run_state['best_state_dict'])
+            self.args.start_epoch, current_cycle, current_labeled, current_pseudo_labeled = \
+                run_state['epoch'], run_state['cycle'], run_state['current_labeled'], \
+                run_state['current_pseudo_labeled']
+            best_recall, best_report, last_best_epochs = \
+                run_state['best_recall'], run_state['best_report'], run_state['last_best_epochs']
+            metrics_per_cycle, metrics_per_epoch, num_class_per_cycle = \
+                run_state['metrics_per_cycle'], run_state['metrics_per_epoch'], run_state['num_class_per_cycle']
+            set_rng_state(run_state['rng_state'])
+
+        models['backbone'] = apply_freeze_schedule(self.args, models['backbone'], self.init, current_cycle)
+
+        validation_scheduler = ValidationScheduler(self.args, test_dataset, self.kwargs)
+        stopping_policy = create_stopping_policy(self.args, self.args.start_epoch)
+        if run_state is not None:
+            stopping_policy.load_state_dict(run_state['stopping_policy'])
 
         for epoch in range(self.args.start_epoch, self.args.epochs):
             if 'fixmatch_with_al' == self.semi_supervised:
@@ -110,10 +156,8 @@ class LearningLoss:
             else:
                 train_loss = self.train(train_loader, models, optimizers, criterions, epoch, last_best_epochs)
 
-            val_loss, val_report = self.validate(val_loader, models, criterions, last_best_epochs)
-
             if 'pseudo_label_with_al' == self.semi_supervised:
-                samples_indices, samples_targets = self.get_pseudo_samples(best_model, unlabeled_loader,
+                samples_indices, samples_targets = self.get_pseudo_samples(best_model.materialize(), unlabeled_loader,
                                                                            number=int(self.args.pseudo_labeling_num / 500))
                 labeled_indices, unlabeled_indices = postprocess_indices(labeled_indices, unlabeled_indices,
                                                                          samples_indices)
@@ -129,13 +173,24 @@ class LearningLoss:
                 print('Epoch Classifier: [{0}]\t'
                       'Pseudo Labels Added: [{1}]'.format(epoch, len(samples_indices)))
 
-            is_best = val_report['macro avg']['recall'] > best_recall
-            last_best_epochs = 0 if is_best else last_best_epochs + 1
+            if validation_scheduler.should_validate(epoch):
+                val_loss, val_report = self.validate(validation_scheduler.get_loader(val_loader),
+                                                     models, criterions, last_best_epochs)
+                is_best = val_report['macro avg']['recall'] > best_recall
+                stopping_policy.update(epoch, val_report['macro avg']['recall'])
 
-            val_report = pd.concat([val_report, train_loss, val_loss], axis=1)
-            metrics_per_epoch = pd.concat([metrics_per_epoch, val_report])
+                val_report = pd.concat([val_report, train_loss, val_loss], axis=1)
+                metrics_per_epoch = pd.concat([metrics_per_epoch, val_report])
+            else:
+                is_best = False
+            last_best_epochs = 0 if is_best else last_best_epochs + 1
 
-            if epoch > self.args.labeled_warmup_epochs and last_best_epochs > self.args.add_labeled_epochs:
+            if stopping_policy.should_stop(epoch, last_best_epochs):
+                stopping_policy.close_cycle(epoch, last_best_epochs)
+                if validation_scheduler.full_at_cycle_end:
+                    val_loss, full_report = self.validate(val_loader, dict(models, backbone=best_model.materialize()),
+                                                          criterions, last_best_epochs)
+                    best_report = pd.concat([full_report, train_loss_columns(best_report), val_loss], axis=1)
                 metrics_per_cycle = pd.concat([metrics_per_cycle, best_report])
 
                 train_loader, unlabeled_loader, val_loader, labeled_indices, unlabeled_indices = \
@@ -147,10 +202,10 @@ class LearningLoss:
                     labeled_dataset_fix, unlabeled_dataset_fix = dataset_cl.get_datasets_fixmatch(base_dataset,
                                                                                                   labeled_indices,
                                                                                                   unlabeled_indices)
-                    train_loader_fix = DataLoader(dataset=labeled_dataset_fix, batch_size=self.args.batch_size,
-                                                  shuffle=True, **self.kwargs)
-                    unlabeled_loader_fix = DataLoader(dataset=unlabeled_dataset_fix, batch_size=self.args.batch_size,
-                                                      shuffle=True, **self.kwargs)
+                    train_loader_fix = create_train_loader(labeled_dataset_fix, self.args.batch_size, self.kwargs,
+                                                           seed=self.args.seed)
+                    unlabeled_loader_fix = create_train_loader(unlabeled_dataset_fix, self.args.batch_size, self.kwargs,
+                                                               seed=self.args.seed)
 
                 current_labeled += self.args.add_labeled
                 last_best_epochs = 0
@@ -160,7 +215,7 @@ class LearningLoss:
                         create_model_optimizer_scheduler(self.args, dataset_cl)
 
                     if self.init == 'pretrained':
-                        model_backbone = load_pretrained(model_backbone)
+                        model_backbone = load_pretrained(model_backbone, cache_path=self.args.pretrained_cache_path)
                     elif self.init == 'autoencoder':
                         model_backbone, optimizer_backbone, _ = create_model_optimizer_autoencoder(self.args,
                                                                                                    dataset_cl)
@@ -183,10 +238,36 @@ class LearningLoss:
                 criterion_unlabeled = get_loss(self.args, dataset_cl.labeled_class_samples, reduction='none')
                 criterions = {'backbone': criterion_backbone, 'module': loss_module_objective_func,
                               'unlabeled': criterion_unlabeled}
+                current_cycle += 1
+                models['backbone'] = apply_freeze_schedule(self.args, models['backbone'], self.init, current_cycle)
+
+                save_run_state(self.args, {
+                    'epoch': epoch + 1,
+                    'cycle': current_cycle,
+                    'current_labeled': current_labeled,
+                    'current_pseudo_labeled': current_pseudo_labeled,
+                    'labeled_indices': labeled_indices,
+                    'unlabeled_indices': unlabeled_indices,
+                    'labeled_fix_indices': train_loader_fix.dataset.indices if train_loader_fix is not None else None,
+                    'unlabeled_fix_indices':
+                        unlabeled_loader_fix.dataset.indices if unlabeled_loader_fix is not None else None,
+                    'state_dict': models['backbone'].state_dict(),
+                    'module_state_dict': models['module'].state_dict(),
+                    'optimizer': optimizers['backbone'].state_dict(),
+                    'module_optimizer': optimizers['module'].state_dict(),
+                    'best_state_dict': best_model.state_dict(),
+                    'best_recall': best_recall,
+                    'best_report': best_report,
+                    'last_best_epochs': last_best_epochs,
+                    'metrics_per_cycle': metrics_per_cycle,
+                    'metrics_per_epoch': metrics_per_epoch,
+                    'num_class_per_cycle': num_class_per_cycle,
+                    'stopping_policy': stopping_policy.state_dict(),
+                })
             else:
                 best_recall = val_report['macro avg']['recall'] if is_best else best_recall
                 best_report = val_report if is_best else best_report
-                best_model = deepcopy(models['backbone']) if is_best else best_model
+                best_model = best_model.update(models['backbone']) if is_best else best_model
 
             if (current_labeled > self.args.stop_labeled) or (current_pseudo_labeled > self.args.pseudo_labeling_num):
                 break
@@ -200,6 +281,8 @@ class LearningLoss:
         if self.args.store_logs:
             store_logs(self.args, metrics_per_cycle)
             store_logs(self.args, metrics_per_epoch, log_type='epoch_wise')
+            store_logs(self.args, validation_scheduler.get_policy(), log_type='validation_policy')
+            store_logs(self.args, stopping_policy.get_log(), log_type='stopping')
             store_logs(self.args, num_class_per_cycle, log_type='novel_class')
 
         return best_recall
@@ -216,8 +299,8 @@ class LearningLoss:
         end = time.time()
 
         for i, (data_x, data_y) in enumerate(train_loader):
-            data_y = data_y.cuda(non_blocking=True)
-            data_x = data_x.cuda(non_blocking=True)
+            data_y = data_y.to(get_device(), non_blocking=True)
+            data_x = data_x.to(get_device(), non_blocking=True)
 
             optimizers['backbone'].zero_grad()
             optimizers['module'].zero_grad()
@@ -235,6 +318,8 @@ class LearningLoss:
             loss = m_backbone_loss + self.args.learning_loss_weight * m_module_loss
 
             loss.backward()
+            synchronize_gradients(models['backbone'])
+            synchronize_gradients(models['module'])
             optimizers['backbone'].step()
             optimizers['module'].step()
 
@@ -269,12 +354,14 @@ class LearningLoss:
 
         end = time.time()
 
+        batches, forward = self.activation_cache.iterate(models['backbone'], val_loader)
+
         with torch.no_grad():
-            for i, (data_x, data_y) in enumerate(val_loader):
-                data_y = data_y.cuda(non_blocking=True)
-                data_x = data_x.cuda(non_blocking=True)
+            for i, (data_x, data_y) in enumerate(batches):
+                data_y = data_y.to(get_device(), non_blocking=True)
+                data_x = data_x.to(get_device(), non_blocking=True)
 
-                output = models['backbone'].forward_encoder_classifier(data_x)
+                output = forward(data_x)
                 loss = criterions['backbone'](output, data_y)
 
                 losses_per_class.update(loss.cpu().detach().numpy(), data_y.cpu().numpy())
@@ -298,6 +385,8 @@ class LearningLoss:
                           .format(i, len(val_loader), batch_time=batch_time, loss=losses, top1=top1,
                                   last_best_epoch=last_best_epochs))
 
+        metrics.synchronize()
+        losses_per_class.synchronize()
         report = metrics.get_report(target_names=val_loader.dataset.dataset.classes)
         print(' * Acc@1 {top1.avg:.3f}\t * Prec {0}\t * Recall {1} * Acc@5 {top5.avg:.3f}\t'
               .format(report['macro avg']['precision'], report['macro avg']['recall'], top1=top1, top5=top5))
@@ -319,21 +408,31 @@ class LearningLoss:
 
         for i, (data_labeled, data_unlabeled) in enumerate(train_loader):
             data_x, data_y = data_labeled
-            data_x, data_y = data_x.cuda(non_blocking=True), data_y.cuda(non_blocking=True)
+            data_x, data_y = data_x.to(get_device(), non_blocking=True), data_y.to(get_device(), non_blocking=True)
 
             (data_w, data_s), _ = data_unlabeled
-            data_w, data_s = data_w.cuda(non_blocking=True), data_s.cuda(non_blocking=True)
+            data_w, data_s = data_w.to(get_device(), non_blocking=True), data_s.to(get_device(), non_blocking=True)
 
             optimizers['backbone'].zero_grad()
             optimizers['module'].zero_grad()
 
-            inputs = torch.cat((data_x, data_w, data_s))
-            logits, features = models['backbone'].forward_features(inputs)
-            logits_labeled = logits[:self.args.batch_size]
-            logits_unlabeled_w, logits_unlabeled_s = logits[self.args.batch_size:].chunk(2)
-            del logits
+            logits_unlabeled_w = forward_no_grad(models['backbone'].forward_encoder_classifier, data_w,
+                                                 self.args.fixmatch_unlabeled_chunk)
+            pseudo_label = torch.softmax(logits_unlabeled_w, dim=-1)
+            max_probs, data_y_unlabeled = torch.max(pseudo_label, dim=-1)
+            mask = max_probs.ge(self.args.fixmatch_threshold).float()
+
+            if self.args.fixmatch_unlabeled_chunk > 0:
+                loss_unlabeled = backward_chunks(models['backbone'].forward_encoder_classifier,
+                                                 criterions['unlabeled'], data_s, data_y_unlabeled, mask,
+                                                 self.args.fixmatch_lambda_u, self.args.fixmatch_unlabeled_chunk)
+                logits_labeled, features = models['backbone'].forward_features(data_x)
+            else:
+                logits, features = models['backbone'].forward_features(torch.cat((data_x, data_s)))
+                logits_labeled, logits_unlabeled_s = logits.split([data_x.size(0), data_s.size(0)])
+                features = [feat[:data_x.size(0)] for feat in features]
+                loss_unlabeled = (criterions['unlabeled'](logits_unlabeled_s, data_y_unlabeled) * mask).mean()
 
-            features = [feat[:self.args.batch_size] for feat in features]
             target_loss = criterions['backbone'](logits_labeled, data_y)
 
             pred_loss = models['module'](features)
@@ -342,17 +441,14 @@ class LearningLoss:
             losses_per_class.update(target_loss.cpu().detach().numpy(), data_y.cpu().numpy())
             m_backbone_loss = torch.sum(target_loss) / target_loss.size(0)
 
-            pseudo_label = torch.softmax(logits_unlabeled_w.detach(), dim=-1)
-            max_probs, data_y_unlabeled = torch.max(pseudo_label, dim=-1)
-            mask = max_probs.ge(self.args.fixmatch_threshold).float()
-            loss_unlabeled = (criterions['unlabeled'](logits_unlabeled_s, data_y_unlabeled) * mask).mean()
-
             m_module_loss = criterions['module'](pred_loss, target_loss)
 
             loss = m_backbone_loss + \
                 self.args.learning_loss_weight * m_module_loss + self.args.fixmatch_lambda_u * loss_unlabeled
 
             loss.backward()
+            synchronize_gradients(models['backbone'])
+            synchronize_gradients(models['module'])
             optimizers['backbone'].step()
             optimizers['module'].step()
 
@@ -375,37 +471,18 @@ class LearningLoss:
                                        for i, k in enumerate(cl)}, orient='index').T
 
     def get_pseudo_samples(self, model, unlabeled_loader, number):
-        batch_time = AverageMeter()
-        samples = None
-        samples_targets = None
-
-        end = time.time()
-
         model.eval()
 
-        for i, (data_x, _) in enumerate(unlabeled_loader):
-            data_x = data_x.cuda(non_blocking=True)
+        logits, _ = self.inference_cache.predict(model, unlabeled_loader)
+        samples, samples_targets = torch.max(torch.softmax(logits, dim=1), dim=1)
 
-            with torch.no_grad():
-                output = model.forward_encoder_classifier(data_x)
-            score = F.softmax(output, dim=1)
-            score = torch.max(score, dim=1)
-
-            samples = score[0] if samples is None else torch.cat([samples, score[0]])
-            samples_targets = score[1] if samples_targets is None else torch.cat([samples_targets, score[1]])
-
-            batch_time.update(time.time() - end)
-            end = time.time()
-
-            if i % self.args.print_freq == 0:
-                pass
-
-        samples_targets = samples_targets[samples > self.args.pseudo_labeling_threshold]
-        samples = samples[samples > self.args.pseudo_labeling_threshold]
-
-        samples_indices = samples.argsort(descending=True)[:number]
+        positions = torch.nonzero(samples > self.args.pseudo_labeling_threshold, as_tuple=True)[0]
+        samples_indices = positions[samples[positions].argsort(descending=True)[:number]]
         samples_targets = samples_targets[samples_indices]
 
+        self.inference_cache.drop(unlabeled_loader.dataset,
+                                  np.array(unlabeled_loader.dataset.indices)[samples_indices.numpy()])
+
         model.train()
 
         return samples_indices, samples_targets
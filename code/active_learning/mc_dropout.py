@@ -1,7 +1,5 @@
-from utils import AverageMeter
-import time
+from utils import predict_logits, RankingStability
 import torch
-import numpy as np
 
 """
 Bayesian Active Learning by Disagreement (BALD) extension
@@ -24,51 +22,61 @@ class UncertaintySamplingMCDropout:
         return entropy
 
     def get_samples(self, epoch, args, model, _, unlabeled_loader, number):
-        batch_time = AverageMeter()
         all_score = None
         all_entropy = None
-        targets = None
-
-        end = time.time()
 
         model.train()
 
         for j in range(args.mc_dropout_iterations):
-            scores = None
-
-            for i, (data_x, data_y) in enumerate(unlabeled_loader):
-                data_x = data_x.cuda(non_blocking=True)
-                data_y = data_y.cuda(non_blocking=True)
-
-                with torch.no_grad():
-                    if args.weak_supervision_strategy == 'semi_supervised_active_learning':
-                        output = torch.softmax(model.forward_encoder_classifier(data_x), dim=1)
-                    else:
-                        output = torch.softmax(model(data_x), dim=1)
-
-                scores = output if scores is None else torch.cat([scores, output])
-                targets = data_y.cpu().numpy() if targets is None \
-                    else np.concatenate([targets, data_y.cpu().numpy().tolist()])
-
-                batch_time.update(time.time() - end)
-                end = time.time()
-
-                if i % args.print_freq == 0:
-                    print('{0}\t'
-                          'Epoch: [{1}][{2}/{3}]\t'
-                          'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
-                          .format(args.uncertainty_sampling_method, epoch, i, len(unlabeled_loader),
-                                  batch_time=batch_time))
+            logits = predict_logits(model, unlabeled_loader)
+            scores = torch.softmax(logits, dim=1)
             print('\n MC dropout sample: ', j+1)
 
             all_score = scores if all_score is None else all_score + scores
             all_entropy = self.entropy(scores) if all_entropy is None else all_entropy + self.entropy(scores)
 
-        avg_score = all_score / args.mc_dropout_iterations
+        scores = self.bald(all_score, all_entropy, args.mc_dropout_iterations)
+
+        return scores.argsort(descending=True)[:number]
+
+    def bald(self, all_score, all_entropy, iterations):
+        avg_score = all_score / iterations
         entropy_avg_score = self.entropy(avg_score)
 
-        average_entropy = all_entropy / args.mc_dropout_iterations
+        average_entropy = all_entropy / iterations
 
-        scores = entropy_avg_score - average_entropy
+        return entropy_avg_score - average_entropy
 
-        return scores.argsort(descending=True)[:number]
+
+class AdaptiveUncertaintySamplingMCDropout(UncertaintySamplingMCDropout):
+    """
+    BALD with a variable number of dropout passes: after every pass the BALD scores of the passes so far are ranked and
+    sampling stops once the selection is stable (see RankingStability), at the latest after --mc-dropout-iterations
+    passes. The passes used in every cycle are kept in self.log.
+    """
+
+    def __init__(self, verbose=True):
+        super(AdaptiveUncertaintySamplingMCDropout, self).__init__(verbose=verbose)
+        self.log = []
+
+    def get_samples(self, epoch, args, model, _, unlabeled_loader, number):
+        all_score = None
+        all_entropy = None
+        stability = RankingStability(args, number, descending=True)
+
+        model.train()
+
+        for j in range(args.mc_dropout_iterations):
+            logits = predict_logits(model, unlabeled_loader)
+            scores = torch.softmax(logits, dim=1)
+
+            all_score = scores if all_score is None else all_score + scores
+            all_entropy = self.entropy(scores) if all_entropy is None else all_entropy + self.entropy(scores)
+
+            if stability.update(self.bald(all_score, all_entropy, j + 1)):
+                break
+
+        print('\n MC dropout samples: ', stability.iterations)
+        self.log.append(dict(stability.get_log(epoch, args.mc_dropout_iterations), cycle=len(self.log)))
+
+        return stability.rank(self.bald(all_score, all_entropy, stability.iterations))[:number]
@@ -1,7 +1,6 @@
 import torch
 import torch.nn.functional as F
-from utils import AverageMeter
-import time
+from utils import get_inference_cache, ShardedScoringExecutor, get_device
 import numpy as np
 
 
@@ -14,6 +13,8 @@ class UncertaintySamplingOthers:
     def __init__(self, uncertainty_sampling_method, verbose=False):
         self.uncertainty_sampling_method = uncertainty_sampling_method
         self.method = getattr(self, self.uncertainty_sampling_method)
+        self.descending = uncertainty_sampling_method == 'entropy_based'
+        self.single_pass = uncertainty_sampling_method != 'learning_loss'
         self.verbose = verbose
 
     @staticmethod
@@ -47,69 +48,46 @@ class UncertaintySamplingOthers:
     def learning_loss(models, unlabeled_loader, args, epoch, uncertainty_sampling_method):
         models['backbone'].eval()
         models['module'].eval()
-        uncertainty = torch.tensor([]).cuda()
+        uncertainty = []
         targets = None
 
         with torch.no_grad():
             for i, (data_x, data_y) in enumerate(unlabeled_loader):
-                data_x = data_x.cuda(non_blocking=True)
-                data_y = data_y.cuda(non_blocking=True)
+                data_x = data_x.to(get_device(), non_blocking=True)
+                data_y = data_y.to(get_device(), non_blocking=True)
 
-                output, features = models['backbone'].forward_features(data_x)
+                _, features = models['backbone'].forward_features(data_x)
                 pred_loss = models['module'](features)
                 pred_loss = pred_loss.view(pred_loss.size(0))
 
                 targets = data_y.cpu().numpy() if targets is None \
                     else np.concatenate([targets, data_y.cpu().numpy().tolist()])
 
-                uncertainty = torch.cat((uncertainty, pred_loss), 0)
+                uncertainty.append(pred_loss)
 
                 if i % args.print_freq == 0:
                     print('{0}\t'
                           'Epoch: [{1}][{2}/{3}]\t'
                           .format(uncertainty_sampling_method, epoch, i, len(unlabeled_loader)))
 
-        return uncertainty
+        return torch.cat(uncertainty)
 
     def get_samples(self, epoch, args, model, _, unlabeled_loader, number):
-        batch_time = AverageMeter()
-        samples = None
-        targets = None
-
-        end = time.time()
-
         if args.uncertainty_sampling_method == 'learning_loss' or \
                 args.semi_supervised_uncertainty_method == 'learning_loss':
             scores = self.learning_loss(model, unlabeled_loader, args, epoch, self.uncertainty_sampling_method)
             return scores.argsort(descending=True)[:number]
 
-        model.eval()
-
-        for i, (data_x, data_y) in enumerate(unlabeled_loader):
-            data_x = data_x.cuda(non_blocking=True)
-            targets = data_y.cpu().numpy() if targets is None \
-                else np.concatenate([targets, data_y.cpu().numpy().tolist()])
-
-            with torch.no_grad():
-                if args.weak_supervision_strategy == 'semi_supervised_active_learning':
-                    output = model.forward_encoder_classifier(data_x)
-                else:
-                    output = model(data_x)
+        if args.scoring_workers > 0:
+            return ShardedScoringExecutor(args.scoring_workers, args.scoring_threads).top_k(
+                model, unlabeled_loader, self.method, number, descending=self.descending)
 
-            score = self.method(F.softmax(output, dim=1))
-
-            samples = score if samples is None else torch.cat([samples, score])
+        model.eval()
 
-            batch_time.update(time.time() - end)
-            end = time.time()
+        logits, _ = get_inference_cache(args).predict(model, unlabeled_loader)
+        samples = self.method(F.softmax(logits, dim=1))
 
-            if i % args.print_freq == 0:
-                print('{0}\t'
-                      'Epoch: [{1}][{2}/{3}]\t'
-                      'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
-                      .format(self.uncertainty_sampling_method, epoch, i, len(unlabeled_loader), batch_time=batch_time))
+        return self.rank(samples)[:number]
 
-        if self.uncertainty_sampling_method == 'entropy_based':
-            return samples.argsort(descending=True)[:number]
-        else:
-            return samples.argsort()[:number]
+    def rank(self, samples):
+        return samples.argsort(descending=self.descending)
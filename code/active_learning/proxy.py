@@ -0,0 +1,139 @@
+import time
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from utils import create_proxy_model_optimizer, create_subset_loader, forward_logits_embeddings, get_device, \
+    synchronize_gradients
+
+"""
+Selection via proxy
+
+Implementation of:
+Selection via Proxy: Efficient Data Selection for Deep Learning:
+https://arxiv.org/abs/1906.11829
+"""
+
+
+class UncertaintySamplingProxy:
+    """
+    Ranks the unlabeled subset with a small proxy model trained on the current labeled set and lets the main model
+    score only the top --proxy-shortlist * add_labeled candidates of that ranking, using the criterion of the wrapped
+    UncertaintySamplingOthers sampler. The proxy is trained alongside the main model, one epoch on the labeled set after
+    every epoch of the main model (observe), and carries its weights over to the next cycle; it is only trained from
+    scratch for --proxy-epochs at acquisition when it was never observed. Proxy training time is logged per cycle
+    apart from the acquisition time, which only covers scoring; with --proxy-compare the main model also scores the
+    whole subset, so the overlap with the full selection can be compared against the time saved.
+    """
+
+    def __init__(self, sampler, dataset_class, args, verbose=True):
+        self.sampler = sampler
+        self.dataset_class = dataset_class
+        self.args = args
+        self.verbose = verbose
+        self.proxy, self.optimizer = None, None
+        self.train_time, self.train_epochs = 0, 0
+        self.log = []
+
+    @staticmethod
+    def synchronize():
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    @staticmethod
+    def train_epoch(proxy, optimizer, train_loader):
+        criterion = nn.CrossEntropyLoss()
+        proxy.train()
+
+        for data_x, data_y in train_loader:
+            data_x = data_x.to(get_device(), non_blocking=True)
+            data_y = data_y.to(get_device(), non_blocking=True)
+
+            output, _ = forward_logits_embeddings(proxy, data_x)
+            loss = criterion(output, data_y)
+
+            optimizer.zero_grad()
+            loss.backward()
+            synchronize_gradients(proxy)
+            optimizer.step()
+
+    def observe(self, _, train_loader):
+        self.synchronize()
+        start = time.time()
+
+        if self.proxy is None:
+            self.proxy, self.optimizer = create_proxy_model_optimizer(self.args, self.dataset_class)
+        self.train_epoch(self.proxy, self.optimizer, train_loader)
+
+        self.synchronize()
+        self.train_time += time.time() - start
+        self.train_epochs += 1
+
+    def train_proxy(self, args, train_loader):
+        for epoch in range(args.proxy_epochs):
+            self.observe(None, train_loader)
+
+    def score(self, model, loader):
+        model.eval()
+        samples = None
+
+        with torch.no_grad():
+            for data_x, _ in loader:
+                output, _ = forward_logits_embeddings(model, data_x.to(get_device(), non_blocking=True))
+                score = self.sampler.method(F.softmax(output, dim=1)).cpu()
+                samples = score if samples is None else torch.cat([samples, score])
+
+        return samples
+
+    def timed(self, function, *inputs):
+        self.synchronize()
+        start = time.time()
+        output = function(*inputs)
+        self.synchronize()
+
+        return output, time.time() - start
+
+    @staticmethod
+    def overlap(samples_indices, reference_indices):
+        return len(set(samples_indices.tolist()) & set(reference_indices.tolist())) / max(1, len(reference_indices))
+
+    def get_samples(self, epoch, args, model, train_loader, unlabeled_loader, number):
+        if self.proxy is None:
+            self.train_proxy(args, train_loader)
+        proxy_train_time, proxy_train_epochs = self.train_time, self.train_epochs
+        self.train_time, self.train_epochs = 0, 0
+
+        proxy_scores, proxy_score_time = self.timed(self.score, self.proxy, unlabeled_loader)
+        proxy_ranking = self.sampler.rank(proxy_scores)
+
+        shortlist = proxy_ranking[:max(number, args.proxy_shortlist * number)]
+        if args.proxy_shortlist > 0:
+            shortlist_scores, main_score_time = self.timed(self.score, model,
+                                                           create_subset_loader(unlabeled_loader, shortlist.numpy()))
+            samples_indices = shortlist[self.sampler.rank(shortlist_scores)[:number]]
+        else:
+            main_score_time = 0
+            samples_indices = proxy_ranking[:number]
+
+        log = {'cycle': len(self.log), 'epoch': epoch, 'proxy_arch': args.proxy_arch, 'pool_size':
+               len(unlabeled_loader.dataset), 'shortlist_size': len(shortlist), 'proxy_train_time': proxy_train_time,
+               'proxy_train_epochs': proxy_train_epochs, 'proxy_score_time': proxy_score_time,
+               'main_score_time': main_score_time, 'acquisition_time': proxy_score_time + main_score_time,
+               'proxy_overlap': self.overlap(samples_indices, proxy_ranking[:number])}
+
+        if args.proxy_compare:
+            full_scores, full_score_time = self.timed(self.score, model, unlabeled_loader)
+            full_indices = self.sampler.rank(full_scores)[:number]
+            log.update({'full_score_time': full_score_time,
+                        'full_overlap': self.overlap(samples_indices, full_indices),
+                        'proxy_full_overlap': self.overlap(proxy_ranking[:number], full_indices)})
+
+        self.log.append(log)
+
+        if self.verbose:
+            print('Proxy Sampling\t'
+                  'Shortlist: [{0}/{1}]\t'
+                  'Proxy Train Time {2:.3f}\t'
+                  'Acquisition Time {3:.3f}'.format(len(shortlist), len(unlabeled_loader.dataset),
+                                                    log['proxy_train_time'], log['acquisition_time']))
+
+        return samples_indices
@@ -0,0 +1,118 @@
+import time
+from copy import deepcopy
+
+import torch
+from utils import ModelSnapshot, get_device
+
+try:
+    from torch.func import functional_call, vmap
+except ImportError:
+    functional_call, vmap = None, None
+
+"""
+Snapshot ensemble uncertainty sampling
+
+Uses weight snapshots taken along the training trajectory of a cycle as ensemble members, following:
+Snapshot Ensembles: Train 1, get M for free:
+https://arxiv.org/abs/1704.00109
+"""
+
+
+class UncertaintySamplingSnapshotEnsemble:
+    """
+    Keeps the last --snapshot-ensemble-size weight snapshots of the cycle, taken every --snapshot-every epochs, in a
+    ring buffer of float16 CPU ModelSnapshots. At acquisition all members score a batch in one functional forward
+    with weights stacked along a leading member dimension (torch.func.vmap), falling back to one pass per member when
+    torch.func is not available. Samples are ranked by the entropy of the mean prediction or by BALD, which falls back
+    to the entropy when the cycle left a single member (BALD is 0 for every sample then).
+    """
+
+    def __init__(self, args, verbose=True):
+        self.size = args.snapshot_ensemble_size
+        self.every = args.snapshot_every
+        self.criterion = args.snapshot_criterion
+        self.verbose = verbose
+        self.snapshots = []
+        self.position, self.count, self.cycle_epochs = 0, 0, 0
+        self.log = []
+
+    def observe(self, model, _):
+        self.cycle_epochs += 1
+        if self.cycle_epochs % self.every == 0:
+            self.add(model)
+
+    def add(self, model):
+        if self.position < len(self.snapshots):
+            self.snapshots[self.position].update(model)
+        else:
+            self.snapshots.append(ModelSnapshot(model, dtype=torch.float16))
+        self.position = (self.position + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def reset(self):
+        self.position, self.count, self.cycle_epochs = 0, 0, 0
+
+    @staticmethod
+    def stack(members, device):
+        states = [member.state_dict() for member in members]
+        stacked = {}
+        for k, v in states[0].items():
+            stacked[k] = torch.stack([state[k] for state in states]).to(device, non_blocking=True)
+            stacked[k] = stacked[k].float() if v.is_floating_point() else stacked[k]
+        return stacked
+
+    @staticmethod
+    def entropy(probs):
+        return torch.sum(-probs * torch.log(probs.clamp(min=1e-12)), dim=-1)
+
+    def forward_stacked(self, model, stacked, data_x):
+        return vmap(lambda state: functional_call(model, state, (data_x,)))(stacked)
+
+    @staticmethod
+    def forward_sequential(model, members, module, data_x):
+        outputs = []
+        for member in members:
+            outputs.append(member.restore(module)(data_x))
+        return torch.stack(outputs)
+
+    def get_samples(self, epoch, args, model, _, unlabeled_loader, number):
+        if self.count < 2:
+            self.add(model)
+        members = self.snapshots[:self.count]
+        criterion = self.criterion if len(members) > 1 else 'entropy'
+        if criterion != self.criterion:
+            print('Snapshot Ensemble Sampling: a single member scores 0 BALD everywhere, ranking by entropy instead')
+        device = next(model.parameters()).device
+
+        start = time.time()
+        model.eval()
+        stacked = self.stack(members, device) if vmap is not None else None
+        module = deepcopy(model).eval() if stacked is None else None
+        scores = None
+
+        with torch.no_grad():
+            for data_x, _ in unlabeled_loader:
+                data_x = data_x.to(get_device(), non_blocking=True)
+                if stacked is not None:
+                    logits = self.forward_stacked(model, stacked, data_x)
+                else:
+                    logits = self.forward_sequential(model, members, module, data_x)
+
+                probs = torch.softmax(logits, dim=-1)
+                score = self.entropy(probs.mean(dim=0))
+                if criterion == 'bald':
+                    score = score - self.entropy(probs).mean(dim=0)
+
+                scores = score if scores is None else torch.cat([scores, score])
+
+        self.log.append({'cycle': len(self.log), 'epoch': epoch, 'criterion': criterion, 'members': len(members),
+                         'stacked_forward': stacked is not None, 'score_time': time.time() - start})
+
+        if self.verbose:
+            print('Snapshot Ensemble Sampling\t'
+                  'Members: [{0}]\t'
+                  'Time {1:.3f}'.format(len(members), self.log[-1]['score_time']))
+
+        self.reset()
+
+        return scores.argsort(descending=True)[:number]
@@ -0,0 +1,123 @@
+import numpy as np
+import torch
+from utils import all_gather_rows, is_distributed
+
+"""
+Training dynamics based sampling
+
+Selects samples from statistics of the predictions made during training instead of extra inference passes, following:
+Dataset Cartography: Mapping and Diagnosing Datasets with Training Dynamics:
+https://arxiv.org/abs/2009.10795
+"""
+
+
+class TrainingDynamicsStore:
+    """
+    Per-sample statistics of the weak-view predictions on the unlabeled batches, kept in tensors indexed by the
+    base-dataset index on the device of the predictions: number of observations, sums of the confidence (max
+    probability) and of its square, the last predicted class and the number of times the prediction changed. Under
+    --distributed every rank records the unlabeled batches of all ranks, so the statistics of the sharded loaders are
+    complete on the rank that selects, and a prediction change is counted when consecutive observations of a sample
+    were made by different ranks.
+    """
+
+    def __init__(self):
+        self.size = 0
+        self.count, self.confidence, self.confidence_sq, self.predictions, self.flips = None, None, None, None, None
+
+    def reset(self, size=None):
+        self.size = size if size is not None else self.size
+        self.count, self.confidence, self.confidence_sq, self.predictions, self.flips = None, None, None, None, None
+
+    def tensors(self):
+        return {'count': self.count, 'confidence': self.confidence, 'confidence_sq': self.confidence_sq,
+                'predictions': self.predictions, 'flips': self.flips}
+
+    def state_dict(self):
+        return dict({k: v.cpu() if v is not None else None for k, v in self.tensors().items()}, size=self.size)
+
+    def load_state_dict(self, state_dict):
+        self.size = state_dict['size']
+        for k in self.tensors():
+            setattr(self, k, state_dict[k])
+
+    def allocate(self, device):
+        self.count = torch.zeros(self.size, device=device)
+        self.confidence = torch.zeros(self.size, device=device)
+        self.confidence_sq = torch.zeros(self.size, device=device)
+        self.predictions = torch.full((self.size,), -1, dtype=torch.long, device=device)
+        self.flips = torch.zeros(self.size, device=device)
+
+    @torch.no_grad()
+    def update(self, indices, probs):
+        if self.count is None:
+            self.allocate(probs.device)
+        elif self.count.device != probs.device:
+            for k, v in self.tensors().items():
+                setattr(self, k, v.to(probs.device))
+
+        indices = indices.to(probs.device, non_blocking=True).long()
+        confidence, predictions = torch.max(probs.detach().float(), dim=1)
+        if is_distributed():
+            rows = all_gather_rows(torch.stack([indices.double(), confidence.double(), predictions.double()], dim=1))
+            indices, confidence, predictions = rows[:, 0].long(), rows[:, 1].float(), rows[:, 2].long()
+
+        previous = self.predictions[indices]
+
+        self.count.index_add_(0, indices, torch.ones_like(confidence))
+        self.confidence.index_add_(0, indices, confidence)
+        self.confidence_sq.index_add_(0, indices, confidence ** 2)
+        self.flips.index_add_(0, indices, ((previous >= 0) & (previous != predictions)).float())
+        self.predictions[indices] = predictions
+
+    def statistics(self, indices):
+        if self.count is None:
+            self.allocate('cpu')
+
+        indices = torch.from_numpy(np.array(indices)).long().to(self.count.device)
+        count = self.count[indices]
+        seen = count > 0
+        mean = torch.where(seen, self.confidence[indices] / count.clamp(min=1), torch.ones_like(count))
+        variability = torch.sqrt((self.confidence_sq[indices] / count.clamp(min=1) - mean ** 2).clamp(min=0))
+
+        return {'count': count.cpu(), 'confidence': mean.cpu(), 'variability': (variability * seen).cpu(),
+                'flips': self.flips[indices].cpu()}
+
+
+class UncertaintySamplingTrainingDynamics:
+    """
+    Ranks the unlabeled subset by the statistics gathered in a TrainingDynamicsStore during the cycle: lowest mean
+    confidence, highest confidence variability or most prediction flips. Samples not seen during the cycle rank last.
+    The statistics are reset after every selection.
+    """
+
+    def __init__(self, store, criterion='low_confidence', verbose=True):
+        self.store = store
+        self.criterion = criterion
+        self.verbose = verbose
+        self.log = []
+
+    def get_samples(self, epoch, args, model, _, unlabeled_loader, number):
+        statistics = self.store.statistics(unlabeled_loader.dataset.indices)
+
+        if self.criterion == 'low_confidence':
+            samples_indices = statistics['confidence'].argsort()[:number]
+        else:
+            samples_indices = statistics[self.criterion].argsort(descending=True)[:number]
+
+        self.log.append({'cycle': len(self.log), 'epoch': epoch, 'criterion': self.criterion,
+                         'pool_size': len(unlabeled_loader.dataset),
+                         'coverage': (statistics['count'] > 0).float().mean().item(),
+                         'mean_observations': statistics['count'].mean().item(),
+                         'selected_confidence': statistics['confidence'][samples_indices].mean().item(),
+                         'selected_variability': statistics['variability'][samples_indices].mean().item(),
+                         'selected_flips': statistics['flips'][samples_indices].mean().item()})
+
+        if self.verbose:
+            print('Training Dynamics Sampling\t'
+                  'Coverage {0:.3f}\t'
+                  'Mean Observations {1:.1f}'.format(self.log[-1]['coverage'], self.log[-1]['mean_observations']))
+
+        self.store.reset()
+
+        return samples_indices
@@ -6,9 +6,10 @@ import torchvision
 
 
 class WeaklySupervisedDataset(Dataset):
-    def __init__(self, dataset, indices, mean, std, transform=None, poisson=False, seed=9999):
+    def __init__(self, dataset, indices, mean, std, transform=None, poisson=False, seed=9999, return_indices=False):
         self.transform = transform
         self.indices = indices
+        self.return_indices = return_indices
         self.dataset = dataset
         self.targets = np.array(dataset.targets)
         self.poisson = poisson
@@ -37,10 +38,14 @@ class WeaklySupervisedDataset(Dataset):
             img_normalized_1 = self.normalize(img_noisy_1).float()
             img_normalized_2 = self.normalize(img_noisy_2).float()
 
+            if self.return_indices:
+                return (img_normalized_1, img_normalized_2), target, self.indices[index]
             return (img_normalized_1, img_normalized_2), target
         else:
             img_noisy = random_noise(img_transformed, mode='poisson', seed=self.seed)
             img_noisy = torch.from_numpy(img_noisy) if self.poisson else img_transformed
             img_normalized = self.normalize(img_noisy).float()
 
+            if self.return_indices:
+                return img_normalized, target, self.indices[index]
             return img_normalized, target
@@ -0,0 +1,96 @@
+import argparse
+import os
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+from torch.utils.data import DataLoader, Dataset
+
+from active_learning.others import UncertaintySamplingOthers
+from utils import distributed_top_k, ShardedScoringExecutor
+
+"""
+Smoke check of the --distributed pool scoring
+
+Spawns --world-size CPU processes joined in a gloo process group, scores a synthetic unlabeled subset with
+distributed_top_k and asserts that rank 0 selects the same positions as the single-process ShardedScoringExecutor.
+The subset holds duplicated samples so the tie-breaking of the merge is exercised as well.
+
+python distributed_check.py --world-size 2
+"""
+
+
+class SyntheticSubset(Dataset):
+    def __init__(self, data, indices):
+        self.data = data
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, item):
+        return self.data[self.indices[item]], 0
+
+
+def create_model_loader(args):
+    torch.manual_seed(args.seed)
+    model = nn.Sequential(nn.Linear(args.features, 32), nn.ReLU(), nn.Dropout(0.5), nn.Linear(32, args.classes))
+
+    data = torch.randn(args.pool_size, args.features)
+    data[1::7] = data[0]
+    loader = DataLoader(dataset=SyntheticSubset(data, np.arange(args.pool_size)), batch_size=args.batch_size,
+                        shuffle=False)
+
+    return model, loader
+
+
+def run(rank, args, expected):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(args.port)
+    dist.init_process_group(backend='gloo', rank=rank, world_size=args.world_size)
+
+    model, loader = create_model_loader(args)
+    if rank != 0:
+        # the other ranks start from different weights, distributed_top_k has to score with the weights of rank 0
+        for p in model.parameters():
+            nn.init.normal_(p)
+
+    sampler = UncertaintySamplingOthers(uncertainty_sampling_method=args.criterion)
+    positions = distributed_top_k(model, loader, sampler.method, args.number, descending=sampler.descending)
+
+    if rank == 0:
+        assert torch.equal(positions, expected), f'distributed selection {positions.tolist()} differs from the ' \
+                                                 f'single-process selection {expected.tolist()}'
+    else:
+        assert positions is None
+
+    dist.barrier()
+    dist.destroy_process_group()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Smoke check of the distributed pool scoring')
+    parser.add_argument('--world-size', default=2, type=int)
+    parser.add_argument('--pool-size', default=1003, type=int)
+    parser.add_argument('--batch-size', default=64, type=int)
+    parser.add_argument('--number', default=50, type=int)
+    parser.add_argument('--features', default=16, type=int)
+    parser.add_argument('--classes', default=5, type=int)
+    parser.add_argument('--criterion', default='entropy_based', type=str,
+                        choices=['least_confidence', 'margin_confidence', 'ratio_confidence', 'entropy_based'])
+    parser.add_argument('--port', default=29512, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+
+    model, loader = create_model_loader(args)
+    sampler = UncertaintySamplingOthers(uncertainty_sampling_method=args.criterion)
+    expected = ShardedScoringExecutor(1).top_k(model, loader, sampler.method, args.number,
+                                               descending=sampler.descending)
+
+    torch.multiprocessing.spawn(run, args=(args, expected), nprocs=args.world_size)
+    print(f'Distributed selection of {args.world_size} ranks matches the single-process selection')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+from copy import deepcopy
+
+import torch
+import torch.nn as nn
+
+try:
+    from torch.func import functional_call, stack_module_state, vmap
+except ImportError:
+    functional_call, stack_module_state, vmap = None, None, None
+
+"""
+Deep ensemble trained in one model: the parameters of M independently initialized members are stacked along a
+leading member dimension and all members run in one vectorized forward (torch.func.vmap over functional_call), so
+they share data loading and kernel launches.
+
+Ensembles as in: Simple and Scalable Predictive Uncertainty Estimation using Deep Ensembles:
+https://arxiv.org/abs/1612.01474
+"""
+
+
+class StackedEnsemble(nn.Module):
+    def __init__(self, members):
+        super(StackedEnsemble, self).__init__()
+        self.size = len(members)
+        self.stacked = vmap is not None
+
+        if self.stacked:
+            params, buffers = stack_module_state(members)
+            self.param_names = {k: k.replace('.', '__') for k in params}
+            self.buffer_names = {k: k.replace('.', '__') for k in buffers}
+            for k, v in params.items():
+                self.register_parameter(self.param_names[k], nn.Parameter(v.detach().clone()))
+            for k, v in buffers.items():
+                self.register_buffer(self.buffer_names[k], v.clone())
+            # the template module only provides the forward code, its weights are never used
+            self.template = [deepcopy(members[0]).to('meta')]
+        else:
+            self.members = nn.ModuleList(members)
+
+    def train(self, mode=True):
+        super(StackedEnsemble, self).train(mode)
+        if self.stacked:
+            self.template[0].train(mode)
+        return self
+
+    def member_state(self):
+        params = {k: getattr(self, name) for k, name in self.param_names.items()}
+        buffers = {k: getattr(self, name) for k, name in self.buffer_names.items()}
+        return params, buffers
+
+    def forward_member(self, params, buffers, x):
+        output = functional_call(self.template[0], (params, buffers), (x,))
+        return output[0] if type(output) is tuple else output
+
+    def forward_members(self, x):
+        if self.stacked:
+            params, buffers = self.member_state()
+            return vmap(self.forward_member, in_dims=(0, 0, None), randomness='different')(params, buffers, x)
+
+        outputs = [member(x) for member in self.members]
+        return torch.stack([output[0] if type(output) is tuple else output for output in outputs])
+
+    @staticmethod
+    def combine(outputs):
+        return torch.log(torch.softmax(outputs, dim=-1).mean(dim=0).clamp(min=1e-12))
+
+    def forward(self, x):
+        return self.combine(self.forward_members(x))
+
+    def member_keys(self):
+        """
+        Maps every key of the state dict to the key of the same tensor in a single member, so single-model states
+        (e.g. pretrained weights) can be copied into all members at once by broadcasting over the member dimension.
+        """
+        if self.stacked:
+            return {name: k for k, name in dict(self.param_names, **self.buffer_names).items()}
+        return {k: k.split('.', 2)[2] for k in self.state_dict()}
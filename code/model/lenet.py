@@ -12,7 +12,7 @@ Courtesy to: https://github.com/aliechoes/pytorch-multichannel-image-classificat
 class LeNet(nn.Module):
     def __init__(self, num_channels, num_classes, droprate=0.5, input_size=32):
         super(LeNet, self).__init__()
-        self.feat_size = {32: 7, 64: 15}
+        self.feat_size = ((input_size - 2) // 2) // 2
         self.features = nn.Sequential(
             nn.Conv2d(num_channels, 6, 3),
             nn.ReLU(),
@@ -24,7 +24,7 @@ class LeNet(nn.Module):
         )
 
         self.classifier = nn.Sequential(
-            nn.Linear(16*self.feat_size[input_size]*self.feat_size[input_size], 120),
+            nn.Linear(16*self.feat_size*self.feat_size, 120),
             nn.ReLU(),
             nn.Dropout(p=droprate, inplace=True),
             nn.Linear(120, 84),
@@ -37,3 +37,9 @@ class LeNet(nn.Module):
         feat = self.features(x)
         x = self.classifier(feat)
         return x, feat
+
+    def forward_encoder(self, x):
+        return self.features(x)
+
+    def forward_classifier(self, x):
+        return self.classifier(x)
@@ -9,19 +9,18 @@ Code adapted from: https://github.com/Mephisto405/Learning-Loss-for-Active-Learn
 
 
 class LossNet(nn.Module):
-    def __init__(self, feature_sizes=None, num_channels=None, interm_dim=128):
+    """
+    Takes the per-stage features of the backbone as globally pooled batch x channels vectors (see
+    ResNet.forward_features), so it does not depend on the input size. Feature maps are still accepted and pooled
+    adaptively.
+    """
+
+    def __init__(self, num_channels=None, interm_dim=128):
         super(LossNet, self).__init__()
 
-        if feature_sizes is None:
-            feature_sizes = [32, 16, 8, 4]
         if num_channels is None:
             num_channels = [64, 128, 256, 512]
 
-        self.GAP1 = nn.AvgPool2d(feature_sizes[0])
-        self.GAP2 = nn.AvgPool2d(feature_sizes[1])
-        self.GAP3 = nn.AvgPool2d(feature_sizes[2])
-        self.GAP4 = nn.AvgPool2d(feature_sizes[3])
-
         self.FC1 = nn.Linear(num_channels[0], interm_dim)
         self.FC2 = nn.Linear(num_channels[1], interm_dim)
         self.FC3 = nn.Linear(num_channels[2], interm_dim)
@@ -29,22 +28,15 @@ class LossNet(nn.Module):
 
         self.linear = nn.Linear(4 * interm_dim, 1)
 
-    def forward(self, features):
-        out1 = self.GAP1(features[0])
-        out1 = out1.view(out1.size(0), -1)
-        out1 = F.relu(self.FC1(out1))
-
-        out2 = self.GAP2(features[1])
-        out2 = out2.view(out2.size(0), -1)
-        out2 = F.relu(self.FC2(out2))
-
-        out3 = self.GAP3(features[2])
-        out3 = out3.view(out3.size(0), -1)
-        out3 = F.relu(self.FC3(out3))
+    @staticmethod
+    def pool(feature):
+        return feature if feature.dim() == 2 else F.adaptive_avg_pool2d(feature, 1).flatten(1)
 
-        out4 = self.GAP4(features[3])
-        out4 = out4.view(out4.size(0), -1)
-        out4 = F.relu(self.FC4(out4))
+    def forward(self, features):
+        out1 = F.relu(self.FC1(self.pool(features[0])))
+        out2 = F.relu(self.FC2(self.pool(features[1])))
+        out3 = F.relu(self.FC3(self.pool(features[2])))
+        out4 = F.relu(self.FC4(self.pool(features[3])))
 
         out = self.linear(torch.cat((out1, out2, out3, out4), 1))
         return out
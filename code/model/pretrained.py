@@ -0,0 +1,52 @@
+import os
+from collections import OrderedDict
+
+import torch
+import torchvision.models as models
+
+_pretrained_states = {}
+
+
+def default_cache_path():
+    return os.path.join(os.path.expanduser('~'), '.cache', 'med_active_learning')
+
+
+def get_pretrained_state(cache_path=None):
+    """
+    Returns the ImageNet resnet18 state dict with its keys already renamed to this repo's resnet ('downsample' ->
+    'shortcut'). The dict is built once per process and stored under cache_path, so later runs and offline hosts read it
+    from disk instead of instantiating torchvision's resnet18.
+    """
+    if 'resnet18' in _pretrained_states:
+        return _pretrained_states['resnet18']
+
+    cache_path = cache_path or default_cache_path()
+    filename = os.path.join(cache_path, 'resnet18_imagenet.pth')
+
+    if os.path.isfile(filename):
+        state = torch.load(filename, map_location='cpu')
+    else:
+        pretrained_dict = models.resnet18(pretrained=True).state_dict()
+        state = OrderedDict((key.replace('downsample', 'shortcut'), value) for key, value in pretrained_dict.items())
+
+        os.makedirs(cache_path, exist_ok=True)
+        tmp_filename = f'{filename}.{os.getpid()}.tmp'
+        torch.save(state, tmp_filename)
+        os.replace(tmp_filename, filename)
+
+    _pretrained_states['resnet18'] = state
+    return state
+
+
+def load_pretrained(model, cache_path=None):
+    pretrained_state = get_pretrained_state(cache_path)
+    model_dict = model.state_dict()
+    keys = model.member_keys() if hasattr(model, 'member_keys') else {key: key for key in model_dict}
+
+    with torch.no_grad():
+        for key, member_key in keys.items():
+            if 'linear' in member_key or 'conv1.weight' == member_key:
+                continue
+            model_dict[key].copy_(pretrained_state[member_key])
+
+    return model
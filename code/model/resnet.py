@@ -1,3 +1,4 @@
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import math
@@ -77,6 +78,7 @@ class ResNet(nn.Module):
     def __init__(self, block, num_blocks, num_classes=10, input_size=32, drop_rate=0):
         super(ResNet, self).__init__()
         self.in_planes = 64
+        self.frozen_stage = 0
 
         self.conv1 = nn.Conv2d(3, 64, kernel_size=3,
                                stride=int(math.log2(input_size) - 4), padding=1, bias=False)
@@ -101,32 +103,83 @@ class ResNet(nn.Module):
             self.in_planes = planes * block.expansion
         return nn.Sequential(*layers)
 
-    def forward(self, x):
-        out = F.relu(self.bn1(self.conv1(x)))
-        out = self.layer1(out)
-        out = self.layer2(out)
-        out = self.layer3(out)
-        out = self.layer4(out)
+    def stage_modules(self):
+        return [nn.ModuleList([self.conv1, self.bn1]), self.layer1, self.layer2, self.layer3, self.layer4]
+
+    def freeze(self, stage):
+        """
+        Freezes the first `stage` stages (1: conv1, 2: up to layer1, ..., 5: up to layer4). Frozen stages run without
+        autograd graph and keep their BatchNorm layers in eval mode.
+        """
+        self.frozen_stage = stage
+        for i, module in enumerate(self.stage_modules()):
+            for param in module.parameters():
+                param.requires_grad = i >= stage
+        self.train(self.training)
+        return self
+
+    def prefix_modules(self):
+        return self.stage_modules()[:self.frozen_stage]
+
+    def train(self, mode=True):
+        super(ResNet, self).train(mode)
+        for module in self.prefix_modules():
+            module.eval()
+        return self
+
+    def run_stage(self, stage, out):
+        if stage == 0:
+            return F.relu(self.bn1(self.conv1(out)))
+        return self.stage_modules()[stage](out)
+
+    def forward_prefix(self, x):
+        with torch.no_grad():
+            for stage in range(self.frozen_stage):
+                x = self.run_stage(stage, x)
+        return x
+
+    def encode_suffix(self, out):
+        for stage in range(self.frozen_stage, 5):
+            out = self.run_stage(stage, out)
         out = F.avg_pool2d(out, 4)
-        out = out.view(out.size(0), -1)
-        out = self.linear(out)
-        return out
+        return out.view(out.size(0), -1)
+
+    def forward_suffix(self, out):
+        return self.linear(self.encode_suffix(out))
+
+    def forward(self, x):
+        return self.forward_suffix(self.forward_prefix(x))
+
+    def forward_encoder(self, x):
+        return self.encode_suffix(self.forward_prefix(x))
+
+    def forward_classifier(self, x):
+        return self.linear(x)
 
     def forward_features(self, x):
-        out = F.relu(self.bn1(self.conv1(x)))
-        out1 = self.layer1(out)
-        out2 = self.layer2(out1)
-        out3 = self.layer3(out2)
-        out4 = self.layer4(out3)
-        out = F.avg_pool2d(out4, 4)
+        """
+        Logits and the globally average pooled output of every residual stage (batch x channels vectors), so callers
+        such as the loss prediction module never hold the full resolution feature maps, whatever the input size
+        """
+        out, feat_list = x, []
+        for stage in range(5):
+            with torch.set_grad_enabled(torch.is_grad_enabled() and stage >= self.frozen_stage):
+                out = self.run_stage(stage, out)
+            if stage > 0:
+                feat_list.append(F.adaptive_avg_pool2d(out, 1).flatten(1))
+        out = F.avg_pool2d(out, 4)
         feat = out.view(out.size(0), -1)
         out = self.linear(feat)
-        return out, [out1, out2, out3, out4]
+        return out, feat_list
 
     def forward_encoder_classifier(self, x):
         return self.forward(x)
 
 
+def resnet10(num_classes, input_size, drop_rate):
+    return ResNet(BasicBlock, [1, 1, 1, 1], num_classes=num_classes, input_size=input_size, drop_rate=drop_rate)
+
+
 def resnet18(num_classes, input_size, drop_rate):
     return ResNet(BasicBlock, [2, 2, 2, 2], num_classes=num_classes, input_size=input_size, drop_rate=drop_rate)
 
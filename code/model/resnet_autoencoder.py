@@ -131,3 +131,23 @@ class ResnetAutoencoder(nn.Module):
         out, feat_list = self.encoder.forward_features(x)
         out = self.classifier(out)
         return out, feat_list
+
+    @property
+    def frozen_stage(self):
+        return getattr(self.encoder, 'frozen_stage', 0)
+
+    def freeze(self, stage):
+        if hasattr(self.encoder, 'freeze'):
+            self.encoder.freeze(stage)
+        return self
+
+    def prefix_modules(self):
+        return self.encoder.prefix_modules() if hasattr(self.encoder, 'prefix_modules') else []
+
+    def forward_prefix(self, x):
+        return self.encoder.forward_prefix(x)
+
+    def forward_suffix(self, out):
+        h = self.encoder.forward_suffix(out)
+        out = self.classifier(h)
+        return out
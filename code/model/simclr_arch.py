@@ -1,6 +1,6 @@
 import torch.nn as nn
 from model.resnet import resnet18
-import torchvision.models as models
+from model.pretrained import load_pretrained
 
 
 class Identity(nn.Module):
@@ -14,7 +14,7 @@ class Identity(nn.Module):
 class SimCLRArch(nn.Module):
     def __init__(self, num_channels, num_classes, drop_rate,
                  normalize, latent_dim=64, projection_dim=64,
-                 arch='lenet', input_size=32):
+                 arch='lenet', input_size=32, pretrained_cache_path=None):
         super(SimCLRArch, self).__init__()
 
         self.normalize = normalize
@@ -28,11 +28,12 @@ class SimCLRArch(nn.Module):
                 nn.ReLU(),
                 nn.MaxPool2d(2),
                 nn.Flatten(),
-                nn.Linear(16 * 7 * 7, latent_dim),
+                nn.Linear(16 * (((input_size - 2) // 2) // 2) ** 2, latent_dim),
                 nn.ReLU(),
             )
         else:
-            self.encoder = load_pretrained(resnet18(num_classes, input_size, drop_rate))
+            self.encoder = load_pretrained(resnet18(num_classes, input_size, drop_rate),
+                                           cache_path=pretrained_cache_path)
             latent_dim = self.encoder.linear[1].in_features
             self.encoder.linear = Identity()
 
@@ -76,16 +77,22 @@ class SimCLRArch(nn.Module):
         out = self.classifier(out)
         return out, feat_list
 
+    @property
+    def frozen_stage(self):
+        return getattr(self.encoder, 'frozen_stage', 0)
 
-def load_pretrained(model):
-    model_dict = model.state_dict()
-    resnet18_pretrained_dict = models.resnet18(pretrained=True).state_dict()
+    def freeze(self, stage):
+        if hasattr(self.encoder, 'freeze'):
+            self.encoder.freeze(stage)
+        return self
 
-    for key in list(model_dict.keys()):
-        if 'linear' in key or 'conv1.weight' == key:
-            continue
-        model_dict[key] = resnet18_pretrained_dict[key.replace('shortcut', 'downsample')]
+    def prefix_modules(self):
+        return self.encoder.prefix_modules() if hasattr(self.encoder, 'prefix_modules') else []
 
-    model.load_state_dict(model_dict)
+    def forward_prefix(self, x):
+        return self.encoder.forward_prefix(x)
 
-    return model
+    def forward_suffix(self, out):
+        h = self.encoder.forward_suffix(out)
+        out = self.classifier(h)
+        return out
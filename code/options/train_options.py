@@ -14,6 +14,9 @@ parser.add_argument('--start-epoch', default=0, type=int, help='starting epoch n
 
 parser.add_argument('--resume', action='store_true', help='flag to be set if an existing model is to be loaded')
 
+parser.add_argument('--resume-run', action='store_true',
+                    help='resume an interrupted AL run from the run state stored at its last cycle boundary')
+
 parser.add_argument('--load-pretrained', action='store_false', help='load pretrained imagenet weights or not')
 
 parser.add_argument('--batch-size', default=256, type=int, help='batch size for AL training (default: 256)')
@@ -40,6 +43,30 @@ parser.add_argument('--no-augment', dest='augment', action='store_false',
 parser.add_argument('--add-labeled-epochs', default=20, type=int,
                     help='if recall doesn\'t improve perform AL cycle')
 
+parser.add_argument('--stopping-policy', default='patience', type=str, choices=['patience', 'smoothed', 'curve'],
+                    help='policy deciding when an AL cycle is performed, patience waits for --add-labeled-epochs '
+                         'non-improving epochs, smoothed and curve may stop earlier on a recall plateau')
+
+parser.add_argument('--stopping-min-delta', default=0.002, type=float,
+                    help='minimum macro recall gain the smoothed and curve stopping policies still train for')
+
+parser.add_argument('--stopping-window', default=5, type=int,
+                    help='number of validations the smoothed and curve stopping policies look at')
+
+parser.add_argument('--stopping-smoothing', default=0.6, type=float,
+                    help='exponential smoothing factor of the macro recall in the smoothed stopping policy')
+
+parser.add_argument('--validation-every', default=1, type=int,
+                    help='validate only every n-th epoch, epochs in between count as non-improving')
+
+parser.add_argument('--validation-subset', default=1.0, type=float,
+                    help='fraction of the test set in the class-stratified subset used for early stopping, the full '
+                         'test set is evaluated only when a cycle closes (1.0 validates on the full set every time)')
+
+parser.add_argument('--inference-cache-budget', default=1024, type=int,
+                    help='size in MB of the memory-mapped cache of pool logits and embeddings shared by the samplers '
+                         'and pseudo-labeling, least recently used entries are evicted beyond it')
+
 parser.add_argument('--add-labeled', default=100, type=int,
                     help='amount of labeled data to be added during each AL cycle')
 
@@ -75,15 +102,104 @@ parser.add_argument('--log-path', default='/home/qasima/med_active_learning/code
 
 parser.add_argument('--al', '--uncertainty-sampling-method', default='entropy_based', type=str,
                     choices=['least_confidence', 'margin_confidence', 'ratio_confidence', 'entropy_based',
-                             'mc_dropout', 'learning_loss', 'augmentations_based'],
+                             'mc_dropout', 'learning_loss', 'augmentations_based', 'snapshot_ensemble',
+                             'deep_ensemble', 'laplace'],
                     help='the AL algorithm to use')
 
 parser.add_argument('--mc-dropout-iterations', default=25, type=int,
                     help='number of iterations for mc dropout')
 
+parser.add_argument('--proxy-arch', default=None, type=str, choices=[None, 'lenet', 'resnet10'],
+                    help='small proxy model trained alongside the main model on the labeled set to rank the unlabeled '
+                         'subset for the least_confidence, margin_confidence, ratio_confidence and entropy_based '
+                         'criteria')
+
+parser.add_argument('--proxy-epochs', default=20, type=int,
+                    help='number of epochs the proxy model is trained for at acquisition when it was not trained '
+                         'alongside the main model')
+
+parser.add_argument('--proxy-shortlist', default=4, type=int,
+                    help='the main model scores the top proxy-shortlist * add-labeled samples of the proxy ranking, '
+                         '0 selects with the proxy alone')
+
+parser.add_argument('--proxy-compare', action='store_true',
+                    help='also score the whole unlabeled subset with the main model and log the overlap with the proxy '
+                         'selection next to the acquisition timings')
+
+parser.add_argument('--cascade-shortlist', default=0, type=int,
+                    help='rank the unlabeled subset with --cascade-criterion first and run mc_dropout, '
+                         'augmentations_based or batch_bald only on the top cascade-shortlist * add-labeled samples, 0 '
+                         'runs them on the whole subset')
+
+parser.add_argument('--cascade-criterion', default='entropy_based', type=str,
+                    choices=['least_confidence', 'margin_confidence', 'ratio_confidence', 'entropy_based'],
+                    help='single-pass criterion ranking the unlabeled subset for the cascade shortlist')
+
+parser.add_argument('--snapshot-ensemble-size', default=5, type=int,
+                    help='number of weight snapshots of the current cycle kept for snapshot_ensemble sampling')
+
+parser.add_argument('--snapshot-every', default=5, type=int,
+                    help='number of epochs between two snapshots of the snapshot ensemble')
+
+parser.add_argument('--snapshot-criterion', default='bald', type=str, choices=['entropy', 'bald'],
+                    help='score of the snapshot ensemble: entropy of the mean prediction or bald')
+
+parser.add_argument('--ensemble-size', default=1, type=int,
+                    help='number of ensemble members trained together with stacked weights in one model, values above '
+                         '1 enable deep_ensemble sampling (not supported by the semi-supervised methods and '
+                         'learning_loss)')
+
+parser.add_argument('--ensemble-criterion', default='bald', type=str, choices=['entropy', 'bald'],
+                    help='score of the deep ensemble: entropy of the mean prediction or bald')
+
+parser.add_argument('--laplace-structure', default='kron', type=str, choices=['diag', 'kron'],
+                    help='diagonal or Kronecker-factored GGN of the last layer for laplace sampling')
+
+parser.add_argument('--laplace-prior-precision', default=1.0, type=float,
+                    help='precision of the isotropic Gaussian prior over the last layer weights for laplace sampling')
+
+parser.add_argument('--laplace-samples', default=100, type=int,
+                    help='number of logit samples drawn from the last layer posterior per sample for laplace sampling')
+
+parser.add_argument('--laplace-criterion', default='bald', type=str, choices=['entropy', 'bald'],
+                    help='score of laplace sampling: bald from sampled logits or entropy of the probit approximated '
+                         'predictive distribution')
+
+parser.add_argument('--scoring-workers', default=0, type=int,
+                    help='score the unlabeled subset for the single-pass criteria on CPU in this many processes, each '
+                         'on a batch-aligned shard with shared-memory weights, 0 scores in the training process')
+
+parser.add_argument('--scoring-threads', default=1, type=int,
+                    help='number of torch threads of every scoring worker')
+
+parser.add_argument('--distributed', action='store_true',
+                    help='join the process group launched by torchrun: training is data parallel (gradients averaged '
+                         'over the ranks, --batch-size per rank), the single-pass criteria score the unlabeled subset '
+                         'split across the ranks, rank 0 broadcasts the new index sets and writes logs and checkpoints')
+
+parser.add_argument('--distributed-backend', default='gloo', type=str, choices=['gloo', 'nccl'],
+                    help='torch.distributed backend of --distributed')
+
 parser.add_argument('--augmentations_based_iterations', default=25, type=int,
                     help='number of iterations for augmentations based AL algorithm')
 
+parser.add_argument('--adaptive-iterations', action='store_true',
+                    help='stop mc_dropout and augmentations_based sampling once the selection is stable, using at most '
+                         '--mc-dropout-iterations / --augmentations_based_iterations passes')
+
+parser.add_argument('--adaptive-min-iterations', default=5, type=int,
+                    help='minimum number of passes of the adaptive samplers')
+
+parser.add_argument('--adaptive-metric', default='overlap', type=str, choices=['overlap', 'kendall'],
+                    help='stability of the adaptive samplers between two passes: overlap of the top add-labeled '
+                         'selections or kendall tau of the scores')
+
+parser.add_argument('--adaptive-threshold', default=0.95, type=float,
+                    help='stability between two passes from which the selection counts as stable')
+
+parser.add_argument('--adaptive-patience', default=2, type=int,
+                    help='number of consecutive stable passes after which the adaptive samplers stop')
+
 parser.add_argument('--root', default='~/datasets/thesis/stratified/', type=str,
                     help='the root path for the datasets')
 
@@ -97,8 +213,14 @@ parser.add_argument('--semi-supervised-method', default='fixmatch_with_al', type
                     help='the SSL algorithm to use')
 
 parser.add_argument('--semi-supervised-uncertainty-method', default='entropy_based', type=str,
-                    choices=['entropy_based', 'augmentations_based'],
-                    help='the AL algorithm to use in conjunction with a SSL algorithm')
+                    choices=['entropy_based', 'augmentations_based', 'training_dynamics', 'laplace'],
+                    help='the AL algorithm to use in conjunction with a SSL algorithm, training_dynamics only with '
+                         'fixmatch')
+
+parser.add_argument('--dynamics-criterion', default='low_confidence', type=str,
+                    choices=['low_confidence', 'variability', 'flips'],
+                    help='statistic of the weak-view predictions gathered during fixmatch training that ranks the '
+                         'unlabeled samples for training_dynamics sampling')
 
 parser.add_argument('--pseudo-labeling-threshold', default=0.99, type=int,
                     help='the threshold for considering the pseudo label as the actual label')
@@ -116,6 +238,31 @@ parser.add_argument('--simclr-normalize', action='store_false',
 parser.add_argument('--simclr-batch-size', default=1024, type=int,
                     help='batch size for simclr training (default: 1024)')
 
+parser.add_argument('--simclr-loss-chunk', default=0, type=int,
+                    help='number of similarity rows the simclr loss computes at once, 0 computes all rows together')
+
+parser.add_argument('--simclr-grad-cache-chunk', default=0, type=int,
+                    help='micro-batch size for gradient-cached simclr training, 0 backpropagates the whole batch at once')
+
+parser.add_argument('--simclr-mode', default='simclr', type=str, choices=['simclr', 'moco'],
+                    help='contrastive pretraining with in-batch negatives (simclr) or with a momentum encoder and a '
+                         'queue of negatives (moco)')
+
+parser.add_argument('--simclr-queue-size', default=4096, type=int,
+                    help='number of past key embeddings kept as negatives in moco mode')
+
+parser.add_argument('--simclr-momentum', default=0.999, type=float,
+                    help='momentum of the key encoder update in moco mode')
+
+parser.add_argument('--simclr-linear-probe', action='store_true',
+                    help='train only the simclr classifier head on top of the frozen pretrained encoder')
+
+parser.add_argument('--simclr-feature-cache', action='store_true',
+                    help='encode the train and test sets once and train the linear probe on the cached features')
+
+parser.add_argument('--simclr-feature-cache-variants', default=0, type=int,
+                    help='number of augmented encodings cached per training sample, 0 caches the test-time encoding')
+
 parser.add_argument('--simclr-arch', default='resnet', type=str, choices=['lenet', 'resnet'],
                     help='which encoder architecture to use for simclr')
 
@@ -138,6 +285,9 @@ parser.add_argument('--dataset', default='matek', type=str, choices=['cifar10',
 parser.add_argument('--checkpoint-path', default=f'/home/qasima/med_active_learning/code/runs/', type=str,
                     help='the directory root for saving/resuming checkpoints from')
 
+parser.add_argument('--pretrained-cache-path', default=f'{home}/.cache/{code_dir}', type=str,
+                    help='the directory where the remapped ImageNet resnet18 weights are stored for offline reuse')
+
 parser.add_argument('--seed', default=9999, type=int, choices=[6666, 9999, 2323, 5555],
                     help='the random seed to set')
 
@@ -159,6 +309,17 @@ parser.add_argument('--fixmatch-threshold', default=0.95, type=float,
 parser.add_argument('--fixmatch-k-img', default=8192, type=int,
                     help='number of labeled examples')
 
+parser.add_argument('--freeze-stage', default=0, type=int, choices=[0, 1, 2, 3, 4, 5],
+                    help='number of leading resnet stages (conv1, layer1, ..., layer4) kept frozen when fine-tuning a '
+                         'pretrained, simclr or autoencoder initialization')
+
+parser.add_argument('--freeze-cycles', default=0, type=int,
+                    help='number of AL cycles the frozen stages stay frozen, 0 keeps them frozen for the whole run')
+
+parser.add_argument('--fixmatch-unlabeled-chunk', default=0, type=int,
+                    help='process the unlabeled views in chunks of this many samples to bound activation memory, 0 '
+                         'processes the whole unlabeled batch at once')
+
 parser.add_argument('--fixmatch-epochs', default=1000, type=int,
                     help='epochs for SSL or SSL + AL training')
 
@@ -181,6 +342,14 @@ parser.add_argument('--autoencoder-train-epochs', default=20, type=int,
 parser.add_argument('--autoencoder-z-dim', default=128, type=float,
                     help='the bottleneck dimension for the autoencoder architecture')
 
+parser.add_argument('--reconstruction-loss-weights', default='l2:1,ssim:1', type=str,
+                    help='weights of the reconstruction terms (bce, l1, l2, ssim) in the autoencoder training loss, '
+                         'given as term:weight pairs separated by commas')
+
+parser.add_argument('--reconstruction-log-weights', default=None, type=str,
+                    help='weights of the reconstruction terms in the autoencoder loss logs, terms with weight 0 are not '
+                         'logged (default: all terms of the trainer with weight 1)')
+
 parser.add_argument('--autoencoder-resume', action='store_false',
                     help='flag to be set if an existing autoencoder model is to be loaded')
 
@@ -190,7 +359,8 @@ parser.add_argument('--k-medoids-n-clusters', default=10, type=int, help='number
 
 parser.add_argument('--novel-class-detection', action='store_true', help='turn on novel class detection')
 
-parser.add_argument('--gpu-id', default='0', type=str, help='the id of the GPU to use')
+parser.add_argument('--gpu-id', default='0', type=str,
+                    help='the id of the GPU to use, a comma separated list spreads the --distributed ranks over them')
 
 parser.set_defaults(augment=True)
 
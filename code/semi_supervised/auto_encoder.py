@@ -1,6 +1,8 @@
-from active_learning.augmentations_based import UncertaintySamplingAugmentationBased
+from active_learning.augmentations_based import UncertaintySamplingAugmentationBased, \
+    AdaptiveUncertaintySamplingAugmentationBased
+from active_learning.laplace import UncertaintySamplingLaplace
 from active_learning.others import UncertaintySamplingOthers
-from active_learning.mc_dropout import UncertaintySamplingMCDropout
+from active_learning.mc_dropout import UncertaintySamplingMCDropout, AdaptiveUncertaintySamplingMCDropout
 from data.isic_dataset import ISICDataset
 from data.matek_dataset import MatekDataset
 from data.cifar10_dataset import Cifar10Dataset
@@ -9,14 +11,13 @@ from data.plasmodium_dataset import PlasmodiumDataset
 from data.retinopathy_dataset import RetinopathyDataset
 
 from utils import create_base_loader, AverageMeter, save_checkpoint, create_loaders, accuracy, Metrics, \
-    store_logs, get_loss, perform_sampling, create_model_optimizer_autoencoder, LossPerClassMeter, print_args
+    store_logs, get_loss, perform_sampling, create_model_optimizer_autoencoder, LossPerClassMeter, print_args, \
+    ModelSnapshot, ValidationScheduler, create_stopping_policy, ReconstructionLoss, parse_loss_weights, get_device, \
+    synchronize_gradients, train_loss_columns
 import time
 import torch
-import torch.nn as nn
 import numpy as np
 import pandas as pd
-from copy import deepcopy
-from pytorch_msssim import SSIM
 
 torch.autograd.set_detect_anomaly(True)
 
@@ -48,11 +49,9 @@ class AutoEncoder:
 
         training_loss_log = []
 
-        l1_loss = nn.L1Loss()
-        l2_loss = nn.MSELoss()
-        ssim_loss = SSIM(size_average=True, data_range=1.0, nonnegative_ssim=True)
-
-        criterions = {'l1': l1_loss, 'l2': l2_loss, 'ssim': ssim_loss}
+        criterion = ReconstructionLoss(parse_loss_weights(self.args.reconstruction_loss_weights),
+                                       parse_loss_weights(self.args.reconstruction_log_weights or
+                                                          'l1:1,l2:1,ssim:1')).to(get_device())
 
         model, optimizer, self.args = create_model_optimizer_autoencoder(self.args, dataset_class)
 
@@ -63,24 +62,19 @@ class AutoEncoder:
         for epoch in range(self.args.start_epoch, self.args.autoencoder_train_epochs):
             model.train()
             batch_time = AverageMeter()
-            losses = AverageMeter()
-            losses_sum = np.zeros(len(criterions.keys()))
+            criterion.reset()
 
             end = time.time()
             for i, (data_x, data_y) in enumerate(train_loader):
-                data_x = data_x.cuda(non_blocking=True)
+                data_x = data_x.to(get_device(), non_blocking=True)
 
                 output = model(data_x)
 
-                losses_alt = np.array([v(output, data_x).cpu().detach().data.item() for v in criterions.values()])
-                losses_alt[-1] = 1 - losses_alt[-1]
-                losses_sum += losses_alt
-                loss = criterions['l2'](output, data_x) + (1 - criterions['ssim'](output, data_x))
-
-                losses.update(loss.data.item(), data_x.size(0))
+                loss = criterion(output, data_x)
 
                 optimizer.zero_grad()
                 loss.backward()
+                synchronize_gradients(model)
                 optimizer.step()
 
                 batch_time.update(time.time() - end)
@@ -89,14 +83,15 @@ class AutoEncoder:
                 if i % self.args.print_freq == 0:
                     print('Epoch: [{0}][{1}/{2}]\t'
                           'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
-                          'Loss {loss.val:.4f} ({loss.avg:.4f})\t'
-                          .format(epoch, i, len(train_loader), batch_time=batch_time, loss=losses))
+                          'Loss {loss:.4f} ({loss_avg:.4f})\t'
+                          .format(epoch, i, len(train_loader), batch_time=batch_time, loss=loss.item(),
+                                  loss_avg=criterion.average_loss()))
 
-            losses_avg = losses_sum / len(train_loader)
-            training_loss_log.append(losses_avg.tolist())
+            training_loss_log.append(criterion.average_log().tolist())
 
-            is_best = best_loss > losses.avg
-            best_loss = min(best_loss, losses.avg)
+            loss_avg = criterion.average_loss()
+            is_best = best_loss > loss_avg
+            best_loss = min(best_loss, loss_avg)
 
             save_checkpoint(self.args, {
                 'epoch': epoch + 1,
@@ -105,7 +100,7 @@ class AutoEncoder:
             }, is_best)
 
         if self.args.store_logs and not self.args.resume:
-            store_logs(self.args, pd.DataFrame(training_loss_log, columns=['l1', 'l2', 'ssim']), log_type='ae_loss')
+            store_logs(self.args, pd.DataFrame(training_loss_log, columns=criterion.log_terms), log_type='ae_loss')
 
         self.model = model
         return model
@@ -113,10 +108,18 @@ class AutoEncoder:
     def train_validate_classifier(self):
 
         if self.uncertainty_sampling_method == 'mc_dropout':
-            uncertainty_sampler = UncertaintySamplingMCDropout()
+            uncertainty_sampler = AdaptiveUncertaintySamplingMCDropout() if self.args.adaptive_iterations \
+                else UncertaintySamplingMCDropout()
             self.args.weak_supervision_strategy = 'semi_supervised_active_learning'
         elif self.uncertainty_sampling_method == 'augmentations_based':
-            uncertainty_sampler = UncertaintySamplingAugmentationBased()
+            uncertainty_sampler = AdaptiveUncertaintySamplingAugmentationBased() if self.args.adaptive_iterations \
+                else UncertaintySamplingAugmentationBased()
+            self.args.weak_supervision_strategy = 'semi_supervised_active_learning'
+        elif self.uncertainty_sampling_method == 'laplace':
+            uncertainty_sampler = UncertaintySamplingLaplace(structure=self.args.laplace_structure,
+                                                             prior_precision=self.args.laplace_prior_precision,
+                                                             samples=self.args.laplace_samples,
+                                                             criterion=self.args.laplace_criterion)
             self.args.weak_supervision_strategy = 'semi_supervised_active_learning'
         elif self.uncertainty_sampling_method == 'random_sampling':
             uncertainty_sampler = None
@@ -157,22 +160,35 @@ class AutoEncoder:
         num_class_per_cycle = pd.DataFrame([])
 
         best_recall, best_report, last_best_epochs = 0, None, 0
-        best_model = deepcopy(model)
+        best_model = ModelSnapshot(model)
 
         self.args.start_epoch = 0
         current_labeled = dataset_class.start_labeled
 
+        validation_scheduler = ValidationScheduler(self.args, test_dataset, self.kwargs)
+        stopping_policy = create_stopping_policy(self.args, self.args.start_epoch)
+
         for epoch in range(self.args.start_epoch, self.args.epochs):
             train_loss = self.train_classifier(train_loader, model, criterion, optimizer, last_best_epochs, epoch)
-            val_loss, val_report = self.validate_classifier(val_loader, model, last_best_epochs, criterion)
 
-            is_best = val_report['macro avg']['recall'] > best_recall
-            last_best_epochs = 0 if is_best else last_best_epochs + 1
+            if validation_scheduler.should_validate(epoch):
+                val_loss, val_report = self.validate_classifier(validation_scheduler.get_loader(val_loader),
+                                                                model, last_best_epochs, criterion)
+                is_best = val_report['macro avg']['recall'] > best_recall
+                stopping_policy.update(epoch, val_report['macro avg']['recall'])
 
-            val_report = pd.concat([val_report, train_loss, val_loss], axis=1)
-            metrics_per_epoch = pd.concat([metrics_per_epoch, val_report])
+                val_report = pd.concat([val_report, train_loss, val_loss], axis=1)
+                metrics_per_epoch = pd.concat([metrics_per_epoch, val_report])
+            else:
+                is_best = False
+            last_best_epochs = 0 if is_best else last_best_epochs + 1
 
-            if epoch > self.args.labeled_warmup_epochs and last_best_epochs > self.args.add_labeled_epochs:
+            if stopping_policy.should_stop(epoch, last_best_epochs):
+                stopping_policy.close_cycle(epoch, last_best_epochs)
+                if validation_scheduler.full_at_cycle_end:
+                    val_loss, full_report = self.validate_classifier(val_loader, best_model.materialize(),
+                                                                     last_best_epochs, criterion)
+                    best_report = pd.concat([full_report, train_loss_columns(best_report), val_loss], axis=1)
                 metrics_per_cycle = pd.concat([metrics_per_cycle, best_report])
 
                 train_loader, unlabeled_loader, val_loader, labeled_indices, unlabeled_indices = \
@@ -198,7 +214,7 @@ class AutoEncoder:
             else:
                 best_recall = val_report['macro avg']['recall'] if is_best else best_recall
                 best_report = val_report if is_best else best_report
-                best_model = deepcopy(model) if is_best else best_model
+                best_model = best_model.update(model) if is_best else best_model
 
             if current_labeled > self.args.stop_labeled:
                 break
@@ -206,7 +222,11 @@ class AutoEncoder:
         if self.args.store_logs:
             store_logs(self.args, metrics_per_cycle)
             store_logs(self.args, metrics_per_epoch, log_type='epoch_wise')
+            store_logs(self.args, validation_scheduler.get_policy(), log_type='validation_policy')
+            store_logs(self.args, stopping_policy.get_log(), log_type='stopping')
             store_logs(self.args, num_class_per_cycle, log_type='novel_class')
+            if hasattr(uncertainty_sampler, 'log'):
+                store_logs(self.args, pd.DataFrame(uncertainty_sampler.log), log_type='acquisition')
 
         return best_recall
 
@@ -221,8 +241,8 @@ class AutoEncoder:
         model.train()
 
         for i, (data_x, data_y) in enumerate(train_loader):
-            data_x = data_x.cuda(non_blocking=True)
-            data_y = data_y.cuda(non_blocking=True)
+            data_x = data_x.to(get_device(), non_blocking=True)
+            data_y = data_y.to(get_device(), non_blocking=True)
 
             if self.train_feat:
                 output = model.forward_encoder_classifier(data_x)
@@ -244,6 +264,7 @@ class AutoEncoder:
 
             optimizer.zero_grad()
             loss.backward()
+            synchronize_gradients(model)
             optimizer.step()
 
             batch_time.update(time.time() - end)
@@ -274,8 +295,8 @@ class AutoEncoder:
 
         with torch.no_grad():
             for i, (data_x, data_y) in enumerate(val_loader):
-                data_x = data_x.cuda(non_blocking=True)
-                data_y = data_y.cuda(non_blocking=True)
+                data_x = data_x.to(get_device(), non_blocking=True)
+                data_y = data_y.to(get_device(), non_blocking=True)
 
                 if self.train_feat:
                     output = model.forward_encoder_classifier(data_x)
@@ -306,6 +327,8 @@ class AutoEncoder:
                           .format(i, len(val_loader), batch_time=batch_time, loss=losses, top1=top1,
                                   last_best_epoch=last_best_epochs))
 
+        metrics.synchronize()
+        losses_per_class.synchronize()
         report = metrics.get_report(target_names=val_loader.dataset.dataset.classes)
         print(' * Acc@1 {top1.avg:.3f}\t * Prec {0}\t * Recall {1} * Acc@5 {top5.avg:.3f}\t'
               .format(report['macro avg']['precision'], report['macro avg']['recall'], top1=top1, top5=top5))
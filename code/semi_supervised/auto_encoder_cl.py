@@ -4,14 +4,13 @@ from data.cifar10_dataset import Cifar10Dataset
 from data.jurkat_dataset import JurkatDataset
 from data.plasmodium_dataset import PlasmodiumDataset
 from utils import create_base_loader, AverageMeter, save_checkpoint, create_loaders, accuracy, Metrics, \
-    store_logs, get_loss, perform_sampling, create_model_optimizer_autoencoder, LossPerClassMeter
+    store_logs, get_loss, perform_sampling, create_model_optimizer_autoencoder, LossPerClassMeter, ModelSnapshot, \
+    ValidationScheduler, create_stopping_policy, ReconstructionLoss, parse_loss_weights, get_device, \
+    synchronize_gradients, train_loss_columns
 import time
 import torch
-import torch.nn as nn
 import numpy as np
 import pandas as pd
-from copy import deepcopy
-from pytorch_msssim import SSIM
 
 torch.autograd.set_detect_anomaly(True)
 
@@ -54,12 +53,9 @@ class AutoEncoderCl:
 
         reconstruction_loss_log = []
 
-        bce_loss = nn.BCELoss().cuda()
-        l1_loss = nn.L1Loss()
-        l2_loss = nn.MSELoss()
-        ssim_loss = SSIM(size_average=True, data_range=1.0, nonnegative_ssim=True)
-
-        criterions_reconstruction = {'bce': bce_loss, 'l1': l1_loss, 'l2': l2_loss, 'ssim': ssim_loss}
+        criterion_reconstruction = ReconstructionLoss(parse_loss_weights(self.args.reconstruction_loss_weights),
+                                                      parse_loss_weights(self.args.reconstruction_log_weights or
+                                                                         'bce:1,l1:1,l2:1,ssim:1')).to(get_device())
         criterion_cl = get_loss(self.args, dataset_class.labeled_class_samples, reduction='none')
 
         model, optimizer, self.args = create_model_optimizer_autoencoder(self.args, dataset_class)
@@ -71,28 +67,41 @@ class AutoEncoderCl:
         num_class_per_cycle = pd.DataFrame([])
 
         best_recall, best_report, last_best_epochs = 0, None, 0
-        best_model = deepcopy(model)
+        best_model = ModelSnapshot(model)
 
         self.args.start_epoch = 0
         self.args.weak_supervision_strategy = "random_sampling"
         current_labeled = dataset_class.start_labeled
 
+        validation_scheduler = ValidationScheduler(self.args, test_dataset, self.kwargs)
+        stopping_policy = create_stopping_policy(self.args, self.args.start_epoch)
+
         for epoch in range(self.args.start_epoch, self.args.epochs):
-            cl_train_loss, losses_avg_reconstruction, losses_reconstruction = \
+            cl_train_loss, losses_avg_reconstruction, loss_reconstruction = \
                 self.train(labeled_loader, model, criterion_cl, optimizer, last_best_epochs, epoch,
-                           criterions_reconstruction, base_loader)
-            val_loss, val_report = self.validate(val_loader, model, last_best_epochs, criterion_cl)
+                           criterion_reconstruction, base_loader)
 
             reconstruction_loss_log.append(losses_avg_reconstruction.tolist())
-            best_loss = min(best_loss, losses_reconstruction.avg)
+            best_loss = min(best_loss, loss_reconstruction)
 
-            is_best = val_report['macro avg']['recall'] > best_recall
-            last_best_epochs = 0 if is_best else last_best_epochs + 1
+            if validation_scheduler.should_validate(epoch):
+                val_loss, val_report = self.validate(validation_scheduler.get_loader(val_loader),
+                                                     model, last_best_epochs, criterion_cl)
+                is_best = val_report['macro avg']['recall'] > best_recall
+                stopping_policy.update(epoch, val_report['macro avg']['recall'])
 
-            val_report = pd.concat([val_report, cl_train_loss, val_loss], axis=1)
-            metrics_per_epoch = pd.concat([metrics_per_epoch, val_report])
+                val_report = pd.concat([val_report, cl_train_loss, val_loss], axis=1)
+                metrics_per_epoch = pd.concat([metrics_per_epoch, val_report])
+            else:
+                is_best = False
+            last_best_epochs = 0 if is_best else last_best_epochs + 1
 
-            if epoch > self.args.labeled_warmup_epochs and last_best_epochs > self.args.add_labeled_epochs:
+            if stopping_policy.should_stop(epoch, last_best_epochs):
+                stopping_policy.close_cycle(epoch, last_best_epochs)
+                if validation_scheduler.full_at_cycle_end:
+                    val_loss, full_report = self.validate(val_loader, best_model.materialize(),
+                                                          last_best_epochs, criterion_cl)
+                    best_report = pd.concat([full_report, train_loss_columns(best_report), val_loss], axis=1)
                 metrics_per_cycle = pd.concat([metrics_per_cycle, best_report])
 
                 labeled_loader, unlabeled_loader, val_loader, labeled_indices, unlabeled_indices = \
@@ -118,7 +127,7 @@ class AutoEncoderCl:
             else:
                 best_recall = val_report['macro avg']['recall'] if is_best else best_recall
                 best_report = val_report if is_best else best_report
-                best_model = deepcopy(model) if is_best else best_model
+                best_model = best_model.update(model) if is_best else best_model
 
             if current_labeled > self.args.stop_labeled:
                 break
@@ -130,39 +139,34 @@ class AutoEncoderCl:
             }, is_best)
 
         if self.args.store_logs:
-            store_logs(self.args, pd.DataFrame(reconstruction_loss_log, columns=['bce', 'l1', 'l2', 'ssim']),
+            store_logs(self.args, pd.DataFrame(reconstruction_loss_log, columns=criterion_reconstruction.log_terms),
                        log_type='ae_loss')
             store_logs(self.args, metrics_per_cycle)
             store_logs(self.args, metrics_per_epoch, log_type='epoch_wise')
+            store_logs(self.args, validation_scheduler.get_policy(), log_type='validation_policy')
+            store_logs(self.args, stopping_policy.get_log(), log_type='stopping')
             store_logs(self.args, num_class_per_cycle, log_type='novel_class')
 
         self.model = model
         return model
 
     def train(self, labeled_loader, model, criterion_cl, optimizer, last_best_epochs, epoch,
-              criterions_reconstruction, base_loader):
+              criterion_reconstruction, base_loader):
         model.train()
         batch_time = AverageMeter()
-        losses_reconstruction = AverageMeter()
-        losses_sum_reconstruction = np.zeros(len(criterions_reconstruction.keys()))
+        criterion_reconstruction.reset()
 
         end = time.time()
         for i, (data_x, data_y) in enumerate(base_loader):
-            data_x = data_x.cuda(non_blocking=True)
+            data_x = data_x.to(get_device(), non_blocking=True)
 
             output = model(data_x)
 
-            losses_alt = np.array([v(output, data_x).cpu().detach().data.item() for v in
-                                   criterions_reconstruction.values()])
-            losses_alt[-1] = 1 - losses_alt[-1]
-            losses_sum_reconstruction = losses_sum_reconstruction + losses_alt
-            loss = criterions_reconstruction['l2'](output, data_x) + \
-                (1 - criterions_reconstruction['ssim'](output, data_x))
-
-            losses_reconstruction.update(loss.data.item(), data_x.size(0))
+            loss = criterion_reconstruction(output, data_x)
 
             optimizer.zero_grad()
             loss.backward()
+            synchronize_gradients(model)
             optimizer.step()
 
             batch_time.update(time.time() - end)
@@ -171,10 +175,12 @@ class AutoEncoderCl:
             if i % self.args.print_freq == 0:
                 print('Epoch: [{0}][{1}/{2}]\t'
                       'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
-                      'Loss {loss.val:.4f} ({loss.avg:.4f})\t'
-                      .format(epoch, i, len(base_loader), batch_time=batch_time, loss=losses_reconstruction))
+                      'Loss {loss:.4f} ({loss_avg:.4f})\t'
+                      .format(epoch, i, len(base_loader), batch_time=batch_time, loss=loss.item(),
+                              loss_avg=criterion_reconstruction.average_loss()))
 
-        losses_avg_reconstruction = losses_sum_reconstruction / len(base_loader)
+        losses_avg_reconstruction = criterion_reconstruction.average_log()
+        loss_reconstruction = criterion_reconstruction.average_loss()
 
         batch_time = AverageMeter()
         losses_cl = AverageMeter()
@@ -186,8 +192,8 @@ class AutoEncoderCl:
         model.train()
 
         for i, (data_x, data_y) in enumerate(labeled_loader):
-            data_x = data_x.cuda(non_blocking=True)
-            data_y = data_y.cuda(non_blocking=True)
+            data_x = data_x.to(get_device(), non_blocking=True)
+            data_y = data_y.to(get_device(), non_blocking=True)
 
             output = model.forward_encoder_classifier(data_x)
 
@@ -202,6 +208,7 @@ class AutoEncoderCl:
 
             optimizer.zero_grad()
             loss.backward()
+            synchronize_gradients(model)
             optimizer.step()
 
             batch_time.update(time.time() - end)
@@ -217,7 +224,7 @@ class AutoEncoderCl:
 
         return pd.DataFrame.from_dict({f'{k}-train-loss': losses_per_class_cl.avg[i]
                                        for i, k in enumerate(labeled_loader.dataset.dataset.classes)},
-                                      orient='index').T, losses_avg_reconstruction, losses_reconstruction
+                                      orient='index').T, losses_avg_reconstruction, loss_reconstruction
 
     def validate(self, val_loader, model, last_best_epochs, criterion):
         batch_time = AverageMeter()
@@ -233,8 +240,8 @@ class AutoEncoderCl:
 
         with torch.no_grad():
             for i, (data_x, data_y) in enumerate(val_loader):
-                data_x = data_x.cuda(non_blocking=True)
-                data_y = data_y.cuda(non_blocking=True)
+                data_x = data_x.to(get_device(), non_blocking=True)
+                data_y = data_y.to(get_device(), non_blocking=True)
 
                 output = model.forward_encoder_classifier(data_x)
 
@@ -261,6 +268,8 @@ class AutoEncoderCl:
                           .format(i, len(val_loader), batch_time=batch_time, loss=losses, top1=top1,
                                   last_best_epoch=last_best_epochs))
 
+        metrics.synchronize()
+        losses_per_class.synchronize()
         report = metrics.get_report(target_names=val_loader.dataset.dataset.classes)
         print(' * Acc@1 {top1.avg:.3f}\t * Prec {0}\t * Recall {1} * Acc@5 {top5.avg:.3f}\t'
               .format(report['macro avg']['precision'], report['macro avg']['recall'], top1=top1, top5=top5))
@@ -1,8 +1,9 @@
-from torch.utils.data import DataLoader
-
-from active_learning.augmentations_based import UncertaintySamplingAugmentationBased
+from active_learning.augmentations_based import UncertaintySamplingAugmentationBased, \
+    AdaptiveUncertaintySamplingAugmentationBased
+from active_learning.laplace import UncertaintySamplingLaplace
 from active_learning.others import UncertaintySamplingOthers
-from active_learning.mc_dropout import UncertaintySamplingMCDropout
+from active_learning.mc_dropout import UncertaintySamplingMCDropout, AdaptiveUncertaintySamplingMCDropout
+from active_learning.training_dynamics import TrainingDynamicsStore, UncertaintySamplingTrainingDynamics
 from data.isic_dataset import ISICDataset
 from data.matek_dataset import MatekDataset
 from data.cifar10_dataset import Cifar10Dataset
@@ -11,15 +12,18 @@ from data.plasmodium_dataset import PlasmodiumDataset
 from data.retinopathy_dataset import RetinopathyDataset
 
 import torch
+import os
 import time
 import numpy as np
 
 from utils import create_model_optimizer_scheduler, AverageMeter, accuracy, Metrics, perform_sampling, \
     store_logs, save_checkpoint, get_loss, LossPerClassMeter, create_loaders, load_pretrained, \
-    create_model_optimizer_autoencoder, create_model_optimizer_simclr, print_args
+    create_model_optimizer_autoencoder, create_model_optimizer_simclr, print_args, save_run_state, load_run_state, \
+    set_rng_state, ModelSnapshot, ValidationScheduler, create_stopping_policy, forward_views, forward_no_grad, \
+    backward_chunks, ActivationCache, apply_freeze_schedule, get_device, synchronize_gradients, \
+    create_train_loader, train_loss_columns
 
 import pandas as pd
-from copy import deepcopy
 
 torch.autograd.set_detect_anomaly(True)
 
@@ -39,13 +43,30 @@ class FixMatch:
         self.kwargs = {'num_workers': 16, 'pin_memory': False, 'drop_last': True}
         self.uncertainty_sampling_method = uncertainty_sampling_method
         self.init = self.args.semi_supervised_init
+        self.training_dynamics = TrainingDynamicsStore() \
+            if self.uncertainty_sampling_method == 'training_dynamics' else None
+        self.activation_cache = ActivationCache(os.path.join(self.args.checkpoint_path,
+                                                             f'{self.args.name}_{self.args.seed}', 'activations.npy'),
+                                                self.kwargs)
 
     def main(self):
         if self.uncertainty_sampling_method == 'mc_dropout':
-            uncertainty_sampler = UncertaintySamplingMCDropout()
+            uncertainty_sampler = AdaptiveUncertaintySamplingMCDropout() if self.args.adaptive_iterations \
+                else UncertaintySamplingMCDropout()
             self.args.weak_supervision_strategy = 'semi_supervised_active_learning'
         elif self.uncertainty_sampling_method == 'augmentations_based':
-            uncertainty_sampler = UncertaintySamplingAugmentationBased()
+            uncertainty_sampler = AdaptiveUncertaintySamplingAugmentationBased() if self.args.adaptive_iterations \
+                else UncertaintySamplingAugmentationBased()
+            self.args.weak_supervision_strategy = 'semi_supervised_active_learning'
+        elif self.uncertainty_sampling_method == 'training_dynamics':
+            uncertainty_sampler = UncertaintySamplingTrainingDynamics(self.training_dynamics,
+                                                                      criterion=self.args.dynamics_criterion)
+            self.args.weak_supervision_strategy = 'semi_supervised_active_learning'
+        elif self.uncertainty_sampling_method == 'laplace':
+            uncertainty_sampler = UncertaintySamplingLaplace(structure=self.args.laplace_structure,
+                                                             prior_precision=self.args.laplace_prior_precision,
+                                                             samples=self.args.laplace_samples,
+                                                             criterion=self.args.laplace_criterion)
             self.args.weak_supervision_strategy = 'semi_supervised_active_learning'
         elif self.uncertainty_sampling_method == 'random_sampling':
             uncertainty_sampler = None
@@ -73,6 +94,9 @@ class FixMatch:
         base_dataset, labeled_dataset, unlabeled_dataset, labeled_indices, unlabeled_indices, test_dataset = \
             dataset_cls.get_dataset()
 
+        if self.training_dynamics is not None:
+            self.training_dynamics.reset(len(base_dataset))
+
         train_loader, unlabeled_loader, val_loader = create_loaders(self.args, labeled_dataset, unlabeled_dataset,
                                                                     test_dataset,
                                                                     labeled_indices, unlabeled_indices, self.kwargs,
@@ -80,21 +104,22 @@ class FixMatch:
 
         labeled_dataset_fix, unlabeled_dataset_fix = dataset_cls.get_datasets_fixmatch(base_dataset, labeled_indices,
                                                                                        unlabeled_indices)
+        unlabeled_dataset_fix.return_indices = True
 
         self.args.lr = 0.0003
         model, optimizer, _ = create_model_optimizer_scheduler(self.args, dataset_cls)
 
         if self.init == 'pretrained':
-            model = load_pretrained(model)
+            model = load_pretrained(model, cache_path=self.args.pretrained_cache_path)
         elif self.init == 'autoencoder':
             model, optimizer, _ = create_model_optimizer_autoencoder(self.args, dataset_cls)
         elif self.init == 'simclr':
             model, optimizer, _, _ = create_model_optimizer_simclr(self.args, dataset_cls)
 
-        labeled_loader_fix = DataLoader(dataset=labeled_dataset_fix, batch_size=self.args.batch_size,
-                                        shuffle=True, **self.kwargs)
-        unlabeled_loader_fix = DataLoader(dataset=unlabeled_dataset_fix, batch_size=self.args.batch_size,
-                                          shuffle=True, **self.kwargs)
+        labeled_loader_fix = create_train_loader(labeled_dataset_fix, self.args.batch_size, self.kwargs,
+                                                 seed=self.args.seed)
+        unlabeled_loader_fix = create_train_loader(unlabeled_dataset_fix, self.args.batch_size, self.kwargs,
+                                                   seed=self.args.seed)
 
         criterion_labeled = get_loss(self.args, dataset_cls.labeled_class_samples, reduction='none')
         criterion_unlabeled = get_loss(self.args, dataset_cls.labeled_class_samples, reduction='none')
@@ -104,7 +129,7 @@ class FixMatch:
         model.zero_grad()
 
         best_recall, best_report, last_best_epochs = 0, None, 0
-        best_model = deepcopy(model)
+        best_model = ModelSnapshot(model)
 
         metrics_per_cycle = pd.DataFrame([])
         metrics_per_epoch = pd.DataFrame([])
@@ -114,20 +139,69 @@ class FixMatch:
 
         self.args.start_epoch = 0
         current_labeled = dataset_cls.start_labeled
+        current_cycle = 0
+
+        run_state = load_run_state(self.args)
+        if run_state is not None:
+            labeled_indices, unlabeled_indices = run_state['labeled_indices'], run_state['unlabeled_indices']
+            train_loader, unlabeled_loader, val_loader = create_loaders(self.args, labeled_dataset, unlabeled_dataset,
+                                                                        test_dataset, labeled_indices,
+                                                                        unlabeled_indices, self.kwargs,
+                                                                        dataset_cls.unlabeled_subset_num,
+                                                                        shuffle_unlabeled=False)
+            labeled_dataset_fix, unlabeled_dataset_fix = dataset_cls.get_datasets_fixmatch(base_dataset,
+                                                                                           labeled_indices,
+                                                                                           unlabeled_indices)
+            unlabeled_dataset_fix.return_indices = True
+            labeled_dataset_fix.indices = run_state['labeled_fix_indices']
+            unlabeled_dataset_fix.indices = run_state['unlabeled_fix_indices']
+            labeled_loader_fix = create_train_loader(labeled_dataset_fix, self.args.batch_size, self.kwargs,
+                                                     seed=self.args.seed)
+            unlabeled_loader_fix = create_train_loader(unlabeled_dataset_fix, self.args.batch_size, self.kwargs,
+                                                       seed=self.args.seed)
+            model.load_state_dict(run_state['state_dict'])
+            optimizer.load_state_dict(run_state['optimizer'])
+            best_model.load_state_dict(run_state['best_state_dict'])
+            self.args.start_epoch, current_cycle, current_labeled = \
+                run_state['epoch'], run_state['cycle'], run_state['current_labeled']
+            best_recall, best_report, last_best_epochs = \
+                run_state['best_recall'], run_state['best_report'], run_state['last_best_epochs']
+            metrics_per_cycle, metrics_per_epoch, num_class_per_cycle = \
+                run_state['metrics_per_cycle'], run_state['metrics_per_epoch'], run_state['num_class_per_cycle']
+            set_rng_state(run_state['rng_state'])
+            if self.training_dynamics is not None:
+                self.training_dynamics.load_state_dict(run_state['training_dynamics'])
+
+        model = apply_freeze_schedule(self.args, model, self.init, current_cycle)
+
+        validation_scheduler = ValidationScheduler(self.args, test_dataset, self.kwargs)
+        stopping_policy = create_stopping_policy(self.args, self.args.start_epoch)
+        if run_state is not None:
+            stopping_policy.load_state_dict(run_state['stopping_policy'])
 
         for epoch in range(self.args.start_epoch, self.args.fixmatch_epochs):
             train_loader_fix = zip(labeled_loader_fix, unlabeled_loader_fix)
             train_loss = self.train(train_loader_fix, model, optimizer, epoch, len(labeled_loader_fix), criterions,
                                     base_dataset.classes, last_best_epochs)
-            val_loss, val_report = self.validate(val_loader, model, last_best_epochs, criterions)
 
-            is_best = val_report['macro avg']['recall'] > best_recall
-            last_best_epochs = 0 if is_best else last_best_epochs + 1
+            if validation_scheduler.should_validate(epoch):
+                val_loss, val_report = self.validate(validation_scheduler.get_loader(val_loader),
+                                                     model, last_best_epochs, criterions)
+                is_best = val_report['macro avg']['recall'] > best_recall
+                stopping_policy.update(epoch, val_report['macro avg']['recall'])
 
-            val_report = pd.concat([val_report, train_loss, val_loss], axis=1)
-            metrics_per_epoch = pd.concat([metrics_per_epoch, val_report])
+                val_report = pd.concat([val_report, train_loss, val_loss], axis=1)
+                metrics_per_epoch = pd.concat([metrics_per_epoch, val_report])
+            else:
+                is_best = False
+            last_best_epochs = 0 if is_best else last_best_epochs + 1
 
-            if epoch > self.args.labeled_warmup_epochs and last_best_epochs > self.args.add_labeled_epochs:
+            if stopping_policy.should_stop(epoch, last_best_epochs):
+                stopping_policy.close_cycle(epoch, last_best_epochs)
+                if validation_scheduler.full_at_cycle_end:
+                    val_loss, full_report = self.validate(val_loader, best_model.materialize(),
+                                                          last_best_epochs, criterions)
+                    best_report = pd.concat([full_report, train_loss_columns(best_report), val_loss], axis=1)
                 metrics_per_cycle = pd.concat([metrics_per_cycle, best_report])
 
                 train_loader, unlabeled_loader, val_loader, labeled_indices, unlabeled_indices = \
@@ -138,11 +212,12 @@ class FixMatch:
                 labeled_dataset_fix, unlabeled_dataset_fix = dataset_cls.get_datasets_fixmatch(base_dataset,
                                                                                                labeled_indices,
                                                                                                unlabeled_indices)
+                unlabeled_dataset_fix.return_indices = True
 
-                labeled_loader_fix = DataLoader(dataset=labeled_dataset_fix, batch_size=self.args.batch_size,
-                                                shuffle=True, **self.kwargs)
-                unlabeled_loader_fix = DataLoader(dataset=unlabeled_dataset_fix, batch_size=self.args.batch_size,
-                                                  shuffle=True, **self.kwargs)
+                labeled_loader_fix = create_train_loader(labeled_dataset_fix, self.args.batch_size, self.kwargs,
+                                                         seed=self.args.seed)
+                unlabeled_loader_fix = create_train_loader(unlabeled_dataset_fix, self.args.batch_size, self.kwargs,
+                                                           seed=self.args.seed)
 
                 current_labeled += self.args.add_labeled
                 last_best_epochs = 0
@@ -151,7 +226,7 @@ class FixMatch:
                     model, optimizer, _ = create_model_optimizer_scheduler(self.args, dataset_cls)
 
                     if self.init == 'pretrained':
-                        model = load_pretrained(model)
+                        model = load_pretrained(model, cache_path=self.args.pretrained_cache_path)
                     elif self.init == 'autoencoder':
                         model, optimizer, _ = create_model_optimizer_autoencoder(self.args, dataset_cls)
                     elif self.init == 'simclr':
@@ -168,10 +243,34 @@ class FixMatch:
                 criterion_labeled = get_loss(self.args, dataset_cls.labeled_class_samples, reduction='none')
                 criterion_unlabeled = get_loss(self.args, dataset_cls.labeled_class_samples, reduction='none')
                 criterions = {'labeled': criterion_labeled, 'unlabeled': criterion_unlabeled}
+                current_cycle += 1
+                model = apply_freeze_schedule(self.args, model, self.init, current_cycle)
+
+                save_run_state(self.args, {
+                    'epoch': epoch + 1,
+                    'cycle': current_cycle,
+                    'current_labeled': current_labeled,
+                    'labeled_indices': labeled_indices,
+                    'unlabeled_indices': unlabeled_indices,
+                    'labeled_fix_indices': labeled_dataset_fix.indices,
+                    'unlabeled_fix_indices': unlabeled_dataset_fix.indices,
+                    'state_dict': model.state_dict(),
+                    'optimizer': optimizer.state_dict(),
+                    'best_state_dict': best_model.state_dict(),
+                    'best_recall': best_recall,
+                    'best_report': best_report,
+                    'last_best_epochs': last_best_epochs,
+                    'metrics_per_cycle': metrics_per_cycle,
+                    'metrics_per_epoch': metrics_per_epoch,
+                    'num_class_per_cycle': num_class_per_cycle,
+                    'stopping_policy': stopping_policy.state_dict(),
+                    'training_dynamics': self.training_dynamics.state_dict()
+                    if self.training_dynamics is not None else None,
+                })
             else:
                 best_recall = val_report['macro avg']['recall'] if is_best else best_recall
                 best_report = val_report if is_best else best_report
-                best_model = deepcopy(model) if is_best else best_model
+                best_model = best_model.update(model) if is_best else best_model
 
             save_checkpoint(self.args, {
                 'epoch': epoch + 1,
@@ -186,7 +285,11 @@ class FixMatch:
         if self.args.store_logs:
             store_logs(self.args, metrics_per_cycle)
             store_logs(self.args, metrics_per_epoch, log_type='epoch_wise')
+            store_logs(self.args, validation_scheduler.get_policy(), log_type='validation_policy')
+            store_logs(self.args, stopping_policy.get_log(), log_type='stopping')
             store_logs(self.args, num_class_per_cycle, log_type='novel_class')
+            if hasattr(uncertainty_sampler, 'log'):
+                store_logs(self.args, pd.DataFrame(uncertainty_sampler.log), log_type='acquisition')
 
         return best_recall
 
@@ -202,36 +305,44 @@ class FixMatch:
 
         for i, (data_labeled, data_unlabeled) in enumerate(train_loader):
             data_x, data_y = data_labeled
-            data_x, data_y = data_x.cuda(non_blocking=True), data_y.cuda(non_blocking=True)
+            data_x, data_y = data_x.to(get_device(), non_blocking=True), data_y.to(get_device(), non_blocking=True)
+
+            (data_w, data_s), _, indices_unlabeled = data_unlabeled
+            data_w, data_s = data_w.to(get_device(), non_blocking=True), data_s.to(get_device(), non_blocking=True)
+
+            optimizer.zero_grad()
 
-            (data_w, data_s), _ = data_unlabeled
-            data_w, data_s = data_w.cuda(non_blocking=True), data_s.cuda(non_blocking=True)
+            logits_unlabeled_w = forward_no_grad(model.forward_encoder_classifier, data_w,
+                                                 self.args.fixmatch_unlabeled_chunk)
+            pseudo_label = torch.softmax(logits_unlabeled_w, dim=-1)
+            max_probs, data_y_unlabeled = torch.max(pseudo_label, dim=-1)
+            mask = max_probs.ge(self.args.fixmatch_threshold).float()
 
-            inputs = torch.cat((data_x, data_w, data_s))
-            logits = model.forward_encoder_classifier(inputs)
-            logits_labeled = logits[:self.args.batch_size]
-            logits_unlabeled_w, logits_unlabeled_s = logits[self.args.batch_size:].chunk(2)
-            del logits
+            if self.training_dynamics is not None:
+                self.training_dynamics.update(indices_unlabeled, pseudo_label)
+
+            if self.args.fixmatch_unlabeled_chunk > 0:
+                loss_unlabeled = backward_chunks(model.forward_encoder_classifier, criterions['unlabeled'], data_s,
+                                                 data_y_unlabeled, mask, self.args.fixmatch_lambda_u,
+                                                 self.args.fixmatch_unlabeled_chunk)
+                logits_labeled = model.forward_encoder_classifier(data_x)
+            else:
+                logits_labeled, logits_unlabeled_s = forward_views(model.forward_encoder_classifier, data_x, data_s)
+                loss_unlabeled = (criterions['unlabeled'](logits_unlabeled_s, data_y_unlabeled) * mask).mean()
 
             loss_labeled = criterions['labeled'](logits_labeled, data_y)
 
             losses_per_class.update(loss_labeled.cpu().detach().numpy(), data_y.cpu().numpy())
             loss_labeled = torch.sum(loss_labeled) / loss_labeled.size(0)
 
-            pseudo_label = torch.softmax(logits_unlabeled_w.detach(), dim=-1)
-            max_probs, data_y_unlabeled = torch.max(pseudo_label, dim=-1)
-            mask = max_probs.ge(self.args.fixmatch_threshold).float()
-
-            loss_unlabeled = (criterions['unlabeled'](logits_unlabeled_s, data_y_unlabeled) * mask).mean()
-
             loss = loss_labeled + self.args.fixmatch_lambda_u * loss_unlabeled
 
             acc = accuracy(logits_labeled.data, data_y, topk=(1,))[0]
             losses.update(loss.data.item(), data_x.size(0))
             top1.update(acc.item(), data_x.size(0))
 
-            optimizer.zero_grad()
             loss.backward()
+            synchronize_gradients(model)
             optimizer.step()
 
             batch_time.update(time.time() - end)
@@ -262,12 +373,14 @@ class FixMatch:
 
         end = time.time()
 
+        batches, forward = self.activation_cache.iterate(model, val_loader)
+
         with torch.no_grad():
-            for i, (data_x, data_y) in enumerate(val_loader):
-                data_x = data_x.cuda(non_blocking=True)
-                data_y = data_y.cuda(non_blocking=True)
+            for i, (data_x, data_y) in enumerate(batches):
+                data_x = data_x.to(get_device(), non_blocking=True)
+                data_y = data_y.to(get_device(), non_blocking=True)
 
-                output = model.forward_encoder_classifier(data_x)
+                output = forward(data_x)
 
                 loss = criterions['labeled'](output, data_y)
 
@@ -292,6 +405,8 @@ class FixMatch:
                           .format(i, len(val_loader), batch_time=batch_time, loss=losses, top1=top1,
                                   last_best_epoch=last_best_epochs))
 
+        metrics.synchronize()
+        losses_per_class.synchronize()
         report = metrics.get_report(target_names=val_loader.dataset.dataset.classes)
         print(' * Acc@1 {top1.avg:.3f}\t * Prec {0}\t * Recall {1} * Acc@5 {top5.avg:.3f}\t'
               .format(report['macro avg']['precision'], report['macro avg']['recall'], top1=top1, top5=top5))
@@ -1,6 +1,8 @@
-from active_learning.augmentations_based import UncertaintySamplingAugmentationBased
+from active_learning.augmentations_based import UncertaintySamplingAugmentationBased, \
+    AdaptiveUncertaintySamplingAugmentationBased
+from active_learning.laplace import UncertaintySamplingLaplace
 from active_learning.others import UncertaintySamplingOthers
-from active_learning.mc_dropout import UncertaintySamplingMCDropout
+from active_learning.mc_dropout import UncertaintySamplingMCDropout, AdaptiveUncertaintySamplingMCDropout
 from data.isic_dataset import ISICDataset
 from data.matek_dataset import MatekDataset
 from data.cifar10_dataset import Cifar10Dataset
@@ -10,13 +12,14 @@ from data.retinopathy_dataset import RetinopathyDataset
 
 from utils import AverageMeter, create_loaders, accuracy, Metrics, \
     store_logs, get_loss, perform_sampling, create_model_optimizer_autoencoder, LossPerClassMeter, load_pretrained, \
-    create_model_optimizer_simclr, create_model_optimizer_scheduler, postprocess_indices, print_args
+    create_model_optimizer_simclr, create_model_optimizer_scheduler, postprocess_indices, print_args, save_run_state, \
+    load_run_state, set_rng_state, ModelSnapshot, ValidationScheduler, create_stopping_policy, ActivationCache, \
+    apply_freeze_schedule, get_inference_cache, get_device, synchronize_gradients, train_loss_columns
+import os
 import time
 import torch
 import numpy as np
 import pandas as pd
-from copy import deepcopy
-import torch.nn.functional as F
 
 
 class PseudoLabeling:
@@ -29,13 +32,25 @@ class PseudoLabeling:
         self.kwargs = {'num_workers': 16, 'pin_memory': False, 'drop_last': True}
         self.uncertainty_sampling_method = uncertainty_sampling_method
         self.init = self.args.semi_supervised_init
+        self.activation_cache = ActivationCache(os.path.join(self.args.checkpoint_path,
+                                                             f'{self.args.name}_{self.args.seed}', 'activations.npy'),
+                                                self.kwargs)
+        self.inference_cache = get_inference_cache(self.args)
 
     def train_validate_classifier(self):
         if self.uncertainty_sampling_method == 'mc_dropout':
-            uncertainty_sampler = UncertaintySamplingMCDropout()
+            uncertainty_sampler = AdaptiveUncertaintySamplingMCDropout() if self.args.adaptive_iterations \
+                else UncertaintySamplingMCDropout()
             self.args.weak_supervision_strategy = 'semi_supervised_active_learning'
         elif self.uncertainty_sampling_method == 'augmentations_based':
-            uncertainty_sampler = UncertaintySamplingAugmentationBased()
+            uncertainty_sampler = AdaptiveUncertaintySamplingAugmentationBased() if self.args.adaptive_iterations \
+                else UncertaintySamplingAugmentationBased()
+            self.args.weak_supervision_strategy = 'semi_supervised_active_learning'
+        elif self.uncertainty_sampling_method == 'laplace':
+            uncertainty_sampler = UncertaintySamplingLaplace(structure=self.args.laplace_structure,
+                                                             prior_precision=self.args.laplace_prior_precision,
+                                                             samples=self.args.laplace_samples,
+                                                             criterion=self.args.laplace_criterion)
             self.args.weak_supervision_strategy = 'semi_supervised_active_learning'
         elif self.uncertainty_sampling_method == 'random_sampling':
             uncertainty_sampler = None
@@ -68,7 +83,7 @@ class PseudoLabeling:
         model, optimizer, _ = create_model_optimizer_scheduler(self.args, dataset_class)
 
         if self.init == 'pretrained':
-            model = load_pretrained(model)
+            model = load_pretrained(model, cache_path=self.args.pretrained_cache_path)
         elif self.init == 'autoencoder':
             model, optimizer, _ = create_model_optimizer_autoencoder(self.args, dataset_class)
         elif self.init == 'simclr':
@@ -83,25 +98,59 @@ class PseudoLabeling:
         num_class_per_cycle = pd.DataFrame([])
 
         best_recall, best_report, last_best_epochs = 0, None, 0
-        best_model = deepcopy(model)
+        best_model = ModelSnapshot(model)
+        self.inference_cache.track(best_model)
 
         print_args(self.args)
 
         self.args.start_epoch = 0
         current_labeled = dataset_class.start_labeled
         current_pseudo_labeled = 0
+        current_cycle = 0
+
+        run_state = load_run_state(self.args)
+        if run_state is not None:
+            labeled_indices, unlabeled_indices = run_state['labeled_indices'], run_state['unlabeled_indices']
+            train_loader, unlabeled_loader, val_loader = create_loaders(self.args, labeled_dataset, unlabeled_dataset,
+                                                                        test_dataset, labeled_indices,
+                                                                        unlabeled_indices, self.kwargs,
+                                                                        dataset_class.unlabeled_subset_num,
+                                                                        shuffle_unlabeled=False)
+            model.load_state_dict(run_state['state_dict'])
+            optimizer.load_state_dict(run_state['optimizer'])
+            best_model.load_state_dict(run_state['best_state_dict'])
+            self.args.start_epoch, current_cycle, current_labeled, current_pseudo_labeled = \
+                run_state['epoch'], run_state['cycle'], run_state['current_labeled'], \
+                run_state['current_pseudo_labeled']
+            best_recall, best_report, last_best_epochs = \
+                run_state['best_recall'], run_state['best_report'], run_state['last_best_epochs']
+            metrics_per_cycle, metrics_per_epoch, num_class_per_cycle = \
+                run_state['metrics_per_cycle'], run_state['metrics_per_epoch'], run_state['num_class_per_cycle']
+            set_rng_state(run_state['rng_state'])
+
+        model = apply_freeze_schedule(self.args, model, self.init, current_cycle)
+
+        validation_scheduler = ValidationScheduler(self.args, test_dataset, self.kwargs)
+        stopping_policy = create_stopping_policy(self.args, self.args.start_epoch)
+        if run_state is not None:
+            stopping_policy.load_state_dict(run_state['stopping_policy'])
 
         for epoch in range(self.args.start_epoch, self.args.epochs):
             train_loss = self.train_classifier(train_loader, model, criterion, optimizer, last_best_epochs, epoch)
-            val_loss, val_report = self.validate_classifier(val_loader, model, last_best_epochs, criterion)
 
-            is_best = val_report['macro avg']['recall'] > best_recall
-            last_best_epochs = 0 if is_best else last_best_epochs + 1
+            if validation_scheduler.should_validate(epoch):
+                val_loss, val_report = self.validate_classifier(validation_scheduler.get_loader(val_loader),
+                                                                model, last_best_epochs, criterion)
+                is_best = val_report['macro avg']['recall'] > best_recall
+                stopping_policy.update(epoch, val_report['macro avg']['recall'])
 
-            val_report = pd.concat([val_report, train_loss, val_loss], axis=1)
-            metrics_per_epoch = pd.concat([metrics_per_epoch, val_report])
+                val_report = pd.concat([val_report, train_loss, val_loss], axis=1)
+                metrics_per_epoch = pd.concat([metrics_per_epoch, val_report])
+            else:
+                is_best = False
+            last_best_epochs = 0 if is_best else last_best_epochs + 1
 
-            samples_indices, samples_targets = self.get_samples(best_model, unlabeled_loader,
+            samples_indices, samples_targets = self.get_samples(best_model.materialize(), unlabeled_loader,
                                                                 number=int(self.args.pseudo_labeling_num / 500))
             labeled_indices, unlabeled_indices = postprocess_indices(labeled_indices, unlabeled_indices,
                                                                      samples_indices)
@@ -117,7 +166,12 @@ class PseudoLabeling:
             print('Epoch Classifier: [{0}]\t'
                   'Pseudo Labels Added: [{1}]'.format(epoch, len(samples_indices)))
 
-            if epoch > self.args.labeled_warmup_epochs and last_best_epochs > self.args.add_labeled_epochs:
+            if stopping_policy.should_stop(epoch, last_best_epochs):
+                stopping_policy.close_cycle(epoch, last_best_epochs)
+                if validation_scheduler.full_at_cycle_end:
+                    val_loss, full_report = self.validate_classifier(val_loader, best_model.materialize(),
+                                                                     last_best_epochs, criterion)
+                    best_report = pd.concat([full_report, train_loss_columns(best_report), val_loss], axis=1)
                 metrics_per_cycle = pd.concat([metrics_per_cycle, best_report])
 
                 train_loader, unlabeled_loader, val_loader, labeled_indices, unlabeled_indices = \
@@ -132,7 +186,7 @@ class PseudoLabeling:
                     model, optimizer, _ = create_model_optimizer_scheduler(self.args, dataset_class)
 
                     if self.init == 'pretrained':
-                        model = load_pretrained(model)
+                        model = load_pretrained(model, cache_path=self.args.pretrained_cache_path)
                     elif self.init == 'autoencoder':
                         model, optimizer, _ = create_model_optimizer_autoencoder(self.args, dataset_class)
                     elif self.init == 'simclr':
@@ -147,10 +201,31 @@ class PseudoLabeling:
                                                                             orient='index').T])
 
                 criterion = get_loss(self.args, dataset_class.labeled_class_samples, reduction='none')
+                current_cycle += 1
+                model = apply_freeze_schedule(self.args, model, self.init, current_cycle)
+
+                save_run_state(self.args, {
+                    'epoch': epoch + 1,
+                    'cycle': current_cycle,
+                    'current_labeled': current_labeled,
+                    'current_pseudo_labeled': current_pseudo_labeled,
+                    'labeled_indices': labeled_indices,
+                    'unlabeled_indices': unlabeled_indices,
+                    'state_dict': model.state_dict(),
+                    'optimizer': optimizer.state_dict(),
+                    'best_state_dict': best_model.state_dict(),
+                    'best_recall': best_recall,
+                    'best_report': best_report,
+                    'last_best_epochs': last_best_epochs,
+                    'metrics_per_cycle': metrics_per_cycle,
+                    'metrics_per_epoch': metrics_per_epoch,
+                    'num_class_per_cycle': num_class_per_cycle,
+                    'stopping_policy': stopping_policy.state_dict(),
+                })
             else:
                 best_recall = val_report['macro avg']['recall'] if is_best else best_recall
                 best_report = val_report if is_best else best_report
-                best_model = deepcopy(model) if is_best else best_model
+                best_model = best_model.update(model) if is_best else best_model
 
             if (current_labeled > self.args.stop_labeled) or (current_pseudo_labeled > self.args.pseudo_labeling_num):
                 break
@@ -158,7 +233,11 @@ class PseudoLabeling:
         if self.args.store_logs:
             store_logs(self.args, metrics_per_cycle)
             store_logs(self.args, metrics_per_epoch, log_type='epoch_wise')
+            store_logs(self.args, validation_scheduler.get_policy(), log_type='validation_policy')
+            store_logs(self.args, stopping_policy.get_log(), log_type='stopping')
             store_logs(self.args, num_class_per_cycle, log_type='novel_class')
+            if hasattr(uncertainty_sampler, 'log'):
+                store_logs(self.args, pd.DataFrame(uncertainty_sampler.log), log_type='acquisition')
 
         return best_recall
 
@@ -173,8 +252,8 @@ class PseudoLabeling:
         model.train()
 
         for i, (data_x, data_y) in enumerate(train_loader):
-            data_x = data_x.cuda(non_blocking=True)
-            data_y = data_y.cuda(non_blocking=True)
+            data_x = data_x.to(get_device(), non_blocking=True)
+            data_y = data_y.to(get_device(), non_blocking=True)
 
             output = model.forward_encoder_classifier(data_x)
             loss = criterion(output, data_y)
@@ -188,6 +267,7 @@ class PseudoLabeling:
 
             optimizer.zero_grad()
             loss.backward()
+            synchronize_gradients(model)
             optimizer.step()
 
             batch_time.update(time.time() - end)
@@ -216,12 +296,14 @@ class PseudoLabeling:
 
         end = time.time()
 
+        batches, forward = self.activation_cache.iterate(model, val_loader)
+
         with torch.no_grad():
-            for i, (data_x, data_y) in enumerate(val_loader):
-                data_x = data_x.cuda(non_blocking=True)
-                data_y = data_y.cuda(non_blocking=True)
+            for i, (data_x, data_y) in enumerate(batches):
+                data_x = data_x.to(get_device(), non_blocking=True)
+                data_y = data_y.to(get_device(), non_blocking=True)
 
-                output = model.forward_encoder_classifier(data_x)
+                output = forward(data_x)
 
                 loss = criterion(output, data_y)
 
@@ -246,6 +328,8 @@ class PseudoLabeling:
                           .format(i, len(val_loader), batch_time=batch_time, loss=losses, top1=top1,
                                   last_best_epoch=last_best_epochs))
 
+        metrics.synchronize()
+        losses_per_class.synchronize()
         report = metrics.get_report(target_names=val_loader.dataset.dataset.classes)
         print(' * Acc@1 {top1.avg:.3f}\t * Prec {0}\t * Recall {1} * Acc@5 {top5.avg:.3f}\t'
               .format(report['macro avg']['precision'], report['macro avg']['recall'], top1=top1, top5=top5))
@@ -255,37 +339,18 @@ class PseudoLabeling:
             pd.DataFrame.from_dict(report)
 
     def get_samples(self, model, unlabeled_loader, number):
-        batch_time = AverageMeter()
-        samples = None
-        samples_targets = None
-
-        end = time.time()
-
         model.eval()
 
-        for i, (data_x, _) in enumerate(unlabeled_loader):
-            data_x = data_x.cuda(non_blocking=True)
+        logits, _ = self.inference_cache.predict(model, unlabeled_loader)
+        samples, samples_targets = torch.max(torch.softmax(logits, dim=1), dim=1)
 
-            with torch.no_grad():
-                output = model.forward_encoder_classifier(data_x)
-            score = F.softmax(output, dim=1)
-            score = torch.max(score, dim=1)
-
-            samples = score[0] if samples is None else torch.cat([samples, score[0]])
-            samples_targets = score[1] if samples_targets is None else torch.cat([samples_targets, score[1]])
-
-            batch_time.update(time.time() - end)
-            end = time.time()
-
-            if i % self.args.print_freq == 0:
-                pass
-
-        samples_targets = samples_targets[samples > self.args.pseudo_labeling_threshold]
-        samples = samples[samples > self.args.pseudo_labeling_threshold]
-
-        samples_indices = samples.argsort(descending=True)[:number]
+        positions = torch.nonzero(samples > self.args.pseudo_labeling_threshold, as_tuple=True)[0]
+        samples_indices = positions[samples[positions].argsort(descending=True)[:number]]
         samples_targets = samples_targets[samples_indices]
 
+        self.inference_cache.drop(unlabeled_loader.dataset,
+                                  np.array(unlabeled_loader.dataset.indices)[samples_indices.numpy()])
+
         model.train()
 
         return samples_indices, samples_targets
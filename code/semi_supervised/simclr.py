@@ -1,6 +1,8 @@
-from active_learning.augmentations_based import UncertaintySamplingAugmentationBased
+from active_learning.augmentations_based import UncertaintySamplingAugmentationBased, \
+    AdaptiveUncertaintySamplingAugmentationBased
+from active_learning.laplace import UncertaintySamplingLaplace
 from active_learning.others import UncertaintySamplingOthers
-from active_learning.mc_dropout import UncertaintySamplingMCDropout
+from active_learning.mc_dropout import UncertaintySamplingMCDropout, AdaptiveUncertaintySamplingMCDropout
 from data.isic_dataset import ISICDataset
 from data.matek_dataset import MatekDataset
 from data.cifar10_dataset import Cifar10Dataset
@@ -9,13 +11,16 @@ from data.plasmodium_dataset import PlasmodiumDataset
 from data.retinopathy_dataset import RetinopathyDataset
 
 from utils import create_base_loader, AverageMeter, save_checkpoint, create_loaders, accuracy, Metrics, \
-    store_logs, NTXent, get_loss, perform_sampling, \
-    create_model_optimizer_simclr, LossPerClassMeter, print_args
+    store_logs, NTXent, MoCoLoss, get_loss, perform_sampling, \
+    create_model_optimizer_simclr, LossPerClassMeter, print_args, ModelSnapshot, ValidationScheduler, \
+    create_stopping_policy, get_rng_state, set_rng_state, forward_views, FeatureCache, get_device, \
+    synchronize_gradients, train_loss_columns
+import os
 import time
+from copy import deepcopy
 import torch
 import numpy as np
 import pandas as pd
-from copy import deepcopy
 
 torch.autograd.set_detect_anomaly(True)
 
@@ -36,6 +41,7 @@ class SimCLR:
         self.kwargs = {'num_workers': 16, 'pin_memory': False}
         self.uncertainty_sampling_method = uncertainty_sampling_method
         self.train_feat = train_feat
+        self.feature_caches = []
 
     def train(self):
         dataset_class = self.datasets[self.args.dataset](root=self.args.root,
@@ -51,11 +57,19 @@ class SimCLR:
 
         train_loader = create_base_loader(base_dataset, self.kwargs, self.args.simclr_batch_size)
 
-        criterion = NTXent(self.args.simclr_batch_size, self.args.simclr_temperature, torch.device("cuda"))
+        criterion = NTXent(self.args.simclr_temperature, chunk_size=self.args.simclr_loss_chunk)
 
         self.args.lr = 3e-4
         model, optimizer, _, self.args = create_model_optimizer_simclr(self.args, dataset_class)
 
+        if self.args.simclr_mode == 'moco':
+            momentum_model = deepcopy(model)
+            for param in momentum_model.parameters():
+                param.requires_grad = False
+
+            criterion = MoCoLoss(self.args.simclr_queue_size, model.projector[-1].out_features,
+                                 self.args.simclr_temperature).to(get_device())
+
         best_loss = np.inf
 
         for epoch in range(self.args.start_epoch, self.args.simclr_train_epochs):
@@ -65,18 +79,31 @@ class SimCLR:
 
             end = time.time()
             for i, ((data_x_i, data_x_j), y) in enumerate(train_loader):
-                data_x_i = data_x_i.cuda(non_blocking=True)
-                data_x_j = data_x_j.cuda(non_blocking=True)
+                data_x_i = data_x_i.to(get_device(), non_blocking=True)
+                data_x_j = data_x_j.to(get_device(), non_blocking=True)
 
                 optimizer.zero_grad()
-                h_i, z_i = model(data_x_i)
-                h_j, z_j = model(data_x_j)
 
-                loss = criterion(z_i, z_j)
+                if self.args.simclr_mode == 'moco':
+                    _, q = model(data_x_i)
+
+                    with torch.no_grad():
+                        self.momentum_update(model, momentum_model)
+                        _, k = momentum_model(data_x_j)
+
+                    loss = criterion(q, k)
+                    loss.backward()
+                elif self.args.simclr_grad_cache_chunk > 0:
+                    loss = self.grad_cache_step(model, criterion, data_x_i, data_x_j)
+                else:
+                    (h_i, z_i), (h_j, z_j) = forward_views(model, data_x_i, data_x_j)
+
+                    loss = criterion(z_i, z_j)
+                    loss.backward()
 
                 losses.update(loss.data.item(), data_x_i.size(0))
 
-                loss.backward()
+                synchronize_gradients(model)
                 optimizer.step()
 
                 batch_time.update(time.time() - end)
@@ -100,12 +127,59 @@ class SimCLR:
         self.model = model
         return model
 
+    def momentum_update(self, model, momentum_model):
+        for param, momentum_param in zip(model.parameters(), momentum_model.parameters()):
+            momentum_param.mul_(self.args.simclr_momentum).add_(param.detach(), alpha=1 - self.args.simclr_momentum)
+
+        for buffer, momentum_buffer in zip(model.buffers(), momentum_model.buffers()):
+            momentum_buffer.copy_(buffer)
+
+    def grad_cache_step(self, model, criterion, data_x_i, data_x_j):
+        """
+        Gradient caching: the projections of the whole batch are computed without graphs, the loss gradient w.r.t. the
+        projections is cached, and the encoder is re-run in micro-batches of --simclr-grad-cache-chunk samples to
+        backpropagate it, so only one micro-batch of activations is resident at a time.
+        """
+        batch_size = data_x_i.size(0)
+        chunks = torch.cat((data_x_i, data_x_j), dim=0).split(self.args.simclr_grad_cache_chunk)
+
+        rng_states, z = [], []
+        with torch.no_grad():
+            for chunk in chunks:
+                rng_states.append(get_rng_state())
+                z.append(model(chunk)[1])
+        rng_state = get_rng_state()
+        running_stats = {k: v.clone() for k, v in model.state_dict().items()
+                         if 'running_' in k or 'num_batches_tracked' in k}
+
+        z = torch.cat(z, dim=0).requires_grad_()
+        loss = criterion(z[:batch_size], z[batch_size:])
+        loss.backward()
+
+        for chunk, grad, state in zip(chunks, z.grad.split(self.args.simclr_grad_cache_chunk), rng_states):
+            set_rng_state(state)
+            _, z_chunk = model(chunk)
+            z_chunk.backward(grad)
+
+        set_rng_state(rng_state)
+        model.load_state_dict(running_stats, strict=False)
+
+        return loss.detach()
+
     def train_validate_classifier(self):
         if self.uncertainty_sampling_method == 'mc_dropout':
-            uncertainty_sampler = UncertaintySamplingMCDropout()
+            uncertainty_sampler = AdaptiveUncertaintySamplingMCDropout() if self.args.adaptive_iterations \
+                else UncertaintySamplingMCDropout()
             self.args.weak_supervision_strategy = 'semi_supervised_active_learning'
         elif self.uncertainty_sampling_method == 'augmentations_based':
-            uncertainty_sampler = UncertaintySamplingAugmentationBased()
+            uncertainty_sampler = AdaptiveUncertaintySamplingAugmentationBased() if self.args.adaptive_iterations \
+                else UncertaintySamplingAugmentationBased()
+            self.args.weak_supervision_strategy = 'semi_supervised_active_learning'
+        elif self.uncertainty_sampling_method == 'laplace':
+            uncertainty_sampler = UncertaintySamplingLaplace(structure=self.args.laplace_structure,
+                                                             prior_precision=self.args.laplace_prior_precision,
+                                                             samples=self.args.laplace_samples,
+                                                             criterion=self.args.laplace_criterion)
             self.args.weak_supervision_strategy = 'semi_supervised_active_learning'
         elif self.uncertainty_sampling_method == 'random_sampling':
             uncertainty_sampler = None
@@ -140,6 +214,18 @@ class SimCLR:
 
         model = self.model
 
+        if not self.train_feat and self.args.simclr_feature_cache:
+            model.eval()
+            directory = os.path.join(self.args.checkpoint_path, f'{self.args.name}_{self.args.seed}')
+            variants = self.args.simclr_feature_cache_variants
+            self.feature_caches = [
+                FeatureCache(os.path.join(directory, 'train_features.npy'), model.forward_encoder, labeled_dataset,
+                             labeled_dataset.transform if variants > 0 else test_dataset.transform,
+                             self.args.batch_size, self.kwargs, variants=variants),
+                FeatureCache(os.path.join(directory, 'test_features.npy'), model.forward_encoder, test_dataset,
+                             test_dataset.transform, self.args.batch_size, self.kwargs),
+            ]
+
         criterion = get_loss(self.args, dataset_class.labeled_class_samples, reduction='none')
 
         optimizer = torch.optim.Adam(model.parameters())
@@ -149,24 +235,37 @@ class SimCLR:
         num_class_per_cycle = pd.DataFrame([])
 
         best_recall, best_report, last_best_epochs = 0, None, 0
-        best_model = deepcopy(model)
+        best_model = ModelSnapshot(model)
 
         print_args(self.args)
 
         self.args.start_epoch = 0
         current_labeled = dataset_class.start_labeled
 
+        validation_scheduler = ValidationScheduler(self.args, test_dataset, self.kwargs)
+        stopping_policy = create_stopping_policy(self.args, self.args.start_epoch)
+
         for epoch in range(self.args.start_epoch, self.args.epochs):
             train_loss = self.train_classifier(train_loader, model, criterion, optimizer, last_best_epochs, epoch)
-            val_loss, val_report = self.validate_classifier(val_loader, model, last_best_epochs, criterion)
 
-            is_best = val_report['macro avg']['recall'] > best_recall
-            last_best_epochs = 0 if is_best else last_best_epochs + 1
+            if validation_scheduler.should_validate(epoch):
+                val_loss, val_report = self.validate_classifier(validation_scheduler.get_loader(val_loader),
+                                                                model, last_best_epochs, criterion)
+                is_best = val_report['macro avg']['recall'] > best_recall
+                stopping_policy.update(epoch, val_report['macro avg']['recall'])
 
-            val_report = pd.concat([val_report, train_loss, val_loss], axis=1)
-            metrics_per_epoch = pd.concat([metrics_per_epoch, val_report])
+                val_report = pd.concat([val_report, train_loss, val_loss], axis=1)
+                metrics_per_epoch = pd.concat([metrics_per_epoch, val_report])
+            else:
+                is_best = False
+            last_best_epochs = 0 if is_best else last_best_epochs + 1
 
-            if epoch > self.args.labeled_warmup_epochs and last_best_epochs > self.args.add_labeled_epochs:
+            if stopping_policy.should_stop(epoch, last_best_epochs):
+                stopping_policy.close_cycle(epoch, last_best_epochs)
+                if validation_scheduler.full_at_cycle_end:
+                    val_loss, full_report = self.validate_classifier(val_loader, best_model.materialize(),
+                                                                     last_best_epochs, criterion)
+                    best_report = pd.concat([full_report, train_loss_columns(best_report), val_loss], axis=1)
                 metrics_per_cycle = pd.concat([metrics_per_cycle, best_report])
 
                 train_loader, unlabeled_loader, val_loader, labeled_indices, unlabeled_indices = \
@@ -193,7 +292,7 @@ class SimCLR:
             else:
                 best_recall = val_report['macro avg']['recall'] if is_best else best_recall
                 best_report = val_report if is_best else best_report
-                best_model = deepcopy(model) if is_best else best_model
+                best_model = best_model.update(model) if is_best else best_model
 
             if current_labeled > self.args.stop_labeled:
                 break
@@ -201,10 +300,20 @@ class SimCLR:
         if self.args.store_logs:
             store_logs(self.args, metrics_per_cycle)
             store_logs(self.args, metrics_per_epoch, log_type='epoch_wise')
+            store_logs(self.args, validation_scheduler.get_policy(), log_type='validation_policy')
+            store_logs(self.args, stopping_policy.get_log(), log_type='stopping')
             store_logs(self.args, num_class_per_cycle, log_type='novel_class')
+            if hasattr(uncertainty_sampler, 'log'):
+                store_logs(self.args, pd.DataFrame(uncertainty_sampler.log), log_type='acquisition')
 
         return best_recall
 
+    def get_feature_cache(self, dataset):
+        for feature_cache in self.feature_caches:
+            if feature_cache.base_dataset is dataset.dataset:
+                return feature_cache
+        return None
+
     def train_classifier(self, train_loader, model, criterion, optimizer, last_best_epochs, epoch):
         batch_time = AverageMeter()
         losses = AverageMeter()
@@ -215,11 +324,18 @@ class SimCLR:
 
         model.train()
 
-        for i, (data_x, data_y) in enumerate(train_loader):
-            data_x = data_x.cuda(non_blocking=True)
-            data_y = data_y.cuda(non_blocking=True)
+        feature_cache = self.get_feature_cache(train_loader.dataset)
+        batches = feature_cache.iterate(train_loader.dataset, train_loader.batch_size, shuffle=True,
+                                        seed=self.args.seed) \
+            if feature_cache is not None else train_loader
+
+        for i, (data_x, data_y) in enumerate(batches):
+            data_x = data_x.to(get_device(), non_blocking=True)
+            data_y = data_y.to(get_device(), non_blocking=True)
 
-            if self.train_feat:
+            if feature_cache is not None:
+                output = model.forward_classifier(data_x)
+            elif self.train_feat:
                 output = model.forward_encoder_classifier(data_x)
             else:
                 model.eval()
@@ -239,6 +355,7 @@ class SimCLR:
 
             optimizer.zero_grad()
             loss.backward()
+            synchronize_gradients(model)
             optimizer.step()
 
             batch_time.update(time.time() - end)
@@ -267,12 +384,18 @@ class SimCLR:
 
         end = time.time()
 
+        feature_cache = self.get_feature_cache(val_loader.dataset)
+        batches = feature_cache.iterate(val_loader.dataset, val_loader.batch_size) \
+            if feature_cache is not None else val_loader
+
         with torch.no_grad():
-            for i, (data_x, data_y) in enumerate(val_loader):
-                data_x = data_x.cuda(non_blocking=True)
-                data_y = data_y.cuda(non_blocking=True)
+            for i, (data_x, data_y) in enumerate(batches):
+                data_x = data_x.to(get_device(), non_blocking=True)
+                data_y = data_y.to(get_device(), non_blocking=True)
 
-                if self.train_feat:
+                if feature_cache is not None:
+                    output = model.forward_classifier(data_x)
+                elif self.train_feat:
                     output = model.forward_encoder_classifier(data_x)
                 else:
                     h = model.forward_encoder(data_x)
@@ -301,6 +424,8 @@ class SimCLR:
                           .format(i, len(val_loader), batch_time=batch_time, loss=losses, top1=top1,
                                   last_best_epoch=last_best_epochs))
 
+        metrics.synchronize()
+        losses_per_class.synchronize()
         report = metrics.get_report(target_names=val_loader.dataset.dataset.classes)
         print(' * Acc@1 {top1.avg:.3f}\t * Prec {0}\t * Recall {1} * Acc@5 {top5.avg:.3f}\t'
               .format(report['macro avg']['precision'], report['macro avg']['recall'], top1=top1, top5=top5))
@@ -1,4 +1,3 @@
-from copy import deepcopy
 import random
 import pandas as pd
 import numpy as np
@@ -11,11 +10,17 @@ import torch.backends.cudnn as cudnn
 import torch.optim
 import torch.utils.data
 
-from active_learning.augmentations_based import UncertaintySamplingAugmentationBased
+from active_learning.augmentations_based import UncertaintySamplingAugmentationBased, \
+    AdaptiveUncertaintySamplingAugmentationBased
 from active_learning.batch_bald import UncertaintySamplingBatchBald
+from active_learning.cascade import UncertaintySamplingCascade
+from active_learning.deep_ensemble import UncertaintySamplingDeepEnsemble
+from active_learning.laplace import UncertaintySamplingLaplace
 from active_learning.learning_loss import LearningLoss
 from active_learning.others import UncertaintySamplingOthers
-from active_learning.mc_dropout import UncertaintySamplingMCDropout
+from active_learning.mc_dropout import UncertaintySamplingMCDropout, AdaptiveUncertaintySamplingMCDropout
+from active_learning.proxy import UncertaintySamplingProxy
+from active_learning.snapshot_ensemble import UncertaintySamplingSnapshotEnsemble
 
 from semi_supervised.auto_encoder import AutoEncoder
 from semi_supervised.simclr import SimCLR
@@ -37,10 +42,12 @@ from data.config.isic_config import set_isic_configs
 from data.config.retinopathy_config import set_retinopathy_configs
 
 from options.train_options import get_arguments
+from model.ensemble import StackedEnsemble
 
 from utils import save_checkpoint, AverageMeter, accuracy, create_loaders, print_args, \
     create_model_optimizer_scheduler, get_loss, resume_model, set_model_name, perform_sampling, LossPerClassMeter, \
-    load_pretrained
+    load_pretrained, save_run_state, load_run_state, set_rng_state, ModelSnapshot, ValidationScheduler, \
+    create_stopping_policy, get_inference_cache, init_distributed, get_device, synchronize_gradients, train_loss_columns
 from utils import Metrics, store_logs
 
 arguments = get_arguments()
@@ -63,6 +70,19 @@ def main(args):
 
     args.name = set_model_name(args)
     args = configs[args.dataset](args)
+    get_inference_cache(args)
+    init_distributed(args)
+
+    if args.ensemble_size > 1 and (args.weak_supervision_strategy == 'semi_supervised' or
+                                   args.uncertainty_sampling_method == 'learning_loss'):
+        raise ValueError('--ensemble-size > 1 is only supported by the supervised training loop, not by the '
+                         'semi-supervised methods or learning_loss')
+
+    if args.weak_supervision_strategy == 'semi_supervised' and \
+            args.semi_supervised_uncertainty_method == 'training_dynamics' and \
+            args.semi_supervised_method not in ['fixmatch', 'fixmatch_with_al']:
+        raise ValueError('--semi-supervised-uncertainty-method training_dynamics needs the statistics gathered during '
+                         'fixmatch training, use it with --semi-supervised-method fixmatch_with_al')
 
     if args.uncertainty_sampling_method == 'learning_loss' or \
             args.semi_supervised_uncertainty_method == 'learning_loss':
@@ -79,7 +99,7 @@ def main(args):
         best_acc = auto_encoder_cl.main()
         return best_acc
     elif args.weak_supervision_strategy == 'semi_supervised' and args.semi_supervised_method == 'simclr':
-        simclr = SimCLR(args, train_feat=True, uncertainty_sampling_method='random_sampling')
+        simclr = SimCLR(args, train_feat=not args.simclr_linear_probe, uncertainty_sampling_method='random_sampling')
         simclr.train()
         best_acc = simclr.train_validate_classifier()
         return best_acc
@@ -92,7 +112,8 @@ def main(args):
         best_acc = pseudo_labeling.train_validate_classifier()
         return best_acc
     elif args.weak_supervision_strategy == 'semi_supervised' and args.semi_supervised_method == 'simclr_with_al':
-        simclr = SimCLR(args, train_feat=True, uncertainty_sampling_method=args.semi_supervised_uncertainty_method)
+        simclr = SimCLR(args, train_feat=not args.simclr_linear_probe,
+                        uncertainty_sampling_method=args.semi_supervised_uncertainty_method)
         simclr.train()
         best_acc = simclr.train_validate_classifier()
         return best_acc
@@ -111,11 +132,22 @@ def main(args):
         return best_acc
 
     if args.uncertainty_sampling_method == 'mc_dropout':
-        uncertainty_sampler = UncertaintySamplingMCDropout()
+        uncertainty_sampler = AdaptiveUncertaintySamplingMCDropout() if args.adaptive_iterations \
+            else UncertaintySamplingMCDropout()
     elif args.uncertainty_sampling_method == 'augmentations_based':
-        uncertainty_sampler = UncertaintySamplingAugmentationBased()
+        uncertainty_sampler = AdaptiveUncertaintySamplingAugmentationBased() if args.adaptive_iterations \
+            else UncertaintySamplingAugmentationBased()
     elif args.uncertainty_sampling_method == 'batch_bald':
         uncertainty_sampler = UncertaintySamplingBatchBald()
+    elif args.uncertainty_sampling_method == 'snapshot_ensemble':
+        uncertainty_sampler = UncertaintySamplingSnapshotEnsemble(args)
+    elif args.uncertainty_sampling_method == 'deep_ensemble':
+        uncertainty_sampler = UncertaintySamplingDeepEnsemble(criterion=args.ensemble_criterion)
+    elif args.uncertainty_sampling_method == 'laplace':
+        uncertainty_sampler = UncertaintySamplingLaplace(structure=args.laplace_structure,
+                                                         prior_precision=args.laplace_prior_precision,
+                                                         samples=args.laplace_samples,
+                                                         criterion=args.laplace_criterion)
     elif args.uncertainty_sampling_method is not None:
         uncertainty_sampler = UncertaintySamplingOthers(verbose=True,
                                                         uncertainty_sampling_method=args.uncertainty_sampling_method)
@@ -137,15 +169,23 @@ def main(args):
     base_dataset, labeled_dataset, unlabeled_dataset, labeled_indices, unlabeled_indices, test_dataset = \
         dataset_class.get_dataset()
 
+    if args.proxy_arch is not None and isinstance(uncertainty_sampler, UncertaintySamplingOthers):
+        uncertainty_sampler = UncertaintySamplingProxy(uncertainty_sampler, dataset_class, args)
+    elif args.cascade_shortlist > 0 and isinstance(uncertainty_sampler, (UncertaintySamplingMCDropout,
+                                                                          UncertaintySamplingAugmentationBased,
+                                                                          UncertaintySamplingBatchBald)):
+        uncertainty_sampler = UncertaintySamplingCascade(uncertainty_sampler, dataset_class,
+                                                         criterion=args.cascade_criterion)
+
     kwargs = {'num_workers': 16, 'pin_memory': False}
     train_loader, unlabeled_loader, val_loader = create_loaders(args, labeled_dataset, unlabeled_dataset, test_dataset,
                                                                 labeled_indices, unlabeled_indices, kwargs,
                                                                 dataset_class.unlabeled_subset_num)
 
-    model, optimizer, scheduler = create_model_optimizer_scheduler(args, dataset_class)
+    model, optimizer, scheduler = create_model_optimizer_scheduler(args, dataset_class, ensemble=True)
 
     if args.load_pretrained:
-        model = load_pretrained(model)
+        model = load_pretrained(model, cache_path=args.pretrained_cache_path)
 
     if args.resume:
         model, _, _ = resume_model(args, model)
@@ -156,25 +196,62 @@ def main(args):
     metrics_per_cycle = pd.DataFrame([])
     metrics_per_epoch = pd.DataFrame([])
     num_class_per_cycle = pd.DataFrame([])
-    best_model = deepcopy(model)
+    best_model = ModelSnapshot(model)
 
     print_args(args)
 
     print('Starting training..')
 
     best_recall, best_report, last_best_epochs = 0, None, 0
+    current_cycle = 0
+
+    run_state = load_run_state(args)
+    if run_state is not None:
+        labeled_indices, unlabeled_indices = run_state['labeled_indices'], run_state['unlabeled_indices']
+        train_loader, unlabeled_loader, val_loader = create_loaders(args, labeled_dataset, unlabeled_dataset,
+                                                                    test_dataset, labeled_indices, unlabeled_indices,
+                                                                    kwargs, dataset_class.unlabeled_subset_num,
+                                                                    shuffle_unlabeled=False)
+        model.load_state_dict(run_state['state_dict'])
+        optimizer.load_state_dict(run_state['optimizer'])
+        scheduler.load_state_dict(run_state['scheduler'])
+        best_model.load_state_dict(run_state['best_state_dict'])
+        args.start_epoch, current_cycle, current_labeled = \
+            run_state['epoch'], run_state['cycle'], run_state['current_labeled']
+        best_recall, best_report, last_best_epochs = \
+            run_state['best_recall'], run_state['best_report'], run_state['last_best_epochs']
+        metrics_per_cycle, metrics_per_epoch, num_class_per_cycle = \
+            run_state['metrics_per_cycle'], run_state['metrics_per_epoch'], run_state['num_class_per_cycle']
+        set_rng_state(run_state['rng_state'])
+
+    validation_scheduler = ValidationScheduler(args, test_dataset, kwargs)
+    stopping_policy = create_stopping_policy(args, args.start_epoch)
+    if run_state is not None:
+        stopping_policy.load_state_dict(run_state['stopping_policy'])
 
     for epoch in range(args.start_epoch, args.epochs):
         train_loss = train(train_loader, model, criterion, optimizer, epoch, last_best_epochs, args)
-        val_loss, val_report = validate(val_loader, model, criterion, last_best_epochs, args)
+        if hasattr(uncertainty_sampler, 'observe'):
+            uncertainty_sampler.observe(model, train_loader)
 
-        is_best = val_report['macro avg']['recall'] > best_recall
-        last_best_epochs = 0 if is_best else last_best_epochs + 1
+        if validation_scheduler.should_validate(epoch):
+            val_loss, val_report = validate(validation_scheduler.get_loader(val_loader),
+                                            model, criterion, last_best_epochs, args)
+            is_best = val_report['macro avg']['recall'] > best_recall
+            stopping_policy.update(epoch, val_report['macro avg']['recall'])
 
-        val_report = pd.concat([val_report, train_loss, val_loss], axis=1)
-        metrics_per_epoch = pd.concat([metrics_per_epoch, val_report])
+            val_report = pd.concat([val_report, train_loss, val_loss], axis=1)
+            metrics_per_epoch = pd.concat([metrics_per_epoch, val_report])
+        else:
+            is_best = False
+        last_best_epochs = 0 if is_best else last_best_epochs + 1
 
-        if epoch > args.labeled_warmup_epochs and last_best_epochs > args.add_labeled_epochs:
+        if stopping_policy.should_stop(epoch, last_best_epochs):
+            stopping_policy.close_cycle(epoch, last_best_epochs)
+            if validation_scheduler.full_at_cycle_end:
+                val_loss, full_report = validate(val_loader, best_model.materialize(),
+                                                 criterion, last_best_epochs, args)
+                best_report = pd.concat([full_report, train_loss_columns(best_report), val_loss], axis=1)
             metrics_per_cycle = pd.concat([metrics_per_cycle, best_report])
 
             train_loader, unlabeled_loader, val_loader, labeled_indices, unlabeled_indices = \
@@ -186,7 +263,7 @@ def main(args):
             last_best_epochs = 0
 
             if args.reset_model:
-                model, optimizer, scheduler = create_model_optimizer_scheduler(args, dataset_class)
+                model, optimizer, scheduler = create_model_optimizer_scheduler(args, dataset_class, ensemble=True)
 
             if args.novel_class_detection:
                 num_classes = [np.sum(np.array(base_dataset.targets)[labeled_indices] == i)
@@ -195,10 +272,30 @@ def main(args):
                                                  for i, cls in enumerate(base_dataset.classes)}, orient='index').T])
 
             criterion = get_loss(args, dataset_class.labeled_class_samples, reduction='none')
+            current_cycle += 1
+
+            save_run_state(args, {
+                'epoch': epoch + 1,
+                'cycle': current_cycle,
+                'current_labeled': current_labeled,
+                'labeled_indices': labeled_indices,
+                'unlabeled_indices': unlabeled_indices,
+                'state_dict': model.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'scheduler': scheduler.state_dict(),
+                'best_state_dict': best_model.state_dict(),
+                'best_recall': best_recall,
+                'best_report': best_report,
+                'last_best_epochs': last_best_epochs,
+                'metrics_per_cycle': metrics_per_cycle,
+                'metrics_per_epoch': metrics_per_epoch,
+                'num_class_per_cycle': num_class_per_cycle,
+                'stopping_policy': stopping_policy.state_dict(),
+            })
         else:
             best_recall = val_report['macro avg']['recall'] if is_best else best_recall
             best_report = val_report if is_best else best_report
-            best_model = deepcopy(model) if is_best else best_model
+            best_model = best_model.update(model) if is_best else best_model
 
         save_checkpoint(args, {
             'epoch': epoch + 1,
@@ -214,7 +311,11 @@ def main(args):
     if args.store_logs:
         store_logs(args, metrics_per_cycle)
         store_logs(args, metrics_per_epoch, log_type='epoch_wise')
+        store_logs(args, validation_scheduler.get_policy(), log_type='validation_policy')
+        store_logs(args, stopping_policy.get_log(), log_type='stopping')
         store_logs(args, num_class_per_cycle, log_type='novel_class')
+        if hasattr(uncertainty_sampler, 'log'):
+            store_logs(args, pd.DataFrame(uncertainty_sampler.log), log_type='acquisition')
 
 
 def train(train_loader, model, criterion, optimizer, epoch, last_best_epochs, args):
@@ -227,12 +328,17 @@ def train(train_loader, model, criterion, optimizer, epoch, last_best_epochs, ar
 
     end = time.time()
     for i, (data_x, data_y) in enumerate(train_loader):
-        data_y = data_y.cuda(non_blocking=True)
-        data_x = data_x.cuda(non_blocking=True)
+        data_y = data_y.to(get_device(), non_blocking=True)
+        data_x = data_x.to(get_device(), non_blocking=True)
 
         optimizer.zero_grad()
-        output = model(data_x)
-        loss = criterion(output, data_y)
+        if isinstance(model, StackedEnsemble):
+            members = model.forward_members(data_x)
+            loss = criterion(members.flatten(0, 1), data_y.repeat(model.size)).view(model.size, -1).mean(dim=0)
+            output = model.combine(members)
+        else:
+            output = model(data_x)
+            loss = criterion(output, data_y)
 
         losses_per_class.update(loss.cpu().detach().numpy(), data_y.cpu().numpy())
         loss = torch.sum(loss) / loss.size(0)
@@ -242,6 +348,7 @@ def train(train_loader, model, criterion, optimizer, epoch, last_best_epochs, ar
         top1.update(acc.item(), data_x.size(0))
 
         loss.backward()
+        synchronize_gradients(model)
         optimizer.step()
 
         batch_time.update(time.time() - end)
@@ -274,8 +381,8 @@ def validate(val_loader, model, criterion, last_best_epochs, args):
 
     with torch.no_grad():
         for i, (data_x, data_y) in enumerate(val_loader):
-            data_y = data_y.cuda(non_blocking=True)
-            data_x = data_x.cuda(non_blocking=True)
+            data_y = data_y.to(get_device(), non_blocking=True)
+            data_x = data_x.to(get_device(), non_blocking=True)
 
             output = model(data_x)
             loss = criterion(output, data_y)
@@ -301,6 +408,8 @@ def validate(val_loader, model, criterion, last_best_epochs, args):
                       .format(i, len(val_loader), batch_time=batch_time, loss=losses, top1=top1,
                               last_best_epoch=last_best_epochs))
 
+    metrics.synchronize()
+    losses_per_class.synchronize()
     report = metrics.get_report(target_names=val_loader.dataset.dataset.classes)
     print(' * Acc@1 {top1.avg:.3f}\t * Prec {0}\t * Recall {1} * Acc@5 {top5.avg:.3f}\t'
           .format(report['macro avg']['precision'], report['macro avg']['recall'], top1=top1, top5=top5))
@@ -1,36 +1,51 @@
+from collections import OrderedDict
+from copy import copy, deepcopy
 from datetime import datetime
 
+import atexit
+import itertools
 import numpy as np
 import os
+import pandas as pd
 import shutil
 import math
 import random
+import tempfile
+import weakref
 
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 import torchvision
 
 from numpy.random import default_rng
+from scipy.stats import kendalltau
+from pytorch_msssim import SSIM
 from sklearn.metrics import precision_recall_fscore_support, classification_report, confusion_matrix, roc_auc_score, \
     pairwise_distances
 from torch.optim.lr_scheduler import LambdaLR
-from torch.utils.data import DataLoader
+from torch.utils.checkpoint import checkpoint
+from torch.utils.data import DataLoader, DistributedSampler
 
 from data.dataset_utils import WeaklySupervisedDataset
 from model.densenet import densenet121
+from model.ensemble import StackedEnsemble
 from model.lenet import LeNet
 from model.loss_net import LossNet
-from model.resnet import resnet18
+from model.pretrained import load_pretrained
+from model.resnet import resnet10, resnet18
 from model.resnet_autoencoder import ResnetAutoencoder
 from model.simclr_arch import SimCLRArch
 from model.wideresnet import WideResNet
 from augmentations.randaugment import RandAugmentMC
 
 import torch.nn.functional as F
-import torchvision.models as models
 
 
 def save_checkpoint(args, state, is_best, filename='checkpoint.pth.tar', best_model_filename='model_best.pth.tar'):
+    if get_rank() != 0:
+        return
+
     directory = os.path.join(args.checkpoint_path, f'{args.name}_{args.seed}')
     if not os.path.exists(directory):
         os.makedirs(directory)
@@ -40,6 +55,62 @@ def save_checkpoint(args, state, is_best, filename='checkpoint.pth.tar', best_mo
         shutil.copyfile(filename, os.path.join(directory, best_model_filename))
 
 
+def get_rng_state():
+    state = {'random': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['random'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def save_run_state(args, state, filename='run_state.pth.tar'):
+    """
+    Stores everything needed to resume an AL run (index sets, cycle counters, models, optimizers, metrics frames and
+    RNG states). The file is written next to the checkpoints and atomically replaced, so a crash while saving
+    leaves the previous run state intact.
+    """
+    if get_rank() != 0:
+        return
+
+    directory = os.path.join(args.checkpoint_path, f'{args.name}_{args.seed}')
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    filename = os.path.join(directory, filename)
+    state['rng_state'] = get_rng_state()
+
+    with open(filename + '.tmp', 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(filename + '.tmp', filename)
+
+
+def load_run_state(args, filename='run_state.pth.tar'):
+    if not args.resume_run:
+        return None
+
+    file = os.path.join(args.checkpoint_path, f'{args.name}_{args.seed}', filename)
+    if not os.path.isfile(file):
+        print("=> no run state found at '{0}'".format(file))
+        return None
+
+    print("=> loading run state '{}'".format(file))
+    try:
+        state = torch.load(file, map_location='cpu', weights_only=False)
+    except TypeError:
+        state = torch.load(file, map_location='cpu')
+    print("=> loaded run state (epoch {0}, cycle {1})".format(state['epoch'], state['cycle']))
+
+    return state
+
+
 class AverageMeter(object):
     def __init__(self):
         self.val = 0
@@ -79,6 +150,437 @@ class LossPerClassMeter(object):
             # noinspection PyTypeChecker
             self.avg[i] = self.sum[i] / (self.count[i] + 1e-6)
 
+    def synchronize(self):
+        """
+        Sums the losses and counts of all ranks under --distributed, so the averages cover the samples of every rank
+        """
+        if not is_distributed():
+            return
+
+        totals = torch.tensor([self.sum, self.count], dtype=torch.float64)
+        dist.all_reduce(totals)
+        self.sum, self.count = totals[0].tolist(), totals[1].tolist()
+        self.avg = [self.sum[i] / (self.count[i] + 1e-6) for i in range(self.classes_num)]
+
+
+class ModelSnapshot:
+    """
+    Copy of a model's parameters and buffers kept in preallocated CPU tensors, used instead of deep-copying the live
+    module. Tensors whose version counter has not changed since the last update are not copied again, and a module
+    holding the snapshot weights is only built when a caller asks for it.
+    """
+
+    def __init__(self, model, dtype=None):
+        self.model = None
+        self.dtype = dtype
+        self.buffers = None
+        self.source_versions = {}
+        self.version = 0
+        self.module = None
+        self.module_version = -1
+        self.update(model)
+
+    def allocate(self, state):
+        self.buffers = OrderedDict()
+        for k, v in state.items():
+            dtype = self.dtype if self.dtype is not None and v.is_floating_point() else v.dtype
+            self.buffers[k] = torch.empty(v.shape, dtype=dtype, device='cpu', pin_memory=torch.cuda.is_available())
+        self.source_versions = {}
+
+    def update(self, model):
+        state = model.state_dict(keep_vars=True)
+
+        if model is not self.model:
+            self.model = model
+            self.source_versions = {}
+        if self.buffers is None or list(self.buffers.keys()) != list(state.keys()) or \
+                any(self.buffers[k].shape != v.shape for k, v in state.items()):
+            self.allocate(state)
+
+        copied = 0
+        for k, v in state.items():
+            source_version = (v.data_ptr(), v._version)
+            if self.source_versions.get(k) == source_version:
+                continue
+            self.buffers[k].copy_(v.detach())
+            self.source_versions[k] = source_version
+            copied += 1
+
+        self.version += 1 if copied > 0 else 0
+        return self
+
+    def state_dict(self):
+        return self.buffers
+
+    def load_state_dict(self, state_dict):
+        for k, v in state_dict.items():
+            self.buffers[k].copy_(v)
+        self.source_versions = {}
+        self.version += 1
+
+    def restore(self, model):
+        model.load_state_dict(self.buffers)
+        return model
+
+    def materialize(self):
+        if self.module is None:
+            self.module = deepcopy(self.model)
+        if self.module_version != self.version:
+            self.restore(self.module)
+            self.module_version = self.version
+        return self.module
+
+    def key_of(self, model):
+        if model is self.module and self.module_version == self.version:
+            return id(self), self.version
+        if model is self.model and all(self.source_versions.get(k) == (v.data_ptr(), v._version)
+                                       for k, v in model.state_dict(keep_vars=True).items()):
+            return id(self), self.version
+        return None
+
+
+def forward_logits_embeddings(model, x):
+    if hasattr(model, 'forward_encoder') and hasattr(model, 'forward_classifier'):
+        h = model.forward_encoder(x)
+        return model.forward_classifier(h), h
+    return model(x), None
+
+
+def forward_embeddings(model, x):
+    return None, model.forward_encoder(x)
+
+
+def predict_member_probabilities(model, loader):
+    """
+    Softmax outputs of every member of a StackedEnsemble on the loader, as an N x M x C tensor (the layout of the
+    MC dropout samples consumed by the BatchBald sampler), computed with one stacked forward per batch.
+    """
+    model.eval()
+    probs = []
+
+    with torch.no_grad():
+        for data_x, _ in loader:
+            members = model.forward_members(data_x.to(get_device(), non_blocking=True))
+            probs.append(torch.softmax(members, dim=-1).transpose(0, 1).cpu())
+
+    return torch.cat(probs)
+
+
+def predict_logits(model, loader):
+    """
+    Logits of the model on the loader in the mode the model is in, bypassing the inference cache: used for the
+    stochastic passes (e.g. MC dropout) whose outputs are never reused.
+    """
+    logits = []
+
+    with torch.no_grad():
+        for data_x, _ in loader:
+            logits.append(forward_logits_embeddings(model, data_x.to(get_device(), non_blocking=True))[0].cpu())
+
+    return torch.cat(logits)
+
+
+class InferenceCache:
+    """
+    Process-wide cache of the logits and penultimate embeddings of dataset samples. Entries are keyed by the model
+    version, the base dataset, the transform, the forward function and an optional variant and hold memory-mapped
+    arrays indexed by the base-dataset index (float32 logits, float16 embeddings), so only samples without a cached row
+    are inferred. The version of a module is the version of a tracked ModelSnapshot when it holds the snapshot weights,
+    otherwise the storage and version counters of its tensors. Least recently used entries are deleted once the cache
+    holds more than the byte budget.
+    """
+
+    def __init__(self, directory, budget):
+        self.directory = directory
+        self.budget = budget
+        self.entries = OrderedDict()
+        self.serials = weakref.WeakKeyDictionary()
+        self.snapshots = weakref.WeakSet()
+        self.counter = itertools.count()
+        atexit.register(self.clear)
+
+    def serial(self, obj):
+        if obj not in self.serials:
+            self.serials[obj] = next(self.counter)
+        return self.serials[obj]
+
+    def track(self, snapshot):
+        self.snapshots.add(snapshot)
+
+    def model_key(self, model):
+        for snapshot in self.snapshots:
+            key = snapshot.key_of(model)
+            if key is not None:
+                return self.serial(snapshot), key[1]
+        return self.serial(model), hash(tuple((v.data_ptr(), v._version)
+                                              for v in model.state_dict(keep_vars=True).values()))
+
+    def dataset_key(self, dataset):
+        return self.serial(dataset.dataset), repr(dataset.transform), getattr(dataset, 'poisson', False)
+
+    dtypes = {'logits': np.float32, 'embeddings': np.float16}
+
+    def allocate(self, name, rows, dim):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        filename = os.path.join(self.directory, f'{os.getpid()}_{next(self.counter)}.npy')
+        return np.lib.format.open_memmap(filename, mode='w+', dtype=self.dtypes[name], shape=(rows, dim))
+
+    @staticmethod
+    def nbytes(entry):
+        return entry['valid'].nbytes + sum(entry[name].nbytes for name in ('logits', 'embeddings')
+                                           if entry[name] is not None)
+
+    @staticmethod
+    def release(entry):
+        for name in ('logits', 'embeddings'):
+            if entry[name] is not None:
+                filename = entry[name].filename
+                entry[name] = None
+                os.remove(filename)
+
+    def evict(self):
+        while len(self.entries) > 1 and sum(self.nbytes(entry) for entry in self.entries.values()) > self.budget:
+            _, entry = self.entries.popitem(last=False)
+            self.release(entry)
+
+    def clear(self):
+        while len(self.entries) > 0:
+            _, entry = self.entries.popitem()
+            self.release(entry)
+
+    def predict(self, model, loader, forward=forward_logits_embeddings, variant=None, model_key=None):
+        dataset = loader.dataset
+        indices = np.array(dataset.indices)
+        key = (self.model_key(model) if model_key is None else model_key, self.dataset_key(dataset),
+               forward.__name__, variant)
+
+        if key not in self.entries:
+            self.entries[key] = {'valid': np.zeros(len(dataset.dataset), dtype=bool), 'logits': None,
+                                 'embeddings': None}
+        self.entries.move_to_end(key)
+        entry = self.entries[key]
+
+        missing = indices[~entry['valid'][indices]]
+        if missing.shape[0] > 0:
+            missing_dataset = copy(dataset)
+            missing_dataset.indices = missing
+            missing_loader = DataLoader(dataset=missing_dataset, batch_size=loader.batch_size, shuffle=False,
+                                        num_workers=loader.num_workers, pin_memory=loader.pin_memory)
+
+            start = 0
+            with torch.no_grad():
+                for data_x, _ in missing_loader:
+                    rows = missing[start:start + data_x.size(0)]
+                    outputs = forward(model, data_x.to(get_device(), non_blocking=True))
+                    for name, output in zip(('logits', 'embeddings'), outputs):
+                        if output is None:
+                            continue
+                        if entry[name] is None:
+                            entry[name] = self.allocate(name, entry['valid'].shape[0], output.size(1))
+                        entry[name][rows] = output.cpu().numpy()
+                    start += data_x.size(0)
+            entry['valid'][missing] = True
+            self.evict()
+
+        return tuple(torch.from_numpy(np.asarray(entry[name][indices], dtype=np.float32))
+                     if entry[name] is not None else None for name in ('logits', 'embeddings'))
+
+    def drop(self, dataset, indices):
+        for key, entry in self.entries.items():
+            if key[1] == self.dataset_key(dataset):
+                entry['valid'][indices] = False
+
+
+class RankingStability:
+    """
+    Tracks how the top-`number` selection of an iterative sampler changes from one pass to the next. The selection is
+    stable once the top-`number` overlap (--adaptive-metric overlap) or the Kendall tau between the scores
+    (--adaptive-metric kendall) of two consecutive passes reaches --adaptive-threshold in --adaptive-patience passes
+    in a row, and at least --adaptive-min-iterations passes were run.
+    """
+
+    def __init__(self, args, number, descending):
+        self.number = number
+        self.descending = descending
+        self.metric = args.adaptive_metric
+        self.threshold = args.adaptive_threshold
+        self.patience = args.adaptive_patience
+        self.min_iterations = args.adaptive_min_iterations
+        self.iterations = 0
+        self.stable_passes = 0
+        self.previous_scores, self.previous_selection = None, None
+        self.values = []
+
+    def rank(self, scores):
+        return torch.sort(scores, descending=self.descending, stable=True)[1]
+
+    def update(self, scores):
+        scores = scores.float().cpu()
+        selection = self.rank(scores)[:self.number]
+        self.iterations += 1
+
+        if self.previous_scores is not None:
+            if self.metric == 'kendall':
+                value = kendalltau(self.previous_scores.numpy(), scores.numpy())[0]
+            else:
+                value = len(set(selection.tolist()) & set(self.previous_selection.tolist())) / max(1, len(selection))
+            self.values.append(value)
+            self.stable_passes = self.stable_passes + 1 if value >= self.threshold else 0
+
+        self.previous_scores, self.previous_selection = scores, selection
+
+        return self.iterations >= self.min_iterations and self.stable_passes >= self.patience
+
+    def get_log(self, epoch, max_iterations):
+        return {'epoch': epoch, 'metric': self.metric, 'iterations': self.iterations,
+                'max_iterations': max_iterations, 'stability': self.values[-1] if len(self.values) > 0 else None}
+
+
+inference_cache = None
+
+
+def get_inference_cache(args=None):
+    global inference_cache
+    if inference_cache is None:
+        directory = os.path.join(args.checkpoint_path, 'inference_cache') if args is not None else tempfile.mkdtemp()
+        budget = args.inference_cache_budget if args is not None else 1024
+        inference_cache = InferenceCache(directory, budget * 1024 ** 2)
+    return inference_cache
+
+
+class FeatureCache:
+    """
+    Encoder outputs of every sample of a base dataset, stored in a memory-mapped array and indexed by the base-dataset
+    index, so a classifier head on a frozen encoder can be trained and validated without re-running the encoder. With
+    variants > 0 the samples are encoded that many times with the given (random) transform and one variant is drawn
+    per sample and batch. Under --distributed every rank keeps its own file, and shuffled (training) iteration
+    only covers the shard of the rank, drawn like EpochDistributedSampler.
+    """
+
+    def __init__(self, filename, encode, dataset, transform, batch_size, kwargs, variants=0):
+        self.base_dataset = dataset.dataset
+        self.targets = dataset.targets
+        self.epoch = 0
+
+        if is_distributed():
+            filename = '{0}_{2}{1}'.format(*os.path.splitext(filename), get_rank())
+
+        cache_dataset = copy(dataset)
+        cache_dataset.indices = np.arange(len(dataset.dataset))
+        cache_dataset.transform = transform
+        loader = DataLoader(dataset=cache_dataset, batch_size=batch_size, shuffle=False,
+                            **dict(kwargs, drop_last=False))
+
+        directory = os.path.dirname(filename)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.features = None
+        with torch.no_grad():
+            for variant in range(max(1, variants)):
+                start = 0
+                for data_x, _ in loader:
+                    h = encode(data_x.to(get_device(), non_blocking=True)).cpu().numpy()
+                    if self.features is None:
+                        self.features = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float32,
+                                                                  shape=(max(1, variants), len(cache_dataset),
+                                                                         h.shape[1]))
+                    self.features[variant, start:start + h.shape[0]] = h
+                    start += h.shape[0]
+        self.features.flush()
+
+    def iterate(self, dataset, batch_size, shuffle=False, seed=0):
+        indices = np.array(dataset.indices)
+        if shuffle and is_distributed():
+            sampler = DistributedSampler(dataset, shuffle=True, seed=seed)
+            sampler.set_epoch(self.epoch)
+            self.epoch += 1
+            order = np.array(list(sampler))
+        else:
+            order = np.random.permutation(len(indices)) if shuffle else np.arange(len(indices))
+
+        for start in range(0, len(order), batch_size):
+            batch = indices[order[start:start + batch_size]]
+            variants = np.random.randint(self.features.shape[0], size=batch.shape[0])
+
+            yield torch.from_numpy(self.features[variants, batch]), torch.from_numpy(self.targets[batch])
+
+
+class ActivationCache:
+    """
+    Outputs of the frozen prefix of a model (see ResNet.freeze) for every sample of a dataset with a deterministic
+    transform, stored in a memory-mapped array by base-dataset index. Validation then only runs the unfrozen suffix.
+    The cache is rebuilt when the dataset, the frozen stage or the frozen weights change. Under --distributed every rank
+    keeps its own file.
+    """
+
+    def __init__(self, filename, kwargs):
+        self.filename = '{0}_{2}{1}'.format(*os.path.splitext(filename), get_rank()) if is_distributed() else filename
+        self.kwargs = kwargs
+        self.key = None
+        self.activations = None
+
+    @staticmethod
+    def fingerprint(model):
+        return tuple(float(t.double().sum()) for module in model.prefix_modules()
+                     for t in module.state_dict().values())
+
+    def build(self, model, dataset, batch_size):
+        cache_dataset = copy(dataset)
+        cache_dataset.indices = np.arange(len(dataset.dataset))
+        loader = DataLoader(dataset=cache_dataset, batch_size=batch_size, shuffle=False,
+                            **dict(self.kwargs, drop_last=False))
+
+        directory = os.path.dirname(self.filename)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        model.eval()
+        self.activations, start = None, 0
+        for data_x, _ in loader:
+            out = model.forward_prefix(data_x.to(get_device(), non_blocking=True)).cpu().numpy()
+            if self.activations is None:
+                self.activations = np.lib.format.open_memmap(self.filename, mode='w+', dtype=np.float32,
+                                                             shape=(len(cache_dataset),) + out.shape[1:])
+            self.activations[start:start + out.shape[0]] = out
+            start += out.shape[0]
+        self.activations.flush()
+
+    def iterate(self, model, loader):
+        """
+        Returns the batches of the loader and the forward function to apply to them: cached prefix activations and the
+        model suffix if a prefix is frozen, the loader itself and the full forward otherwise.
+        """
+        if getattr(model, 'frozen_stage', 0) == 0:
+            return loader, model.forward_encoder_classifier
+
+        dataset = loader.dataset
+        key = (id(dataset.dataset), id(dataset.transform), model.frozen_stage, self.fingerprint(model))
+        if key != self.key:
+            self.build(model, dataset, loader.batch_size)
+            self.key = key
+
+        def batches():
+            indices = np.array(dataset.indices)
+            for start in range(0, indices.shape[0], loader.batch_size):
+                batch = indices[start:start + loader.batch_size]
+                yield torch.from_numpy(self.activations[batch]), torch.from_numpy(dataset.targets[batch])
+
+        return batches(), model.forward_suffix
+
+
+def apply_freeze_schedule(args, model, init, cycle):
+    """
+    Freezes the first --freeze-stage stages of a pretrained (ImageNet, SimCLR or autoencoder) model during the first
+    --freeze-cycles AL cycles (all cycles if 0), and unfreezes it afterwards.
+    """
+    if init not in ['pretrained', 'simclr', 'autoencoder'] or not hasattr(model, 'freeze'):
+        return model
+
+    stage = args.freeze_stage if args.freeze_cycles == 0 or cycle < args.freeze_cycles else 0
+    return model.freeze(stage)
+
 
 class View(nn.Module):
     def __init__(self, shape):
@@ -116,20 +618,454 @@ def accuracy(output, target, topk=(1,)):
 
 
 def create_loaders(args, labeled_dataset, unlabeled_dataset, test_dataset, labeled_indices, unlabeled_indices, kwargs,
-                   unlabeled_subset_num):
+                   unlabeled_subset_num, shuffle_unlabeled=True):
     labeled_dataset.indices = labeled_indices
-    random.shuffle(unlabeled_indices)
+    if shuffle_unlabeled:
+        random.shuffle(unlabeled_indices)
+        if is_distributed():
+            unlabeled_indices[:] = broadcast_object(unlabeled_indices)
     unlabeled_dataset.indices = unlabeled_indices[:unlabeled_subset_num]
 
-    labeled_loader = DataLoader(dataset=labeled_dataset, batch_size=args.batch_size, shuffle=True, **kwargs)
+    labeled_loader = create_train_loader(labeled_dataset, args.batch_size, kwargs, seed=args.seed)
     unlabeled_loader = DataLoader(dataset=unlabeled_dataset, batch_size=args.batch_size, shuffle=False, **kwargs)
-    val_loader = DataLoader(dataset=test_dataset, batch_size=args.batch_size, shuffle=True, **kwargs)
+    val_loader = create_val_loader(test_dataset, args.batch_size, kwargs, shuffle=True)
 
     return labeled_loader, unlabeled_loader, val_loader
 
 
+def create_subset_loader(loader, positions, transform=None):
+    dataset = copy(loader.dataset)
+    dataset.indices = np.array(loader.dataset.indices)[positions]
+    if transform is not None:
+        dataset.transform = transform
+        dataset.poisson = False
+
+    return DataLoader(dataset=dataset, batch_size=loader.batch_size, shuffle=False, num_workers=loader.num_workers,
+                      pin_memory=loader.pin_memory)
+
+
+def top_k_positions(scores, positions, number, descending=True):
+    """
+    The number best scores and their positions, ties broken by the lower position, so the selection does not depend on
+    the order in which the candidates were scored
+    """
+    order = np.lexsort((positions, -scores if descending else scores))[:number]
+    return scores[order], positions[order]
+
+
+def score_shard(model, dataset, positions, batch_size, score, number, descending, threads):
+    if len(positions) == 0:
+        return np.zeros(0, dtype=np.float32), positions
+
+    torch.set_num_threads(threads)
+    loader = DataLoader(dataset=dataset, batch_size=batch_size, shuffle=False, num_workers=0)
+    device = next(model.parameters()).device
+    model.eval()
+    scores = []
+
+    with torch.no_grad():
+        for data_x, _ in loader:
+            logits, _ = forward_logits_embeddings(model, data_x.to(device, non_blocking=True))
+            scores.append(score(F.softmax(logits, dim=1)).cpu())
+
+    return top_k_positions(torch.cat(scores).numpy(), positions, number, descending)
+
+
+class ShardedScoringExecutor:
+    """
+    Scores the unlabeled subset on CPU in --scoring-workers spawned processes. The model weights are moved to shared
+    memory once and every worker scores a contiguous, batch-aligned shard of the subset with --scoring-threads threads
+    and returns its local top-k, which are merged with the same tie-breaking. Batches and thread counts are the same for
+    any number of workers, so the selection is identical to the in-process run with one worker.
+    """
+
+    def __init__(self, workers, threads=1):
+        self.workers = workers
+        self.threads = threads
+
+    def shards(self, size, batch_size):
+        batches = np.arange(int(math.ceil(size / batch_size)))
+        return [np.arange(chunk[0] * batch_size, min(size, (chunk[-1] + 1) * batch_size))
+                for chunk in np.array_split(batches, self.workers) if len(chunk) > 0]
+
+    @staticmethod
+    def shard_dataset(loader, positions):
+        dataset = copy(loader.dataset)
+        dataset.indices = np.array(loader.dataset.indices)[positions]
+        return dataset
+
+    def top_k(self, model, loader, score, number, descending=True):
+        model = deepcopy(model).cpu().share_memory()
+        tasks = []
+        for positions in self.shards(len(loader.dataset), loader.batch_size):
+            tasks.append((model, self.shard_dataset(loader, positions), positions, loader.batch_size, score, number,
+                          descending, self.threads))
+
+        if len(tasks) == 1:
+            threads = torch.get_num_threads()
+            results = [score_shard(*tasks[0])]
+            torch.set_num_threads(threads)
+        else:
+            with torch.multiprocessing.get_context('spawn').Pool(len(tasks)) as pool:
+                results = pool.starmap(score_shard, tasks)
+
+        _, positions = top_k_positions(np.concatenate([scores for scores, _ in results]),
+                                       np.concatenate([positions for _, positions in results]), number, descending)
+        return torch.from_numpy(positions)
+
+
+def get_device():
+    if torch.cuda.is_available():
+        # ordinals are relative to CUDA_VISIBLE_DEVICES (--gpu-id), the ranks of torchrun are spread over the visible
+        # GPUs and share one when a single GPU is pinned
+        return torch.device('cuda', int(os.environ.get('LOCAL_RANK', 0)) % torch.cuda.device_count())
+    return torch.device('cpu')
+
+
+def init_distributed(args):
+    """
+    Joins the process group started by torchrun (--distributed, WORLD_SIZE > 1) and returns the rank of the process
+    """
+    if args.distributed and int(os.environ.get('WORLD_SIZE', 1)) > 1 and not dist.is_initialized():
+        dist.init_process_group(backend=args.distributed_backend)
+        if torch.cuda.is_available():
+            torch.cuda.set_device(get_device())
+    return get_rank()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def broadcast_object(obj, src=0):
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
+
+
+def all_gather_rows(tensor):
+    """
+    The tensors of all ranks concatenated along the first dimension in rank order. Built on all_reduce, so it also runs
+    on CUDA tensors with the gloo backend; every rank has to pass a tensor of the same shape.
+    """
+    rows = torch.zeros((get_world_size(),) + tuple(tensor.shape), dtype=tensor.dtype, device=tensor.device)
+    rows[get_rank()] = tensor
+    dist.all_reduce(rows)
+    return rows.flatten(0, 1)
+
+
+def synchronize_model(model):
+    """
+    Copies the parameters and buffers of rank 0 to the other ranks, so all replicas of a newly created model start from
+    the same weights
+    """
+    if is_distributed():
+        with torch.no_grad():
+            for tensor in model.state_dict().values():
+                dist.broadcast(tensor, src=0)
+    return model
+
+
+def synchronize_gradients(model):
+    """
+    Data-parallel step of --distributed: averages the gradients of all ranks with one all-reduce of the flattened
+    gradients and broadcasts the floating point buffers (BatchNorm statistics) of rank 0, called between backward() and
+    the optimizer step. Works for any forward method of the model, including chunked and vmapped forwards. Parameters
+    that have no gradient on any rank keep grad None, so the optimizer skips them as in the single-process run.
+    """
+    if not is_distributed():
+        return
+
+    with torch.no_grad():
+        params = [p for p in model.parameters() if p.requires_grad]
+        present = torch.tensor([p.grad is not None for p in params], dtype=torch.float32,
+                               device=params[0].device if len(params) > 0 else get_device())
+        dist.all_reduce(present)
+
+        params = [p for p, count in zip(params, present.tolist()) if count > 0]
+        for p in params:
+            if p.grad is None:
+                p.grad = torch.zeros_like(p)
+        if len(params) > 0:
+            flat = torch.cat([p.grad.flatten() for p in params])
+            dist.all_reduce(flat)
+            flat /= get_world_size()
+            for p, grad in zip(params, flat.split([p.numel() for p in params])):
+                p.grad.copy_(grad.view_as(p))
+
+        buffers = [b for b in model.buffers() if b.is_floating_point()]
+        if len(buffers) > 0:
+            flat = torch.cat([b.flatten() for b in buffers])
+            dist.broadcast(flat, src=0)
+            for b, value in zip(buffers, flat.split([b.numel() for b in buffers])):
+                b.copy_(value.view_as(b))
+
+
+class EpochDistributedSampler(DistributedSampler):
+    """
+    DistributedSampler that moves to its next epoch every time it is iterated, so the training loops need no
+    set_epoch calls and all ranks draw the same permutation in every epoch of every AL cycle
+    """
+
+    def __iter__(self):
+        indices = super(EpochDistributedSampler, self).__iter__()
+        self.set_epoch(self.epoch + 1)
+        return indices
+
+
+def create_train_loader(dataset, batch_size, kwargs, drop_last=False, seed=0):
+    # the trainers pass drop_last in their loader kwargs, which then applies to the sampler shards as well
+    kwargs = dict(kwargs)
+    drop_last = kwargs.pop('drop_last', drop_last)
+
+    if is_distributed():
+        return DataLoader(dataset=dataset, batch_size=batch_size, drop_last=drop_last,
+                          sampler=EpochDistributedSampler(dataset, shuffle=True, seed=seed, drop_last=drop_last),
+                          **kwargs)
+    return DataLoader(dataset=dataset, batch_size=batch_size, drop_last=drop_last, shuffle=True, **kwargs)
+
+
+def create_val_loader(dataset, batch_size, kwargs, shuffle=False):
+    """
+    Under --distributed every rank validates a strided shard of the test samples instead of the whole set. The shards
+    are not padded, so no sample is counted twice when the validation loops combine them with Metrics.synchronize and
+    LossPerClassMeter.synchronize.
+    """
+    if is_distributed():
+        dataset = copy(dataset)
+        dataset.indices = np.array(dataset.indices)[get_rank()::get_world_size()]
+        shuffle = False
+    return DataLoader(dataset=dataset, batch_size=batch_size, shuffle=shuffle, **kwargs)
+
+
+def distributed_top_k(model, loader, score, number, descending=True):
+    """
+    Every rank scores a batch-aligned slice of the unlabeled subset with the weights of rank 0 and sends its local
+    top-k to rank 0, which merges them with the tie-breaking of the single-process selection. Returns the selected
+    positions on rank 0 and None on the other ranks.
+    """
+    synchronize_model(model)
+
+    shards = ShardedScoringExecutor(get_world_size()).shards(len(loader.dataset), loader.batch_size)
+    positions = shards[get_rank()] if get_rank() < len(shards) else np.zeros(0, dtype=np.int64)
+    result = score_shard(model, ShardedScoringExecutor.shard_dataset(loader, positions), positions, loader.batch_size,
+                         score, number, descending, torch.get_num_threads())
+
+    results = [None] * get_world_size() if get_rank() == 0 else None
+    dist.gather_object(result, results, dst=0)
+    if get_rank() != 0:
+        return None
+
+    _, positions = top_k_positions(np.concatenate([scores for scores, _ in results]),
+                                   np.concatenate([positions for _, positions in results]), number, descending)
+    return torch.from_numpy(positions)
+
+
+def train_loss_columns(report):
+    """
+    The train-loss columns of a per-epoch report, kept when the best epoch's report is rebuilt on the full test set at
+    cycle close so metrics_per_cycle has the same columns with and without --validation-subset
+    """
+    if report is None:
+        return None
+    return report[[column for column in report.columns if column.endswith('-train-loss')]]
+
+
+class ValidationScheduler:
+    """
+    Decides on which epochs the model is validated and on which test samples. With --validation-every N only every N-th
+    epoch is validated, and with --validation-subset below 1 the early-stopping decisions use a fixed class-stratified
+    subset of the test set while the best model of each cycle is evaluated on the full test set when the cycle closes.
+    """
+
+    def __init__(self, args, test_dataset, kwargs):
+        self.every = max(1, args.validation_every)
+        self.subset_ratio = args.validation_subset
+        self.full_at_cycle_end = self.subset_ratio < 1
+        self.subset_loader = None
+
+        if self.full_at_cycle_end:
+            subset_dataset = copy(test_dataset)
+            subset_dataset.indices = self.stratified_subset(test_dataset, self.subset_ratio, args.seed)
+            self.subset_loader = create_val_loader(subset_dataset, args.batch_size, kwargs)
+
+    @staticmethod
+    def stratified_subset(dataset, ratio, seed):
+        indices = np.array(dataset.indices)
+        targets = dataset.targets[indices]
+        rng = default_rng(seed=seed)
+
+        subset_indices = []
+        for i in np.unique(targets):
+            indices_cls = indices[targets == i]
+            size = max(1, int(round(ratio * indices_cls.shape[0])))
+            subset_indices.extend(rng.choice(indices_cls, size=size, replace=False).tolist())
+
+        return np.sort(subset_indices)
+
+    def should_validate(self, epoch):
+        return (epoch + 1) % self.every == 0
+
+    def get_loader(self, val_loader):
+        return self.subset_loader if self.subset_loader is not None else val_loader
+
+    def get_policy(self):
+        return pd.DataFrame.from_dict({
+            'validation_every': [self.every],
+            'validation_subset': [self.subset_ratio],
+            'validation_subset_size': [len(self.subset_loader.dataset) if self.subset_loader is not None else None],
+            'full_validation_at_cycle_end': [self.full_at_cycle_end],
+        })
+
+
+class StoppingPolicy:
+    """
+    Decides when training on the current labeled set stops and the AL cycle is performed. The base policy is the
+    patience rule (no macro recall improvement for more than --add-labeled-epochs epochs after the warmup), subclasses
+    may stop earlier based on the recall recorded during the current cycle. Every closed cycle is logged together with
+    the epochs the patience rule would still have trained.
+    """
+    name = 'patience'
+
+    def __init__(self, args, start_epoch=0):
+        self.warmup_epochs = args.labeled_warmup_epochs
+        self.patience = args.add_labeled_epochs
+        self.min_delta = args.stopping_min_delta
+        self.window = args.stopping_window
+        self.smoothing = args.stopping_smoothing
+        self.cycle_start = start_epoch
+        self.epochs, self.recalls = [], []
+        self.log = []
+
+    def update(self, epoch, recall):
+        self.epochs.append(epoch)
+        self.recalls.append(recall)
+
+    def plateaued(self, epoch):
+        return False
+
+    def should_stop(self, epoch, last_best_epochs):
+        stop = epoch > self.warmup_epochs and \
+            (last_best_epochs > self.patience or (last_best_epochs > 0 and self.plateaued(epoch)))
+
+        # under --distributed rank 0 decides, so ranks whose validation recall differs in the last digits still enter
+        # the collective calls of the AL cycle together instead of deadlocking
+        return broadcast_object(stop) if is_distributed() else stop
+
+    def close_cycle(self, epoch, last_best_epochs):
+        patience_stop = max(self.warmup_epochs + 1, epoch - last_best_epochs + self.patience + 1)
+        epochs_saved = max(0, patience_stop - epoch)
+
+        self.log.append({'cycle': len(self.log), 'policy': self.name, 'start_epoch': self.cycle_start,
+                         'stop_epoch': epoch, 'epochs_trained': epoch - self.cycle_start + 1,
+                         'epochs_saved': epochs_saved})
+        print(f'Cycle stopped by {self.name} policy at epoch {epoch}, epochs saved {epochs_saved}')
+
+        self.cycle_start = epoch + 1
+        self.epochs, self.recalls = [], []
+
+    def state_dict(self):
+        return {'cycle_start': self.cycle_start, 'log': self.log}
+
+    def load_state_dict(self, state_dict):
+        self.cycle_start = state_dict['cycle_start']
+        self.log = state_dict['log']
+
+    def get_log(self):
+        return pd.DataFrame(self.log)
+
+
+class SmoothedImprovementStopping(StoppingPolicy):
+    """
+    Stops when the exponentially smoothed macro recall gained less than --stopping-min-delta over the last
+    --stopping-window validations of the cycle.
+    """
+    name = 'smoothed'
+
+    def plateaued(self, epoch):
+        if len(self.recalls) <= self.window:
+            return False
+
+        smoothed, current = [], self.recalls[0]
+        for recall in self.recalls:
+            current = self.smoothing * current + (1 - self.smoothing) * recall
+            smoothed.append(current)
+
+        return smoothed[-1] - smoothed[-1 - self.window] < self.min_delta
+
+
+class CurveExtrapolationStopping(StoppingPolicy):
+    """
+    Fits recall(t) = a - b / sqrt(t) to the macro recall of the current cycle and stops when the recall extrapolated
+    --add-labeled-epochs epochs ahead gains less than --stopping-min-delta over the best recall of the cycle.
+    """
+    name = 'curve'
+
+    def plateaued(self, epoch):
+        if len(self.recalls) < self.window:
+            return False
+
+        t = np.array(self.epochs) - self.cycle_start + 1
+        slope, intercept = np.polyfit(1 / np.sqrt(t), np.array(self.recalls), 1)
+        predicted = intercept + slope / np.sqrt(epoch - self.cycle_start + 1 + self.patience)
+
+        return predicted - max(self.recalls) < self.min_delta
+
+
+def create_stopping_policy(args, start_epoch=0):
+    policies = {'patience': StoppingPolicy, 'smoothed': SmoothedImprovementStopping,
+                'curve': CurveExtrapolationStopping}
+
+    return policies[args.stopping_policy](args, start_epoch=start_epoch)
+
+
+def forward_views(forward, *views):
+    """
+    Runs several views of a batch through a single forward pass and splits every output back per view.
+    """
+    sizes = [view.size(0) for view in views]
+    outputs = forward(torch.cat(views))
+
+    if isinstance(outputs, tuple):
+        return tuple(zip(*[output.split(sizes) for output in outputs]))
+    return outputs.split(sizes)
+
+
+@torch.no_grad()
+def forward_no_grad(forward, inputs, chunk_size=0):
+    """
+    Forward pass without autograd graph, e.g. for the FixMatch weak view whose logits are only used as pseudo-labels,
+    optionally in chunks of chunk_size samples.
+    """
+    chunks = inputs.split(chunk_size) if chunk_size > 0 else [inputs]
+    return torch.cat([forward(chunk) for chunk in chunks])
+
+
+def backward_chunks(forward, criterion, inputs, targets, mask, weight, chunk_size):
+    """
+    Backpropagates weight * mean(criterion(forward(inputs), targets) * mask) in chunks of chunk_size samples, so only
+    one chunk of activations is resident at a time. Returns the detached loss.
+    """
+    total_loss = 0
+    for inputs_chunk, targets_chunk, mask_chunk in zip(inputs.split(chunk_size), targets.split(chunk_size),
+                                                       mask.split(chunk_size)):
+        loss = (criterion(forward(inputs_chunk), targets_chunk) * mask_chunk).sum() / inputs.size(0)
+        (weight * loss).backward()
+        total_loss += loss.detach()
+
+    return total_loss
+
+
 def create_base_loader(base_dataset, kwargs, batch_size):
-    return DataLoader(dataset=base_dataset, batch_size=batch_size, drop_last=True, shuffle=True, **kwargs)
+    return create_train_loader(base_dataset, batch_size, kwargs, drop_last=True)
 
 
 def random_sampling(unlabeled_indices, number):
@@ -160,6 +1096,22 @@ class Metrics:
         self.outputs_probs = mini_outputs \
             if self.outputs_probs is None else torch.cat([self.outputs_probs, mini_outputs], dim=0)
 
+    def synchronize(self):
+        """
+        Gathers the targets and predictions of all ranks under --distributed, so every rank reports on the whole
+        (sharded) test set and takes the same best-model decisions
+        """
+        if not is_distributed():
+            return
+
+        shards = [None] * get_world_size()
+        dist.all_gather_object(shards, (self.targets, self.outputs,
+                                        self.outputs_probs.cpu() if self.outputs_probs is not None else None))
+        self.targets = [target for targets, _, _ in shards for target in targets]
+        self.outputs = [output for _, outputs, _ in shards for output in outputs]
+        probs = [outputs_probs for _, _, outputs_probs in shards if outputs_probs is not None]
+        self.outputs_probs = torch.cat(probs) if len(probs) > 0 else None
+
     def get_metrics(self, average='macro'):
         return precision_recall_fscore_support(self.targets, self.outputs, average=average, zero_division=1)
 
@@ -176,44 +1128,131 @@ class Metrics:
 
 
 class NTXent(nn.Module):
-    def __init__(self, batch_size, temperature, device):
+    """
+    NT-Xent loss computed from the matmul of the normalized embeddings. Masking only the self-similarity out of the
+    logsumexp gives the same value as the cross entropy over [positive, negatives] with O(B^2) memory. With chunk_size
+    set, the similarity rows are computed chunk by chunk under checkpointing, so only one chunk of the similarity matrix
+    is kept for the backward pass.
+    """
+
+    def __init__(self, temperature, chunk_size=None):
         super(NTXent, self).__init__()
         self.temperature = temperature
-        self.device = device
-        self.criterion = nn.CrossEntropyLoss(reduction="sum")
-        self.similarity_f = nn.CosineSimilarity(dim=2)
-        self.batch_size = batch_size
-        self.mask = self.mask_correlated_samples()
+        self.chunk_size = chunk_size
 
-    def mask_correlated_samples(self):
-        # noinspection PyTypeChecker
-        mask = torch.ones((self.batch_size * 2, self.batch_size * 2), dtype=bool)
-        mask = mask.fill_diagonal_(0)
-        for i in range(self.batch_size):
-            mask[i, self.batch_size + i] = 0
-            mask[self.batch_size + i, i] = 0
-        return mask
+    def chunk_loss(self, z_chunk, z, positives, rows):
+        sim = torch.matmul(z_chunk, z.t()) / self.temperature
+        sim = sim.masked_fill(rows.unsqueeze(1) == torch.arange(z.size(0), device=z.device).unsqueeze(0),
+                              float('-inf'))
+        positive = (z_chunk * positives).sum(dim=1) / self.temperature
+
+        return (torch.logsumexp(sim, dim=1) - positive).sum()
 
     def forward(self, z_i, z_j):
-        p1 = torch.cat((z_i, z_j), dim=0)
-        sim = self.similarity_f(p1.unsqueeze(1), p1.unsqueeze(0)) / self.temperature
+        batch_size = z_i.size(0)
+        z = F.normalize(torch.cat((z_i, z_j), dim=0), dim=1)
+        positives = torch.cat((z[batch_size:], z[:batch_size]), dim=0)
+        rows = torch.arange(2 * batch_size, device=z.device)
 
-        sim_i_j = torch.diag(sim, self.batch_size)
-        sim_j_i = torch.diag(sim, -self.batch_size)
+        if not self.chunk_size or self.chunk_size >= 2 * batch_size:
+            loss = self.chunk_loss(z, z, positives, rows)
+        else:
+            loss = 0
+            for start in range(0, 2 * batch_size, self.chunk_size):
+                end = start + self.chunk_size
+                loss = loss + checkpoint(self.chunk_loss, z[start:end], z, positives[start:end], rows[start:end],
+                                         use_reentrant=False)
 
-        positive_samples = torch.cat((sim_i_j, sim_j_i), dim=0).reshape(
-            self.batch_size * 2, 1
-        )
+        return loss / (2 * batch_size)
+
+
+class MoCoLoss(nn.Module):
+    """
+    InfoNCE loss of MoCo: the positive of a query is the momentum-encoder key of the other view, the negatives are a
+    fixed-size FIFO queue of keys from previous batches. The keys of the current batch are enqueued after the loss is
+    computed.
+    """
+
+    def __init__(self, queue_size, dim, temperature):
+        super(MoCoLoss, self).__init__()
+        self.temperature = temperature
+        self.criterion = nn.CrossEntropyLoss()
+        self.register_buffer('queue', F.normalize(torch.randn(queue_size, dim), dim=1))
+        self.queue_ptr = 0
 
-        negative_samples = sim[self.mask].reshape(self.batch_size * 2, -1)
+    @torch.no_grad()
+    def enqueue(self, k):
+        k = k[:self.queue.size(0)]
+        end = self.queue_ptr + k.size(0)
 
-        labels = torch.zeros(self.batch_size * 2).to(self.device).long()
-        logits = torch.cat((positive_samples, negative_samples), dim=1)
+        if end <= self.queue.size(0):
+            self.queue[self.queue_ptr:end] = k
+        else:
+            split = self.queue.size(0) - self.queue_ptr
+            self.queue[self.queue_ptr:] = k[:split]
+            self.queue[:end - self.queue.size(0)] = k[split:]
+
+        self.queue_ptr = end % self.queue.size(0)
+
+    def forward(self, q, k):
+        q = F.normalize(q, dim=1)
+        k = F.normalize(k.detach(), dim=1)
+
+        positive = (q * k).sum(dim=1, keepdim=True)
+        negative = torch.matmul(q, self.queue.clone().detach().t())
+
+        logits = torch.cat((positive, negative), dim=1) / self.temperature
+        labels = torch.zeros(q.size(0), dtype=torch.long, device=q.device)
         loss = self.criterion(logits, labels)
-        loss /= 2 * self.batch_size
+
+        self.enqueue(k)
+
+        return loss
+
+
+def parse_loss_weights(weights):
+    return {term: float(weight) for term, weight in (item.split(':') for item in weights.split(','))}
+
+
+class ReconstructionLoss(nn.Module):
+    """
+    Computes every requested reconstruction term (bce, l1, l2, ssim, where ssim enters as 1 - ssim) once per batch. The
+    training loss is the sum of the terms weighted by train_weights, the values weighted by log_weights and the
+    training loss are accumulated on the device and only copied to the host when the averages are requested.
+    """
+
+    def __init__(self, train_weights, log_weights):
+        super(ReconstructionLoss, self).__init__()
+        self.criterions = nn.ModuleDict({'bce': nn.BCELoss(), 'l1': nn.L1Loss(), 'l2': nn.MSELoss(),
+                                         'ssim': SSIM(size_average=True, data_range=1.0, nonnegative_ssim=True)})
+        self.terms = [term for term in self.criterions.keys()
+                      if train_weights.get(term, 0) != 0 or log_weights.get(term, 0) != 0]
+        self.log_terms = [term for term in self.terms if log_weights.get(term, 0) != 0]
+        self.register_buffer('train_weights', torch.tensor([train_weights.get(term, 0) for term in self.terms]))
+        self.register_buffer('log_weights', torch.tensor([log_weights.get(term, 0) for term in self.terms]))
+        self.log_mask = [term in self.log_terms for term in self.terms]
+        self.reset()
+
+    def reset(self):
+        self.log_sum, self.loss_sum, self.count = 0, 0, 0
+
+    def forward(self, output, target):
+        values = torch.stack([1 - self.criterions[term](output, target) if term == 'ssim'
+                              else self.criterions[term](output, target) for term in self.terms])
+        loss = (values * self.train_weights).sum()
+
+        self.log_sum = self.log_sum + values.detach() * self.log_weights
+        self.loss_sum = self.loss_sum + loss.detach()
+        self.count += 1
 
         return loss
 
+    def average_loss(self):
+        return (self.loss_sum / max(1, self.count)).item()
+
+    def average_log(self):
+        return (self.log_sum / max(1, self.count)).cpu().numpy()[self.log_mask]
+
 
 class TransformsSimCLR:
     def __init__(self, size):
@@ -264,8 +1303,7 @@ class TransformFix(object):
         return weak, strong
 
 
-def create_model_optimizer_scheduler(args, dataset_class, optimizer='adam', scheduler='steplr',
-                                     load_optimizer_scheduler=False):
+def create_model(args, dataset_class):
     if args.arch == 'wideresnet':
         model = WideResNet(depth=args.layers,
                            num_classes=dataset_class.num_classes,
@@ -282,10 +1320,20 @@ def create_model_optimizer_scheduler(args, dataset_class, optimizer='adam', sche
     else:
         raise NotImplementedError
 
+    return model
+
+
+def create_model_optimizer_scheduler(args, dataset_class, optimizer='adam', scheduler='steplr',
+                                     load_optimizer_scheduler=False, ensemble=False):
+    if ensemble and args.ensemble_size > 1:
+        model = StackedEnsemble([create_model(args, dataset_class) for _ in range(args.ensemble_size)])
+    else:
+        model = create_model(args, dataset_class)
+
     print('Number of model parameters: {}'.format(
         sum([p.data.nelement() for p in model.parameters()])))
 
-    model = model.cuda()
+    model = synchronize_model(model.to(get_device()))
 
     if optimizer == 'adam':
         optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
@@ -310,13 +1358,29 @@ def create_model_optimizer_scheduler(args, dataset_class, optimizer='adam', sche
     return model, optimizer, scheduler
 
 
+def create_proxy_model_optimizer(args, dataset_class):
+    if args.proxy_arch == 'lenet':
+        model = LeNet(num_channels=3, num_classes=dataset_class.num_classes,
+                      droprate=args.drop_rate, input_size=dataset_class.input_size)
+    elif args.proxy_arch == 'resnet10':
+        model = resnet10(num_classes=dataset_class.num_classes, input_size=dataset_class.input_size,
+                         drop_rate=args.drop_rate)
+    else:
+        raise NotImplementedError
+
+    model = synchronize_model(model.to(get_device()))
+    optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+
+    return model, optimizer
+
+
 def create_model_optimizer_simclr(args, dataset_class):
     model = SimCLRArch(num_channels=3,
                        num_classes=dataset_class.num_classes,
                        drop_rate=args.drop_rate, normalize=True, arch=args.simclr_arch,
-                       input_size=dataset_class.input_size)
+                       input_size=dataset_class.input_size, pretrained_cache_path=args.pretrained_cache_path)
 
-    model = model.cuda()
+    model = synchronize_model(model.to(get_device()))
 
     if args.simclr_resume:
         model, _, _ = resume_model(args, model)
@@ -332,7 +1396,7 @@ def create_model_optimizer_autoencoder(args, dataset_class):
     model = ResnetAutoencoder(z_dim=args.autoencoder_z_dim, num_classes=dataset_class.num_classes,
                               drop_rate=args.drop_rate, input_size=dataset_class.input_size)
 
-    model = model.cuda()
+    model = synchronize_model(model.to(get_device()))
 
     if args.autoencoder_resume:
         model, _, _ = resume_model(args, model)
@@ -344,7 +1408,7 @@ def create_model_optimizer_autoencoder(args, dataset_class):
 
 
 def create_model_optimizer_loss_net():
-    model = LossNet().cuda()
+    model = synchronize_model(LossNet().to(get_device()))
     optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
 
     return model, optimizer
@@ -356,9 +1420,10 @@ def get_loss(args, labeled_class_samples, reduction='mean'):
             classes_weights = np.clip(np.sum(labeled_class_samples) / np.array(labeled_class_samples),
                                       a_min=1, a_max=50)
             # noinspection PyArgumentList
-            criterion = nn.CrossEntropyLoss(weight=torch.FloatTensor(classes_weights).cuda(), reduction=reduction)
+            criterion = nn.CrossEntropyLoss(weight=torch.FloatTensor(classes_weights).to(get_device()),
+                                            reduction=reduction)
         else:
-            criterion = nn.CrossEntropyLoss(reduction=reduction).cuda()
+            criterion = nn.CrossEntropyLoss(reduction=reduction).to(get_device())
     else:
         if reduction == 'mean':
             criterion = FocalLoss(gamma=2, alpha=0.25, reduction=True)
@@ -435,7 +1500,19 @@ def perform_sampling(args, uncertainty_sampler, epoch, model, train_loader, unla
                      labeled_indices, unlabeled_indices, labeled_dataset, unlabeled_dataset, test_dataset, kwargs,
                      current_labeled):
     print(args.weak_supervision_strategy)
-    if args.weak_supervision_strategy == 'active_learning':
+    distributed = is_distributed()
+    if distributed and args.weak_supervision_strategy != 'random_sampling' and \
+            getattr(uncertainty_sampler, 'single_pass', False):
+        samples_indices = distributed_top_k(model, unlabeled_loader, uncertainty_sampler.method,
+                                            dataset_class.add_labeled, descending=uncertainty_sampler.descending)
+
+        print(f'Distributed Uncertainty Sampling\t '
+              f'Ranks: {get_world_size()}\t'
+              f'Current labeled ratio: {current_labeled + args.add_labeled}\t'
+              f'Model Reset')
+    elif get_rank() != 0:
+        samples_indices = None
+    elif args.weak_supervision_strategy == 'active_learning':
         samples_indices = uncertainty_sampler.get_samples(epoch, args, model,
                                                           train_loader,
                                                           unlabeled_loader,
@@ -461,12 +1538,16 @@ def perform_sampling(args, uncertainty_sampler, epoch, model, train_loader, unla
               f'Current labeled ratio: {current_labeled + args.add_labeled}\t'
               f'Model Reset')
 
-    labeled_indices, unlabeled_indices = postprocess_indices(labeled_indices, unlabeled_indices,
-                                                             samples_indices)
+    if get_rank() == 0:
+        labeled_indices, unlabeled_indices = postprocess_indices(labeled_indices, unlabeled_indices,
+                                                                 samples_indices)
 
-    if args.oversampling:
-        labeled_indices = oversampling_indices(labeled_indices,
-                                               np.array(labeled_dataset.targets)[labeled_indices])
+        if args.oversampling:
+            labeled_indices = oversampling_indices(labeled_indices,
+                                                   np.array(labeled_dataset.targets)[labeled_indices])
+
+    if distributed:
+        labeled_indices, unlabeled_indices = broadcast_object((labeled_indices, unlabeled_indices))
 
     train_loader, unlabeled_loader, val_loader = create_loaders(args, labeled_dataset, unlabeled_dataset,
                                                                 test_dataset, labeled_indices,
@@ -597,20 +1678,6 @@ class FocalLoss(nn.Module):
             return balanced_focal_loss
 
 
-def load_pretrained(model):
-    model_dict = model.state_dict()
-    resnet18_pretrained_dict = models.resnet18(pretrained=True).state_dict()
-
-    for key in list(model_dict.keys()):
-        if 'linear' in key or 'conv1.weight' == key:
-            continue
-        model_dict[key] = resnet18_pretrained_dict[key.replace('shortcut', 'downsample')]
-
-    model.load_state_dict(model_dict)
-
-    return model
-
-
 def class_wise_random_sample(targets, n=1, seed=9999):
     targets = np.array(targets)
     indices = np.arange(len(targets))
@@ -626,22 +1693,13 @@ def class_wise_random_sample(targets, n=1, seed=9999):
 
 
 def k_medoids_init(base_dataset, k_medoids_model, transform_test, mean, std, seed, n, k_medoids_n_clusters):
-    k_medoids_dataset = WeaklySupervisedDataset(base_dataset, range(len(base_dataset)), transform=transform_test,
+    k_medoids_dataset = WeaklySupervisedDataset(base_dataset, np.arange(len(base_dataset)), transform=transform_test,
                                                 mean=mean, std=std)
-    k_medoids_loader = DataLoader(dataset=k_medoids_dataset, batch_size=128, shuffle=True)
+    k_medoids_loader = DataLoader(dataset=k_medoids_dataset, batch_size=128, shuffle=False)
     k_medoids_model.eval()
 
-    features_h = None
-
-    with torch.no_grad():
-        for i, (data_x, data_y) in enumerate(k_medoids_loader):
-            data_x = data_x.cuda(non_blocking=True)
-
-            h = k_medoids_model.forward_encoder(data_x)
-            features_h = h if features_h is None else torch.cat([features_h, h], dim=0)
-            print('K-medoids features: [{0}/{1}]'.format(i, len(k_medoids_loader)))
-
-    features_h = features_h.cpu().numpy()
+    _, features_h = get_inference_cache().predict(k_medoids_model, k_medoids_loader, forward=forward_embeddings)
+    features_h = features_h.numpy()
     dist_mat = pairwise_distances(features_h)
 
     from sklearn_extra.cluster import KMedoids
@@ -673,12 +1731,22 @@ def print_args(args):
 
 
 def store_logs(args, logs_df, log_type='al_cycles'):
+    if get_rank() != 0:
+        return
+
     if log_type == 'epoch_wise':
         filename = '{0}-{1}-seed:{2}-epoch'.format(datetime.now().strftime("%d.%m.%Y"), args.name, args.seed)
     elif log_type == 'ae_loss':
         filename = '{0}-{1}-ae-loss'.format(datetime.now().strftime("%d.%m.%Y"), args.name)
     elif log_type == 'novel_class':
         filename = '{0}-{1}-seed:{2}-class-nums'.format(datetime.now().strftime("%d.%m.%Y"), args.name, args.seed)
+    elif log_type == 'stopping':
+        filename = '{0}-{1}-seed:{2}-stopping'.format(datetime.now().strftime("%d.%m.%Y"), args.name, args.seed)
+    elif log_type == 'acquisition':
+        filename = '{0}-{1}-seed:{2}-acquisition'.format(datetime.now().strftime("%d.%m.%Y"), args.name, args.seed)
+    elif log_type == 'validation_policy':
+        filename = '{0}-{1}-seed:{2}-validation-policy'.format(datetime.now().strftime("%d.%m.%Y"), args.name,
+                                                                 args.seed)
     else:
         filename = '{0}-{1}-seed:{2}'.format(datetime.now().strftime("%d.%m.%Y"), args.name, args.seed)
 